@@ -152,3 +152,7 @@ CLOUDINARY = {
 SUPABASE_URL = os.getenv('SUPABASE_URL', '')
 SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_KEY', '')
 
+# ML inference configuration
+# Load and warm up the artwork classifier when each worker starts. Under gunicorn --preload this
+# happens once in the master and the forked workers share the weight pages copy-on-write
+ML_PRELOAD_MODELS = os.getenv('ML_PRELOAD_MODELS', 'False') == 'True'
@@ -0,0 +1,184 @@
+"""
+Inference backends for the artwork classifier.
+
+Every backend exposes the same small interface (load, warm_up,
+predict_batch, describe) so the ModelRegistry, the batching engine and the
+views do not care which runtime executes the forward pass. The backend for
+a deployment is picked with ML_INFERENCE_BACKEND.
+"""
+
+import os
+
+import torch
+
+from ml_inference import INPUT_SIZE, WARMUP_RUNS, load_model
+
+# 0 uses the torch intra-op thread count from the worker's ml_threads plan
+ORT_THREADS = int(os.getenv('ML_ORT_THREADS', '0'))
+
+
+def state_dict_bytes(model):
+    """Bytes held by a model's parameters and buffers (including packed quantized weights)."""
+    total = 0
+    pending = list(model.state_dict().values())
+    while pending:
+        value = pending.pop()
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            pending.extend(value)
+    return total
+
+
+class InferenceBackend:
+    """Base class for a runtime that turns a (N, 3, H, W) batch into class probabilities."""
+
+    name = None
+
+    def __init__(self):
+        self.model_path = None
+
+    def load(self, model_path):
+        raise NotImplementedError
+
+    def warm_up(self, runs=WARMUP_RUNS, size=INPUT_SIZE):
+        for _ in range(runs):
+            self.predict_batch(torch.zeros(1, 3, size, size))
+
+    def predict_batch(self, batch):
+        """
+        Args:
+            batch (torch.Tensor): Float tensor of shape (N, 3, H, W).
+        Returns:
+            torch.Tensor: Softmax probabilities of shape (N, num_classes).
+        """
+        raise NotImplementedError
+
+    def embed_batch(self, batch):
+        """
+        Args:
+            batch (torch.Tensor): Float tensor of shape (N, 3, H, W).
+        Returns:
+            (torch.Tensor, torch.Tensor): Penultimate-layer features of shape
+            (N, D) and softmax probabilities of shape (N, num_classes), from
+            one forward pass.
+        Raises:
+            RuntimeError: If the runtime only exposes the final logits.
+        """
+        raise RuntimeError(f"The {self.name} backend does not expose embeddings for {self.model_path}")
+
+    def weight_bytes(self):
+        return 0
+
+    def describe(self):
+        return {'backend': self.name, 'model_path': self.model_path}
+
+
+class TorchBackend(InferenceBackend):
+    """Eager, TorchScript or int8 PyTorch models, loaded with ml_inference.load_model."""
+
+    name = 'torch'
+
+    def __init__(self):
+        super().__init__()
+        self.model = None
+        self.classifier = None
+
+    def load(self, model_path):
+        self.model = load_model(model_path)
+        self.model_path = model_path
+        # The last Linear (float or int8) is the classification layer; its input is the embedding.
+        # Frozen TorchScript graphs have no submodules left to hook.
+        if not isinstance(self.model, torch.jit.ScriptModule):
+            linears = [m for m in self.model.modules() if type(m).__name__ == 'Linear']
+            self.classifier = linears[-1] if linears else None
+
+    def predict_batch(self, batch):
+        with torch.no_grad():
+            return torch.softmax(self.model(batch), dim=1)
+
+    def embed_batch(self, batch):
+        if self.classifier is None:
+            return super().embed_batch(batch)
+        captured = []
+        hook = self.classifier.register_forward_pre_hook(lambda module, inputs: captured.append(inputs[0]))
+        try:
+            with torch.no_grad():
+                probs = torch.softmax(self.model(batch), dim=1)
+        finally:
+            hook.remove()
+        features = captured[0]
+        if features.is_quantized:
+            features = features.dequantize()
+        return features.float(), probs
+
+    def weight_bytes(self):
+        return state_dict_bytes(self.model)
+
+    def describe(self):
+        return {**super().describe(), 'torch_threads': torch.get_num_threads()}
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """ONNX Runtime on CPU, serving a graph written by ml_export.export_onnx."""
+
+    name = 'onnxruntime'
+
+    def __init__(self):
+        super().__init__()
+        self.session = None
+        self.input_name = None
+
+    def load(self, model_path):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("Failed to load model: onnxruntime is not installed")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = ORT_THREADS or torch.get_num_threads()
+        try:
+            self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        except Exception as e:
+            raise RuntimeError(f"Failed to load model: {e}")
+        self.input_name = self.session.get_inputs()[0].name
+        self.model_path = model_path
+
+    def predict_batch(self, batch):
+        logits = self.session.run(None, {self.input_name: batch.contiguous().numpy()})[0]
+        return torch.softmax(torch.from_numpy(logits), dim=1)
+
+    def weight_bytes(self):
+        if not self.model_path:
+            return 0
+        # Newer torch.onnx exporters keep the initializers in a .data sidecar file
+        sidecar = self.model_path + '.data'
+        return os.path.getsize(self.model_path) + (os.path.getsize(sidecar) if os.path.exists(sidecar) else 0)
+
+    def describe(self):
+        import onnxruntime as ort
+        return {
+            **super().describe(),
+            'onnxruntime_version': ort.__version__,
+            'providers': self.session.get_providers(),
+        }
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+}
+
+
+def create_backend(name):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise RuntimeError(f"Unknown inference backend '{name}', expected one of {sorted(BACKENDS)}")
+
+
+def backend_for_path(model_path):
+    """ONNX graphs run on ONNX Runtime; every other checkpoint runs on PyTorch."""
+    if model_path.endswith('.onnx'):
+        return create_backend(OnnxRuntimeBackend.name)
+    return create_backend(TorchBackend.name)
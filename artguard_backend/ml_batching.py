@@ -0,0 +1,487 @@
+"""
+Dynamic micro-batching in front of the artwork classifier.
+
+Request threads submit preprocessed image tensors and get a Future back. A
+single background thread collects pending requests until either
+ML_BATCH_MAX_SIZE items are queued or the oldest one has waited
+ML_BATCH_MAX_WAIT_MS, runs one forward pass for the whole group and fans the
+softmax rows back out to the callers. Embedding engines (get_engine with
+embed=True) do the same with ModelHandle.embed and hand each caller its
+(features, probabilities) rows.
+
+classify_image_bytes is complete_scan's whole inference step: prediction
+cache, near-duplicate lookup in the embedding index, then the model. When
+the embedding model is the served model, the lookup's embedding and the
+prediction come from one batched forward pass.
+"""
+
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import torch
+from PIL import Image
+
+from ml_cache import cache_key, get_cache
+from ml_cascade import get_cascade
+from ml_errors import QueueFullError
+from ml_inference import default_model_path, get_model_handle, registry
+from ml_metrics import BATCH_SIZE, ERRORS, PREDICTIONS, QUEUE_DEPTH, QUEUE_DEPTH_CURRENT, STAGE_SECONDS
+from ml_preprocessing import STRETCH
+from ml_versions import model_path_for_version
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = int(os.getenv('ML_BATCH_MAX_SIZE', '16'))
+MAX_WAIT_MS = float(os.getenv('ML_BATCH_MAX_WAIT_MS', '5'))
+MAX_QUEUE_SIZE = int(os.getenv('ML_BATCH_QUEUE_SIZE', '256'))
+REQUEST_TIMEOUT = float(os.getenv('ML_BATCH_TIMEOUT_SECONDS', '10'))
+
+QUEUE_WAIT_SECONDS = STAGE_SECONDS.labels('queue_wait')
+NEAR_DUPLICATE_SECONDS = STAGE_SECONDS.labels('near_duplicate')
+QUEUE_FULL = ERRORS.labels('queue_full')
+FORWARD_ERRORS = ERRORS.labels('forward')
+TIMEOUTS = ERRORS.labels('timeout')
+
+# Cache policy key for pre-resized pixels, which no resize policy applies to
+PIXELS = 'pixels'
+
+
+class _EngineStopped(RuntimeError):
+    pass
+
+
+class _Pending:
+    __slots__ = ('tensor', 'future', 'enqueued_at')
+
+    def __init__(self, tensor, future):
+        self.tensor = tensor
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchingEngine:
+    """
+    Groups concurrent single-image requests into batched forward passes.
+
+    Latency is bounded by max_wait_ms (time the oldest request may wait for
+    companions) plus one forward pass of at most max_batch_size images. The
+    queue is bounded too, so overload surfaces as QueueFullError instead of
+    unbounded tail latency.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._submit_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=2048)
+        self._batches = 0
+        self._items = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ml-batching', daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self, timeout=5.0):
+        """Stop accepting work, finish everything already queued and stop the thread."""
+        with self._submit_lock:
+            self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, tensor):
+        """
+        Queue one preprocessed image for inference.
+
+        Args:
+            tensor (torch.Tensor): Image tensor of shape (3, H, W) or (1, 3, H, W).
+        Returns:
+            concurrent.futures.Future: Resolves to the image's row of the outputs:
+            a 1-D tensor of class probabilities, or (features, probabilities)
+            for an embedding engine.
+        Raises:
+            QueueFullError: If the queue is at capacity.
+        """
+        if tensor.dim() == 4:
+            tensor = tensor.squeeze(0)
+        future = Future()
+        with self._submit_lock:
+            if self._stopping.is_set():
+                raise _EngineStopped("Batching engine is shut down")
+            try:
+                self._queue.put_nowait(_Pending(tensor, future))
+            except queue.Full:
+                QUEUE_FULL.inc()
+                raise QueueFullError("Inference queue is full, try again later")
+        return future
+
+    def _collect(self):
+        # Requests whose caller timed out were cancelled and take no slot in the batch
+        first = None
+        while first is None or first.future.cancelled():
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                return []
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    pending = self._queue.get(timeout=remaining)
+                else:
+                    pending = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if not pending.future.cancelled():
+                batch.append(pending)
+        depth = self._queue.qsize()
+        QUEUE_DEPTH.observe(depth)
+        QUEUE_DEPTH_CURRENT.set(depth)
+        return batch
+
+    def _run(self):
+        # Requests queued before shutdown() are still served
+        while not self._stopping.is_set() or not self._queue.empty():
+            batch = self._collect()
+            if not batch:
+                continue
+            # Cancelled since _collect took them; the rest can no longer be cancelled
+            batch = [p for p in batch if p.future.set_running_or_notify_cancel()]
+            # Only tensors of identical shape can share a forward pass
+            groups = {}
+            for pending in batch:
+                groups.setdefault(tuple(pending.tensor.shape), []).append(pending)
+            for group in groups.values():
+                self._process(group)
+
+    def _process(self, group):
+        started = time.perf_counter()
+        for pending in group:
+            QUEUE_WAIT_SECONDS.observe(started - pending.enqueued_at)
+        BATCH_SIZE.observe(len(group))
+        try:
+            outputs = self.predict_fn(torch.stack([p.tensor for p in group]))
+        except Exception as e:
+            FORWARD_ERRORS.inc(len(group))
+            logger.error(f"Batched inference failed for {len(group)} requests: {e}")
+            for pending in group:
+                pending.future.set_exception(e)
+            return
+        done = time.perf_counter()
+        for i, pending in enumerate(group):
+            pending.future.set_result(
+                tuple(output[i] for output in outputs) if isinstance(outputs, tuple) else outputs[i])
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(group)
+            self._latencies.extend(done - p.enqueued_at for p in group)
+
+    def stats(self):
+        """Batch counts and recent request latency percentiles in milliseconds."""
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            batches, items = self._batches, self._items
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+
+        return {
+            'batches': batches,
+            'items': items,
+            'mean_batch_size': round(items / batches, 2) if batches else 0,
+            'queue_depth': self._queue.qsize(),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+        }
+
+
+_engines = {}
+_engine_lock = threading.Lock()
+
+
+def get_engine(model_path=None, embed=False):
+    """
+    Return the process-wide engine for a model (default: the served one), starting it on first use.
+    With embed=True the engine runs ModelHandle.embed instead of predict.
+    """
+    key = (model_path or default_model_path(), embed)
+    engine = _engines.get(key)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(key)
+            if engine is None:
+                handle = get_model_handle(key[0])
+                engine = _engines[key] = BatchingEngine(handle.embed if embed else handle.predict).start()
+    return engine
+
+
+def _stop_engine(model_path):
+    # Registered with the ModelRegistry: an evicted model's engines drain and exit
+    with _engine_lock:
+        engines = [_engines.pop((model_path, embed), None) for embed in (False, True)]
+    for engine in engines:
+        if engine is not None:
+            engine.shutdown()
+
+
+registry.add_evict_listener(_stop_engine)
+
+
+def engine_stats(model_path=None, embed=False):
+    """Stats of a model's engine (or embedding engine), or None if no request has started it yet."""
+    engine = _engines.get((model_path or default_model_path(), embed))
+    return engine.stats() if engine is not None else None
+
+
+def predict_batched(input_tensor, timeout=REQUEST_TIMEOUT, model_path=None):
+    """
+    Classify one preprocessed image through the shared batching engine.
+
+    Args:
+        input_tensor (torch.Tensor): Output of ml_inference.preprocess_image.
+        timeout (float): Seconds to wait for the result.
+        model_path (str): Checkpoint to run, defaults to the served model.
+    Returns:
+        (label: str, confidence: float): Predicted label and confidence score.
+    Raises:
+        QueueFullError: If the engine is saturated.
+        RuntimeError: If model loading or the forward pass fails.
+    """
+    probs = _run_engine(input_tensor, timeout, model_path, embed=False)
+    confidence, pred_idx = torch.max(probs, dim=0)
+    return get_model_handle(model_path).labels.get(pred_idx.item(), "Unknown"), confidence.item()
+
+
+def embed_batched(input_tensor, timeout=REQUEST_TIMEOUT, model_path=None):
+    """
+    Embed and classify one preprocessed image through a shared embedding engine.
+
+    Returns:
+        (embedding: numpy.ndarray, label: str, confidence: float): As ml_inference.embed_image.
+    Raises:
+        QueueFullError: If the engine is saturated.
+        RuntimeError: If model loading fails or the model cannot expose embeddings.
+    """
+    features, probs = _run_engine(input_tensor, timeout, model_path, embed=True)
+    confidence, pred_idx = torch.max(probs, dim=0)
+    label = get_model_handle(model_path).labels.get(pred_idx.item(), "Unknown")
+    return features.numpy(), label, confidence.item()
+
+
+def _run_engine(input_tensor, timeout, model_path, embed):
+    try:
+        future = get_engine(model_path, embed).submit(input_tensor)
+    except _EngineStopped:
+        # The model was evicted between looking up its engine and submitting
+        future = get_engine(model_path, embed).submit(input_tensor)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        TIMEOUTS.inc()
+        # Still queued: the batcher skips it instead of spending a slot on an unread result
+        future.cancel()
+        raise
+
+
+def predict_image_bytes(image_bytes, policy=STRETCH, timeout=REQUEST_TIMEOUT, model_version=None):
+    """
+    Classify an uploaded image, answering repeats from the prediction cache
+    and batching the rest with concurrent requests. With ML_CASCADE_ENABLED
+    the stretch policy goes through the confidence-gated cascade unless a
+    model version is pinned.
+
+    Args:
+        image_bytes (bytes): Raw image file contents.
+        policy (str): ml_preprocessing resize policy.
+        timeout (float): Seconds to wait for the forward pass.
+        model_version (str): Published version to use instead of the active one.
+    Returns:
+        (label: str, confidence: float, cached: bool, model_version: str)
+    Raises:
+        ValueError: If the image cannot be read.
+        UnknownVersionError: If model_version was never published.
+        QueueFullError: If the engine is saturated.
+        RuntimeError: If model loading or the forward pass fails.
+    """
+    # Resolved once, so a hot-swap mid-request cannot mix versions
+    model_path = model_path_for_version(model_version) or default_model_path()
+    handle = get_model_handle(model_path)
+    cascade = get_cascade() if policy == STRETCH and not model_version else None
+    run_model = _model_runner(image_bytes, policy, timeout, model_path, handle, cascade)
+    version = cascade.version if cascade is not None else handle.version
+    cache = get_cache()
+    if cache is None:
+        label, confidence = run_model()
+        cached = False
+    else:
+        label, confidence, cached = cache.lookup_or_predict(image_bytes, version, policy, run_model)
+    PREDICTIONS.labels('cache' if cached else 'model').inc()
+    return label, confidence, cached, version
+
+
+def _model_runner(image_bytes, policy, timeout, model_path, handle, cascade):
+    """Zero-argument function classifying image_bytes through the cascade or the batching engine."""
+    def run_model():
+        if cascade is not None:
+            label, confidence, _ = cascade.classify(
+                io.BytesIO(image_bytes), lambda tensor, path: predict_batched(tensor, timeout, path or model_path))
+            return label, confidence
+        input_tensor = handle.preprocessor(policy).preprocess(io.BytesIO(image_bytes))
+        return predict_batched(input_tensor, timeout, model_path)
+    return run_model
+
+
+def classify_image_bytes(image_bytes, policy=STRETCH, timeout=REQUEST_TIMEOUT, model_version=None,
+                         near_duplicate=True):
+    """
+    Classify an upload the way complete_scan does: prediction cache first, then
+    the near-duplicate lookup in the embedding index, then the model.
+
+    When the embedding model is the served model (an eager or int8 checkpoint
+    served without the cascade), one batched forward pass yields both the
+    embedding for the lookup and the prediction. Otherwise the embedding model
+    runs through its own engine and the served model only on a lookup miss.
+
+    Args:
+        image_bytes (bytes): Raw image file contents.
+        policy (str): ml_preprocessing resize policy.
+        timeout (float): Seconds to wait for each forward pass.
+        model_version (str): Published version to use instead of the active
+            one; pinned versions skip the near-duplicate lookup.
+        near_duplicate (bool): Answer from the embedding index when an earlier
+            scan is a near-duplicate.
+    Returns:
+        dict: label, confidence, cached, model_version, near_duplicate_of,
+        similarity and embedding (numpy.ndarray to pass to
+        ml_embeddings.record_scan once the scan has an id, or None).
+    Raises:
+        ValueError: If the image cannot be read.
+        UnknownVersionError: If model_version was never published.
+        QueueFullError: If an engine is saturated.
+        RuntimeError: If model loading or the forward pass fails.
+    """
+    from ml_embeddings import EMBEDDING_INDEX_ENABLED, embedding_model_path, match_embedding
+
+    if model_version or not near_duplicate or not EMBEDDING_INDEX_ENABLED:
+        label, confidence, cached, version = predict_image_bytes(image_bytes, policy, timeout, model_version)
+        return _classified(label, confidence, cached, version)
+
+    model_path = default_model_path()
+    handle = get_model_handle(model_path)
+    cascade = get_cascade() if policy == STRETCH else None
+    version = cascade.version if cascade is not None else handle.version
+    cache = get_cache()
+    key = cache_key(image_bytes, version, policy)
+    if cache is not None:
+        hit = cache.get(key)
+        if hit is not None:
+            PREDICTIONS.labels('cache').inc()
+            return _classified(hit[0], hit[1], True, version)
+
+    prediction, embedding, match = None, None, None
+    embedding_path = embedding_model_path()
+    if cascade is None and policy == STRETCH and embedding_path == model_path:
+        embedding, label, confidence = embed_batched(
+            handle.preprocessor(STRETCH).preprocess(io.BytesIO(image_bytes)), timeout, model_path)
+        prediction = (label, confidence)
+    try:
+        with NEAR_DUPLICATE_SECONDS.time():
+            if embedding is None:
+                embedding_handle = get_model_handle(embedding_path)
+                embedding, _, _ = embed_batched(
+                    embedding_handle.preprocessor(STRETCH).preprocess(io.BytesIO(image_bytes)), timeout,
+                    embedding_path)
+            match = match_embedding(embedding, version, model_path=embedding_path)
+    except RuntimeError as e:
+        logger.warning(f"Near-duplicate lookup unavailable: {e}")
+
+    if match is not None:
+        PREDICTIONS.labels('near_duplicate').inc()
+        return {
+            'label': match['label'],
+            'confidence': match['confidence'],
+            'cached': True,
+            'model_version': match['model_version'],
+            'near_duplicate_of': match['scan_id'],
+            'similarity': match['similarity'],
+            'embedding': None,
+        }
+    if prediction is None:
+        prediction = _model_runner(image_bytes, policy, timeout, model_path, handle, cascade)()
+    label, confidence = prediction
+    if cache is not None:
+        cache.put(key, version, label, confidence)
+    PREDICTIONS.labels('model').inc()
+    return {**_classified(label, confidence, False, version), 'embedding': embedding}
+
+
+def _classified(label, confidence, cached, version):
+    return {
+        'label': label,
+        'confidence': confidence,
+        'cached': cached,
+        'model_version': version,
+        'near_duplicate_of': None,
+        'similarity': None,
+        'embedding': None,
+    }
+
+
+def predict_pixels(pixels, width, height, timeout=REQUEST_TIMEOUT, model_version=None):
+    """
+    Classify an image the client already decoded and resized to the model's
+    input size, skipping decode and resize. Goes through the prediction cache
+    (keyed on the pixels) and the batching engine, never the cascade.
+
+    Args:
+        pixels (bytes): width * height * 3 bytes of RGB, row-major.
+        width, height (int): Must both equal the model's input_size.
+        timeout (float): Seconds to wait for the forward pass.
+        model_version (str): Published version to use instead of the active one.
+    Returns:
+        (label: str, confidence: float, cached: bool, model_version: str)
+    Raises:
+        ValueError: If the pixels do not match the model's input size.
+        UnknownVersionError: If model_version was never published.
+        QueueFullError: If the engine is saturated.
+        RuntimeError: If model loading or the forward pass fails.
+    """
+    model_path = model_path_for_version(model_version) or default_model_path()
+    handle = get_model_handle(model_path)
+    if width != handle.input_size or height != handle.input_size or len(pixels) != width * height * 3:
+        raise ValueError(
+            f"Expected {handle.input_size}x{handle.input_size} RGB pixels, got {width}x{height} "
+            f"({len(pixels)} bytes)")
+
+    def run_model():
+        image = Image.frombytes('RGB', (width, height), pixels)
+        return predict_batched(handle.preprocessor(STRETCH).from_decoded(image), timeout, model_path)
+
+    cache = get_cache()
+    if cache is None:
+        label, confidence = run_model()
+        cached = False
+    else:
+        label, confidence, cached = cache.lookup_or_predict(pixels, handle.version, PIXELS, run_model)
+    PREDICTIONS.labels('cache' if cached else 'model').inc()
+    return label, confidence, cached, handle.version
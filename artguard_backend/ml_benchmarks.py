@@ -0,0 +1,699 @@
+"""
+Benchmarks for the inference pipeline.
+
+Synthetic artworks are generated deterministically so runs on different
+machines (or before/after a change) measure the same inputs.
+"""
+
+import multiprocessing
+import os
+import random
+import re
+import resource
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from queue import Empty
+
+from PIL import Image
+
+from ml_inference import INPUT_SIZE, WARMUP_RUNS, decode_image, load_model
+
+# (width, height) per bucket, roughly the megapixel counts users upload
+SIZE_BUCKETS = {
+    '0.3mp': (640, 480),
+    '2mp': (1920, 1080),
+    '12mp': (4000, 3000),
+    '24mp': (6000, 4000),
+}
+
+
+def synthetic_image(width, height, seed=0):
+    """Smooth random colour field upscaled from a small noise image, so it compresses like a photo."""
+    rng = random.Random(seed)
+    small = Image.frombytes('RGB', (32, 24), rng.randbytes(32 * 24 * 3))
+    return small.resize((width, height), Image.BICUBIC)
+
+
+def write_synthetic_image(path, width, height, fmt='JPEG', seed=0):
+    image = synthetic_image(width, height, seed)
+    if fmt == 'GIF':
+        image = image.convert('P', palette=Image.ADAPTIVE)
+    options = {'quality': 90} if fmt in ('JPEG', 'WEBP') else {}
+    image.save(path, fmt, **options)
+    return path
+
+
+def bucket_for(width, height):
+    """Smallest bucket whose pixel count covers the image."""
+    pixels = width * height
+    for name, (w, h) in sorted(SIZE_BUCKETS.items(), key=lambda item: item[1][0] * item[1][1]):
+        if pixels <= w * h:
+            return name
+    return max(SIZE_BUCKETS, key=lambda name: SIZE_BUCKETS[name][0] * SIZE_BUCKETS[name][1])
+
+
+def percentiles(seconds):
+    """p50/p95/p99 in milliseconds for a list of durations."""
+    ordered = sorted(seconds)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+def _proc_status_bytes(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"{field} not found in /proc/self/status")
+
+
+def _peak_rss_worker(fn, args, queue, model_path=None):
+    if model_path is not None:
+        # Loaded and warmed up first, so only the call itself is measured
+        from ml_inference import get_model_handle
+        get_model_handle(model_path)
+    try:
+        # Reset the high-water mark so import-time peaks do not mask the call
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = _proc_status_bytes('VmRSS')
+    except OSError:
+        before = None
+    if before is not None:
+        fn(*args)
+        queue.put(max(_proc_status_bytes('VmHWM') - before, 0))
+    else:
+        # ru_maxrss is in KiB on Linux and cannot be reset
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put(max(after - before, 0) * 1024)
+
+
+def peak_rss_growth(fn, *args, model_path=None):
+    """
+    Peak resident memory added by one call, measured in a fresh process so
+    earlier allocations in this process do not hide it. fn must be importable.
+    With model_path, that model is loaded before the measurement starts.
+
+    Raises:
+        RuntimeError: If the measuring process exits without a result, e.g.
+            because fn raised.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_peak_rss_worker, args=(fn, args, queue, model_path))
+    process.start()
+    try:
+        while True:
+            try:
+                return queue.get(timeout=1.0)
+            except Empty:
+                if process.exitcode is not None:
+                    break
+        # The result may have been flushed just before the exit was noticed
+        try:
+            return queue.get(timeout=1.0)
+        except Empty:
+            raise RuntimeError(
+                f"Measuring {getattr(fn, '__name__', fn)} failed: its process exited with code {process.exitcode}")
+    finally:
+        process.join()
+
+
+def benchmark_decode(paths, repeats=5, size=(INPUT_SIZE, INPUT_SIZE)):
+    """
+    Compare full-resolution and reduced-resolution decoding, grouped by size bucket.
+
+    Returns:
+        dict: bucket -> {'images', 'full': {...}, 'fast': {...}, 'speedup'}
+    """
+    buckets = {}
+    for path in paths:
+        with Image.open(path) as image:
+            buckets.setdefault(bucket_for(*image.size), []).append(path)
+
+    results = {}
+    for bucket in [name for name in SIZE_BUCKETS if name in buckets]:
+        bucket_paths = buckets[bucket]
+        results[bucket] = {'images': len(bucket_paths)}
+        for mode, fast in (('full', False), ('fast', True)):
+            timings = []
+            for path in bucket_paths:
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    decode_image(path, size, fast)
+                    timings.append(time.perf_counter() - start)
+            results[bucket][mode] = {
+                **percentiles(timings),
+                'mean_ms': round(statistics.mean(timings) * 1000, 3),
+                'peak_rss_bytes': peak_rss_growth(decode_image, bucket_paths[0], size, fast),
+            }
+        results[bucket]['speedup'] = round(
+            results[bucket]['full']['mean_ms'] / results[bucket]['fast']['mean_ms'], 2)
+    return results
+
+
+def generate_bucket_images(directory, fmt='JPEG', per_bucket=1):
+    """Write per_bucket synthetic images for every size bucket and return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    extension = {'JPEG': 'jpg'}.get(fmt, fmt.lower())
+    for bucket, (width, height) in SIZE_BUCKETS.items():
+        for seed in range(per_bucket):
+            path = os.path.join(directory, f"{bucket}_{seed}.{extension}")
+            paths.append(write_synthetic_image(path, width, height, fmt, seed))
+    return paths
+
+
+def _thread_plan_worker(model_path, plan, duration, barrier, queue):
+    import torch
+    from ml_threads import apply_plan
+    apply_plan(plan)
+    model = load_model(model_path)
+    batch = torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE)
+    with torch.no_grad():
+        for _ in range(WARMUP_RUNS):
+            model(batch)
+        # Every worker starts hammering at the same moment, like a server under load
+        barrier.wait()
+        latencies = []
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            model(batch)
+            latencies.append(time.perf_counter() - start)
+    queue.put(latencies)
+
+
+def benchmark_thread_plans(model_path, plans, duration=10.0):
+    """
+    Saturate the CPUs with one closed-loop client per worker process under
+    each thread plan and compare throughput and latency.
+
+    Args:
+        model_path (str): Checkpoint every worker loads.
+        plans (list): (label, [ThreadPlan per worker]) pairs.
+        duration (float): Seconds each plan is measured for.
+    Returns:
+        list: One dict per plan with images_per_second and p50/p95/p99.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for label, worker_plans in plans:
+        barrier = ctx.Barrier(len(worker_plans))
+        queue = ctx.Queue()
+        processes = [
+            ctx.Process(target=_thread_plan_worker, args=(model_path, plan, duration, barrier, queue))
+            for plan in worker_plans
+        ]
+        for process in processes:
+            process.start()
+        latencies = []
+        for _ in processes:
+            while True:
+                try:
+                    latencies.extend(queue.get(timeout=1.0))
+                    break
+                except Empty:
+                    if any(process.exitcode not in (None, 0) for process in processes):
+                        for process in processes:
+                            process.terminate()
+                        raise RuntimeError(f"A worker for thread plan '{label}' exited early")
+        for process in processes:
+            process.join()
+        results.append({
+            'plan': label,
+            'workers': len(worker_plans),
+            'intra_op_threads': worker_plans[0].intra_op,
+            'pinned': worker_plans[0].cores is not None,
+            'requests': len(latencies),
+            'images_per_second': round(len(latencies) / duration, 2),
+            **percentiles(latencies),
+        })
+    return results
+
+
+# How each strategy gets the weights into its workers
+MEMORY_STRATEGIES = ('private', 'mmap', 'preload')
+
+
+def process_memory(pid):
+    """RSS, PSS and USS (private clean + dirty) of a process in bytes, from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {
+        'rss_bytes': fields['Rss'],
+        'pss_bytes': fields['Pss'],
+        'uss_bytes': fields['Private_Clean'] + fields['Private_Dirty'],
+    }
+
+
+def _serve_until_released(model, ready, release):
+    import torch
+    with torch.no_grad():
+        for _ in range(WARMUP_RUNS):
+            model(torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE))
+    ready.put(os.getpid())
+    release.wait()
+
+
+def _memory_worker(model_path, mmap, ready, release):
+    _serve_until_released(load_model(model_path, mmap=mmap), ready, release)
+
+
+def _preloading_master(model_path, workers, ready, release):
+    # Load once, then fork the workers so they inherit the weight pages copy-on-write
+    model = load_model(model_path, mmap=False)
+    ctx = multiprocessing.get_context('fork')
+    children = [ctx.Process(target=_serve_until_released, args=(model, ready, release)) for _ in range(workers)]
+    for child in children:
+        child.start()
+    for child in children:
+        child.join()
+
+
+def worker_memory(model_path, workers=4, strategy='mmap'):
+    """
+    Start `workers` processes holding the model the way `strategy` loads it and
+    report their memory once all of them have run a forward pass.
+
+    private  every worker torch.loads its own copy of the weights
+    mmap     every worker maps the checkpoint (ML_MMAP_WEIGHTS), sharing the page cache
+    preload  a master loads the model and forks the workers (gunicorn --preload)
+
+    Returns:
+        dict: Per-worker RSS/PSS/USS plus their means and the total PSS, i.e.
+        what the workers really cost the node together.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Queue()
+    release = ctx.Event()
+    if strategy == 'preload':
+        processes = [ctx.Process(target=_preloading_master, args=(model_path, workers, ready, release))]
+    elif strategy in MEMORY_STRATEGIES:
+        processes = [
+            ctx.Process(target=_memory_worker, args=(model_path, strategy == 'mmap', ready, release))
+            for _ in range(workers)
+        ]
+    else:
+        raise ValueError(f"Unknown strategy '{strategy}', expected one of {MEMORY_STRATEGIES}")
+    for process in processes:
+        process.start()
+    try:
+        pids = []
+        while len(pids) < workers:
+            try:
+                pids.append(ready.get(timeout=1.0))
+            except Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError(f"A worker for strategy '{strategy}' exited early")
+        per_worker = [process_memory(pid) for pid in pids]
+    finally:
+        release.set()
+        for process in processes:
+            process.join()
+
+    def mean(field):
+        return int(statistics.mean(worker[field] for worker in per_worker))
+
+    return {
+        'strategy': strategy,
+        'workers': workers,
+        'per_worker': per_worker,
+        'mean_rss_bytes': mean('rss_bytes'),
+        'mean_pss_bytes': mean('pss_bytes'),
+        'mean_uss_bytes': mean('uss_bytes'),
+        'total_pss_bytes': sum(worker['pss_bytes'] for worker in per_worker),
+    }
+
+
+# Bumped whenever the layout of benchmark_pipeline's results changes
+PIPELINE_SCHEMA = 1
+PIPELINE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+PIPELINE_STAGES = ('decode', 'preprocess', 'forward', 'end_to_end')
+THROUGHPUT_BATCH_SIZES = (1, 2, 4, 8, 16, 32)
+
+
+@contextmanager
+def _prediction_cache_disabled():
+    # Repeated predictions of the same file would otherwise measure cache hits
+    import ml_cache
+    enabled = ml_cache.CACHE_ENABLED
+    ml_cache.CACHE_ENABLED = False
+    try:
+        yield
+    finally:
+        ml_cache.CACHE_ENABLED = enabled
+
+
+def _uncached_prediction(path, model_path):
+    from ml_inference import predict_artwork_type
+    with _prediction_cache_disabled():
+        return predict_artwork_type(path, model_path)
+
+
+def _stage_summary(seconds):
+    return {**percentiles(seconds), 'mean_ms': round(statistics.mean(seconds) * 1000, 3)}
+
+
+def _environment(handle):
+    import platform
+    import torch
+    from ml_threads import available_cpus, current_plan
+    plan = current_plan()
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'machine': platform.machine(),
+        'available_cpus': available_cpus(),
+        'threads': plan.describe() if plan else None,
+        'model': handle.name,
+        'model_version': handle.version,
+        'backend': handle.backend.name,
+    }
+
+
+def throughput_curve(model_path, paths, batch_sizes=THROUGHPUT_BATCH_SIZES, rounds=3):
+    """
+    Images per second at each batch size, for the forward pass alone and for
+    the full predict_artwork_types pipeline (decode threads overlapping the model).
+
+    Args:
+        paths (list): Images the pipeline classifies; forward passes use random inputs.
+        rounds (int): Pipeline passes over paths and minimum timed forward passes per batch size.
+    Returns:
+        list: One dict per batch size.
+    """
+    import torch
+    from ml_inference import get_model_handle, predict_artwork_types
+    handle = get_model_handle(model_path)
+    generator = torch.Generator().manual_seed(0)
+    curve = []
+    for batch_size in batch_sizes:
+        batch = torch.randn(batch_size, 3, handle.input_size, handle.input_size, generator=generator)
+        handle.predict(batch)
+        timings = []
+        for _ in range(max(rounds, 32 // batch_size)):
+            start = time.perf_counter()
+            handle.predict(batch)
+            timings.append(time.perf_counter() - start)
+        # At least two full batches, so decoding can overlap a forward pass
+        count = max(len(paths) * rounds, 2 * batch_size)
+        pipeline_images = [paths[i % len(paths)] for i in range(count)]
+        start = time.perf_counter()
+        for _ in predict_artwork_types(pipeline_images, batch_size, model_path=model_path):
+            pass
+        pipeline_seconds = time.perf_counter() - start
+        curve.append({
+            'batch_size': batch_size,
+            'forward_images_per_second': round(batch_size * len(timings) / sum(timings), 2),
+            'forward_batch_p50_ms': percentiles(timings)['p50_ms'],
+            'pipeline_images_per_second': round(len(pipeline_images) / pipeline_seconds, 2),
+        })
+    return curve
+
+
+def benchmark_pipeline(model_path=None, formats=PIPELINE_FORMATS, buckets=None, repeats=10,
+                       batch_sizes=THROUGHPUT_BATCH_SIZES, directory=None):
+    """
+    Latency per pipeline stage for every format and size bucket, batch-size
+    throughput and peak memory, on deterministic synthetic artworks.
+
+    Stages are timed separately for each image: decode (decode_image at the
+    decoder's reduced size), preprocess (resize and normalize), forward (one
+    image through the model) and end_to_end (predict_artwork_type with the
+    prediction cache bypassed).
+
+    Args:
+        model_path (str): Checkpoint to measure, defaults to the serving model.
+        formats (tuple): PIL format names of the synthetic images.
+        buckets (list): SIZE_BUCKETS names, defaults to all of them.
+        repeats (int): Timed runs per image and stage, after one untimed run.
+        batch_sizes (tuple): Batch sizes for the throughput curve.
+        directory (str): Where the images are written, defaults to a temporary directory.
+    Returns:
+        dict: JSON-serializable results, see compare_benchmarks.
+    """
+    import tempfile
+    from ml_inference import default_model_path, get_model_handle
+    from ml_preprocessing import STRETCH
+
+    model_path = model_path or default_model_path()
+    buckets = list(buckets or SIZE_BUCKETS)
+    unknown = set(buckets) - set(SIZE_BUCKETS)
+    if unknown:
+        raise ValueError(f"Unknown size buckets {sorted(unknown)}, expected some of {list(SIZE_BUCKETS)}")
+    handle = get_model_handle(model_path)
+    preprocessor = handle.preprocessor(STRETCH)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = directory or tmp
+        latency = {}
+        stage_seconds = {stage: [] for stage in PIPELINE_STAGES}
+        written = {}
+        for fmt in formats:
+            extension = {'JPEG': 'jpg'}.get(fmt, fmt.lower())
+            for bucket in buckets:
+                width, height = SIZE_BUCKETS[bucket]
+                path = write_synthetic_image(os.path.join(directory, f"{bucket}.{extension}"), width, height, fmt)
+                written.setdefault(fmt, {})[bucket] = path
+                timings = {stage: [] for stage in PIPELINE_STAGES}
+                for run in range(repeats + 1):
+                    start = time.perf_counter()
+                    image = decode_image(path, preprocessor.decode_size)
+                    decoded = time.perf_counter()
+                    tensor = preprocessor.from_decoded(image)
+                    preprocessed = time.perf_counter()
+                    handle.predict(tensor)
+                    forwarded = time.perf_counter()
+                    _uncached_prediction(path, model_path)
+                    done = time.perf_counter()
+                    # The first run pays for lazy allocations and is not counted
+                    if run:
+                        timings['decode'].append(decoded - start)
+                        timings['preprocess'].append(preprocessed - decoded)
+                        timings['forward'].append(forwarded - preprocessed)
+                        timings['end_to_end'].append(done - forwarded)
+                latency[f"{fmt}/{bucket}"] = {stage: _stage_summary(timings[stage]) for stage in PIPELINE_STAGES}
+                for stage in PIPELINE_STAGES:
+                    stage_seconds[stage].extend(timings[stage])
+
+        def pixels(bucket):
+            return SIZE_BUCKETS[bucket][0] * SIZE_BUCKETS[bucket][1]
+
+        smallest, largest = min(buckets, key=pixels), max(buckets, key=pixels)
+        curve = throughput_curve(model_path, [paths[smallest] for paths in written.values()], batch_sizes)
+        memory = {
+            'model_weight_bytes': handle.weight_bytes,
+            'process_peak_rss_bytes': _proc_status_bytes('VmHWM'),
+            # Peak added by one end-to-end prediction of the largest image, model already loaded
+            'request_peak_rss_bytes': {
+                fmt: peak_rss_growth(_uncached_prediction, paths[largest], model_path, model_path=model_path)
+                for fmt, paths in written.items()
+            },
+        }
+
+    return {
+        'schema': PIPELINE_SCHEMA,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'environment': _environment(handle),
+        'repeats': repeats,
+        'stages': {stage: _stage_summary(stage_seconds[stage]) for stage in PIPELINE_STAGES},
+        'latency': latency,
+        'throughput': curve,
+        'memory': memory,
+    }
+
+
+# Largest tolerated relative change for the worse, per metric category ('default' for the rest)
+DEFAULT_BUDGETS = {'default': 0.10}
+COMPARED_PERCENTILES = ('p50_ms', 'p95_ms')
+
+
+def _benchmark_metrics(results):
+    """(name, category, value, higher_is_worse) for every metric budgets apply to."""
+    metrics = []
+    for stage, summary in results.get('stages', {}).items():
+        for key in COMPARED_PERCENTILES:
+            metrics.append((f"stages.{stage}.{key}", stage, summary[key], True))
+    for case, stages in results.get('latency', {}).items():
+        for stage, summary in stages.items():
+            for key in COMPARED_PERCENTILES:
+                metrics.append((f"latency.{case}.{stage}.{key}", stage, summary[key], True))
+    for point in results.get('throughput', []):
+        for key in ('forward_images_per_second', 'pipeline_images_per_second'):
+            metrics.append((f"throughput.batch{point['batch_size']}.{key}", 'throughput', point[key], False))
+    memory = results.get('memory', {})
+    for key in ('model_weight_bytes', 'process_peak_rss_bytes'):
+        if key in memory:
+            metrics.append((f"memory.{key}", 'memory', memory[key], True))
+    for fmt, value in memory.get('request_peak_rss_bytes', {}).items():
+        metrics.append((f"memory.request_peak_rss_bytes.{fmt}", 'memory', value, True))
+    return metrics
+
+
+def compare_benchmarks(baseline, current, budgets=None, min_delta_ms=0.5):
+    """
+    Compare two benchmark_pipeline results metric by metric.
+
+    Args:
+        baseline, current (dict): Results of benchmark_pipeline (e.g. loaded from JSON).
+        budgets (dict): Allowed relative regression per category: a stage name,
+            'throughput', 'memory' or 'default', e.g. {'default': 0.1, 'decode': 0.2}.
+        min_delta_ms (float): Latency changes smaller than this never count as
+            regressions, so sub-millisecond jitter does not fail a run.
+    Returns:
+        list: One dict per metric present in both runs with baseline, current,
+        change (relative, positive is worse), budget and regressed.
+    Raises:
+        ValueError: If the results were written with different schemas.
+    """
+    if baseline.get('schema') != current.get('schema'):
+        raise ValueError(f"Cannot compare schema {baseline.get('schema')} results with schema {current.get('schema')}")
+    budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+    previous = {name: value for name, _, value, _ in _benchmark_metrics(baseline)}
+    rows = []
+    for name, category, value, higher_is_worse in _benchmark_metrics(current):
+        if name not in previous or not previous[name]:
+            continue
+        before = previous[name]
+        change = (value - before) / before if higher_is_worse else (before - value) / before
+        budget = budgets.get(category, budgets['default'])
+        regressed = change > budget
+        if regressed and name.endswith('_ms') and abs(value - before) < min_delta_ms:
+            regressed = False
+        rows.append({
+            'metric': name,
+            'baseline': before,
+            'current': value,
+            'change': round(change, 4),
+            'budget': budget,
+            'regressed': regressed,
+        })
+    return rows
+
+
+# Interpreter startup. Each run is a fresh process under `python -X importtime`,
+# so module caches of this process do not hide the real cost.
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# What a web worker does before its first request: configure Django and load the URLconf (and with it every view)
+WORKER_BOOT = (
+    "import os, django;"
+    "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'artguard_backend.settings');"
+    "django.setup();"
+    "from django.urls import get_resolver;"
+    "get_resolver().url_patterns"
+)
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+
+def parse_importtime(output):
+    """
+    Parse the stderr of `python -X importtime`.
+
+    Returns:
+        list: One dict per import in the order printed (children before their
+        parent) with module, depth, self_us, cumulative_us and parent (the
+        module that imported it, None at the top level).
+    """
+    rows = []
+    for line in output.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append({'module': module, 'depth': len(indent) // 2, 'self_us': int(self_us),
+                         'cumulative_us': int(cumulative_us), 'parent': None})
+    # A child's parent is the next line one level up
+    next_at_depth = {}
+    for row in reversed(rows):
+        parent = next_at_depth.get(row['depth'] - 1)
+        row['parent'] = parent['module'] if parent is not None else None
+        next_at_depth[row['depth']] = row
+    return rows
+
+
+def _import_chain(rows, index):
+    chain = [rows[index]['module']]
+    depth = rows[index]['depth']
+    for row in rows[index + 1:]:
+        if row['depth'] < depth:
+            chain.append(row['module'])
+            depth = row['depth']
+    return chain
+
+
+def profile_startup(argv=None, runs=3, top=20):
+    """
+    Time interpreter startup and break it down by import.
+
+    Args:
+        argv (list): Command to profile, run from the backend directory
+            (default: a worker boot, see WORKER_BOOT), e.g. ['manage.py', 'check'].
+        runs (int): Fresh processes to time; the median run is reported.
+        top (int): Entries to keep in the slowest-imports and packages lists.
+    Returns:
+        dict: seconds (median wall time per run), import_seconds, module
+        count, slowest (modules by cumulative time with the chain that
+        imported them) and packages (top-level packages by own import time).
+    Raises:
+        RuntimeError: If the profiled command fails.
+    """
+    import subprocess
+    import sys
+
+    argv = argv or ['-c', WORKER_BOOT]
+    samples = []
+    for _ in range(max(1, runs)):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', *argv], cwd=BACKEND_DIR,
+                                 capture_output=True, text=True)
+        seconds = time.perf_counter() - start
+        if process.returncode != 0:
+            tail = '\n'.join(line for line in process.stderr.splitlines()
+                             if not line.startswith('import time:'))[-2000:]
+            raise RuntimeError(f"{' '.join(argv)} exited with {process.returncode}: {tail}")
+        samples.append((seconds, parse_importtime(process.stderr)))
+    samples.sort(key=lambda sample: sample[0])
+    seconds, rows = samples[len(samples) // 2]
+
+    packages = {}
+    for index, row in enumerate(rows):
+        name = row['module'].split('.')[0]
+        package = packages.get(name)
+        if package is None:
+            # The first import of a package is the one that pulled it in
+            chain = [module for module in _import_chain(rows, index) if module.split('.')[0] != name]
+            package = packages[name] = {'package': name, 'self_ms': 0.0, 'modules': 0, 'imported_by': chain}
+        package['self_ms'] += row['self_us'] / 1000
+        package['modules'] += 1
+    for package in packages.values():
+        package['self_ms'] = round(package['self_ms'], 2)
+
+    slowest = sorted(range(len(rows)), key=lambda i: rows[i]['cumulative_us'], reverse=True)[:top]
+    return {
+        'command': ' '.join(argv) if argv[0] != '-c' else 'worker boot',
+        'runs': len(samples),
+        'seconds': round(seconds, 4),
+        'seconds_min': round(samples[0][0], 4),
+        'import_seconds': round(sum(row['cumulative_us'] for row in rows if row['depth'] == 0) / 1e6, 4),
+        'modules': len(rows),
+        'slowest': [{
+            'module': rows[i]['module'],
+            'cumulative_ms': round(rows[i]['cumulative_us'] / 1000, 2),
+            'self_ms': round(rows[i]['self_us'] / 1000, 2),
+            'imported_by': _import_chain(rows, i)[1:],
+        } for i in slowest],
+        'packages': sorted(packages.values(), key=lambda package: package['self_ms'], reverse=True)[:top],
+        'imported': sorted(packages),
+    }
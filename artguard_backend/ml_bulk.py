@@ -0,0 +1,196 @@
+"""
+Offline bulk classification of archived artworks.
+
+Inputs are split into chunks that a pool of worker processes classify with
+ml_inference.predict_artwork_types. Each worker gets an even share of the
+CPUs (see ml_threads) as torch intra-op threads, so the pool uses every core
+without oversubscribing. Results come back in input order and are appended to
+a JSONL or CSV file; after every chunk a small JSON checkpoint records how
+many inputs are done and how long the output file was at that point, so an
+interrupted run resumes exactly where it stopped.
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from ml_inference import IMAGE_EXTENSIONS, find_images
+from ml_threads import available_cpus, configure_threads, plan_threads
+
+OUTPUT_FIELDS = ('path', 'label', 'confidence', 'error')
+TIMING_STAGES = ('decode_seconds', 'decode_wait_seconds', 'forward_seconds')
+
+
+def read_manifest(path):
+    """
+    Image paths listed one per line; blank lines and '#' comments are skipped
+    and relative paths are resolved against the manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    paths = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(os.path.normpath(os.path.join(base, line)))
+    return paths
+
+
+def collect_inputs(source):
+    """All images below a directory, or the paths listed in a manifest file."""
+    if os.path.isdir(source):
+        return find_images(source)
+    if source.lower().endswith(IMAGE_EXTENSIONS):
+        return [source]
+    return read_manifest(source)
+
+
+class ResultWriter:
+    """Appends results as JSONL or CSV, truncating to a checkpointed offset first."""
+
+    def __init__(self, path, fmt, offset=0):
+        self.path = path
+        self.fmt = fmt
+        self._file = open(path, 'a+', newline='')
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        self._csv = csv.DictWriter(self._file, fieldnames=OUTPUT_FIELDS) if fmt == 'csv' else None
+        if self._csv is not None and offset == 0:
+            self._csv.writeheader()
+
+    def write(self, result):
+        row = {field: result.get(field) for field in OUTPUT_FIELDS}
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(row) + '\n')
+
+    def sync(self):
+        """Flush to disk and return the file length to record in the checkpoint."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+def load_checkpoint(path, total, output):
+    """
+    Resume state from a checkpoint file, or a fresh state if there is none.
+
+    Raises:
+        ValueError: If the checkpoint belongs to a different input list or output file.
+    """
+    if not os.path.exists(path):
+        return {'total': total, 'output': os.path.abspath(output), 'done': 0, 'offset': 0}
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('total') != total or state.get('output') != os.path.abspath(output):
+        raise ValueError(
+            f"Checkpoint {path} was written for {state.get('total')} inputs into {state.get('output')}; "
+            f"remove it to start over")
+    return state
+
+
+def save_checkpoint(path, state):
+    # Written to a temporary file and renamed so a crash never leaves it half written
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+_worker_model_path = None
+
+
+def _init_worker(workers, threads, model_path):
+    global _worker_model_path
+    configure_threads(plan_threads(workers, intra_op=threads))
+    _worker_model_path = model_path
+
+
+def _classify_chunk(args):
+    from ml_inference import predict_artwork_types
+
+    paths, batch_size = args
+    timings = {}
+    results = []
+    # One decode thread: the other cores belong to the other workers
+    for result in predict_artwork_types(paths, batch_size, workers=1, model_path=_worker_model_path,
+                                        timings=timings):
+        result['path'] = result.pop('input')
+        results.append(result)
+    return results, timings
+
+
+def classify_files(paths, output, fmt='jsonl', checkpoint=None, workers=None, batch_size=16,
+                   chunk_size=256, model_path=None, progress=None):
+    """
+    Classify paths into an output file, resuming from checkpoint if it exists.
+
+    Args:
+        paths (list): Image paths, in the order results should be written.
+        output (str): JSONL or CSV file results are appended to.
+        fmt (str): 'jsonl' or 'csv'.
+        checkpoint (str): Progress file, defaults to output + '.checkpoint'.
+        workers (int): Worker processes, defaults to one per available CPU.
+        batch_size (int): Images per forward pass.
+        chunk_size (int): Images per task handed to a worker; progress is
+            checkpointed after each chunk.
+        model_path (str): Checkpoint to classify with, defaults to the serving model.
+        progress (callable): Called with (done, total) after every chunk.
+    Returns:
+        dict: Counts, wall time, throughput and per-stage seconds for this run.
+    Raises:
+        ValueError: If the checkpoint does not match this run.
+    """
+    checkpoint = checkpoint or output + '.checkpoint'
+    state = load_checkpoint(checkpoint, len(paths), output)
+    cpus = available_cpus()
+    workers = max(1, min(workers or cpus, cpus))
+    threads = max(1, cpus // workers)
+    remaining = paths[state['done']:]
+    chunks = [(remaining[i:i + chunk_size], batch_size) for i in range(0, len(remaining), chunk_size)]
+
+    summary = {
+        'total': len(paths),
+        'skipped': state['done'],
+        'classified': 0,
+        'errors': 0,
+        'workers': workers,
+        'threads_per_worker': threads,
+        **{stage: 0.0 for stage in TIMING_STAGES},
+    }
+    writer = ResultWriter(output, fmt, state['offset'])
+    start = time.perf_counter()
+    try:
+        if chunks:
+            # spawn, not fork: a parent that already ran torch can deadlock forked OpenMP workers
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(workers, initializer=_init_worker, initargs=(workers, threads, model_path)) as pool:
+                for results, timings in pool.imap(_classify_chunk, chunks):
+                    for result in results:
+                        writer.write(result)
+                        summary['errors'] += result['error'] is not None
+                    state['done'] += len(results)
+                    state['offset'] = writer.sync()
+                    save_checkpoint(checkpoint, state)
+                    summary['classified'] += len(results)
+                    for stage in TIMING_STAGES:
+                        summary[stage] += timings.get(stage, 0.0)
+                    if progress is not None:
+                        progress(state['done'], len(paths))
+    finally:
+        writer.close()
+
+    wall = time.perf_counter() - start
+    summary['wall_seconds'] = round(wall, 3)
+    summary['images_per_second'] = round(summary['classified'] / wall, 2) if wall > 0 else 0
+    for stage in TIMING_STAGES:
+        summary[stage] = round(summary[stage], 3)
+    return summary
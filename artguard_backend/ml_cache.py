@@ -0,0 +1,184 @@
+"""
+Content-addressed cache of classifier predictions.
+
+Entries are keyed by the SHA-256 of the uploaded image bytes, the content
+hash of the serving checkpoint and the resize policy. Swapping the model
+therefore changes every key, so predictions from an old model are never
+served; they age out of the bounded disk tier.
+
+Two tiers are consulted in order:
+    memory  per-process LRU of the most recent ML_CACHE_MEMORY_ITEMS entries
+    disk    SQLite file (WAL mode) shared by every worker process on the node
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.getenv('ML_CACHE_ENABLED', 'True') == 'True'
+CACHE_PATH = os.getenv(
+    'ML_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prediction_cache.sqlite3'))
+CACHE_MEMORY_ITEMS = int(os.getenv('ML_CACHE_MEMORY_ITEMS', '4096'))
+CACHE_MAX_ROWS = int(os.getenv('ML_CACHE_MAX_ROWS', '200000'))
+# How many inserts between checks of the disk tier's row cap
+PRUNE_INTERVAL = 1000
+
+
+def cache_key(image_bytes, model_version, policy):
+    return f"{hashlib.sha256(image_bytes).hexdigest()}:{model_version}:{policy}"
+
+
+class PredictionCache:
+    """Two-tier (memory LRU + SQLite) cache of (label, confidence) predictions."""
+
+    def __init__(self, path=CACHE_PATH, memory_items=CACHE_MEMORY_ITEMS, max_rows=CACHE_MAX_ROWS):
+        self.path = path
+        self.memory_items = memory_items
+        self.max_rows = max_rows
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._inserts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_errors = 0
+
+    def _connection(self):
+        # Connections are per thread and must not cross a fork
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS predictions ('
+                'key TEXT PRIMARY KEY, model_version TEXT NOT NULL, label TEXT NOT NULL, '
+                'confidence REAL NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_predictions_created_at ON predictions(created_at)')
+            conn.commit()
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return (label, confidence) for a key, or None on a miss."""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+        try:
+            row = self._connection().execute(
+                'SELECT label, confidence FROM predictions WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Prediction cache read failed: {e}")
+            self.disk_errors += 1
+            row = None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        value = (row[0], row[1])
+        self._remember(key, value)
+        with self._lock:
+            self.disk_hits += 1
+        return value
+
+    def put(self, key, model_version, label, confidence):
+        self._remember(key, (label, confidence))
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO predictions (key, model_version, label, confidence, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, model_version, label, confidence, time.time()),
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Prediction cache write failed: {e}")
+            self.disk_errors += 1
+            return
+        with self._lock:
+            self._inserts += 1
+            prune = self._inserts % PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Drop the oldest disk entries beyond max_rows; stale model versions go first by age."""
+        conn = self._connection()
+        try:
+            (count,) = conn.execute('SELECT COUNT(*) FROM predictions').fetchone()
+            if count > self.max_rows:
+                conn.execute(
+                    'DELETE FROM predictions WHERE key IN '
+                    '(SELECT key FROM predictions ORDER BY created_at LIMIT ?)',
+                    (count - self.max_rows,),
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Prediction cache prune failed: {e}")
+
+    def lookup_or_predict(self, image_bytes, model_version, policy, predict):
+        """
+        Return a cached prediction or compute, store and return a new one.
+
+        Args:
+            image_bytes (bytes): Raw uploaded file contents.
+            model_version (str): Version of the model that would run.
+            policy (str): Resize policy the prediction is made with.
+            predict (callable): Zero-argument function returning (label, confidence).
+        Returns:
+            (label, confidence, cached): cached is True when no forward pass ran.
+        """
+        key = cache_key(image_bytes, model_version, policy)
+        value = self.get(key)
+        if value is not None:
+            return value[0], value[1], True
+        label, confidence = predict()
+        self.put(key, model_version, label, confidence)
+        return label, confidence, False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0,
+                'memory_entries': len(self._memory),
+                'disk_errors': self.disk_errors,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide PredictionCache, or None when ML_CACHE_ENABLED=False."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PredictionCache()
+    return _cache
@@ -0,0 +1,234 @@
+"""
+Confidence-gated cascade for the artwork classifier.
+
+A cheap first stage answers whenever its top softmax probability reaches
+ML_CASCADE_THRESHOLD; every other image escalates to the full model. By
+default the first stage is the served network run at ML_CASCADE_FIRST_SIZE
+pixels (160px needs about half the FLOPs of 224px) and the escalation target
+is the served network at its manifest input size. Either stage can point at
+another checkpoint instead, e.g. a smaller student for the first stage or the
+ResNet18 ArtworkClassifier for escalation; each stage normalizes with its own
+model's manifest mean/std. Each image is decoded once and resized for
+whichever stages it reaches.
+
+sweep_thresholds() runs both stages over a folder and reports the escalation
+rate, accuracy and mean latency each threshold would give, so the threshold
+can be tuned offline (see the tune_cascade management command).
+"""
+
+import os
+import statistics
+import threading
+import time
+
+import torch
+
+from ml_inference import CLASS_LABELS, WARMUP_RUNS, decode_image, find_images, get_model_handle
+from ml_preprocessing import STRETCH, get_preprocessor
+
+CASCADE_ENABLED = os.getenv('ML_CASCADE_ENABLED', 'False') == 'True'
+CASCADE_THRESHOLD = float(os.getenv('ML_CASCADE_THRESHOLD', '0.9'))
+CASCADE_FIRST_SIZE = int(os.getenv('ML_CASCADE_FIRST_SIZE', '160'))
+# Empty means the served checkpoint (ml_inference.default_model_path)
+CASCADE_FIRST_MODEL = os.getenv('ML_CASCADE_FIRST_MODEL') or None
+CASCADE_ESCALATION_MODEL = os.getenv('ML_CASCADE_ESCALATION_MODEL') or None
+DEFAULT_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99)
+
+
+def _run_handle(tensor, model_path):
+    handle = get_model_handle(model_path)
+    confidence, pred_idx = torch.max(handle.predict(tensor).reshape(-1), dim=0)
+    return handle.labels.get(pred_idx.item(), "Unknown"), confidence.item()
+
+
+class Cascade:
+    """
+    Two-stage classifier: a cheap first pass, escalating below `threshold`.
+    """
+
+    def __init__(self, threshold=CASCADE_THRESHOLD, first_size=CASCADE_FIRST_SIZE,
+                 first_model_path=CASCADE_FIRST_MODEL, escalation_model_path=CASCADE_ESCALATION_MODEL,
+                 policy=STRETCH):
+        self.threshold = threshold
+        self.first_model_path = first_model_path
+        self.escalation_model_path = escalation_model_path
+        self.first_size = first_size
+        self.policy = policy
+        self._lock = threading.Lock()
+        self.images = 0
+        self.escalated = 0
+        self.first_seconds = 0.0
+        self.escalation_seconds = 0.0
+
+    @property
+    def first(self):
+        """Preprocessor for the first stage: CASCADE_FIRST_SIZE with its model's normalization."""
+        handle = get_model_handle(self.first_model_path)
+        return get_preprocessor(self.policy, self.first_size, handle.mean, handle.std)
+
+    @property
+    def full(self):
+        """Preprocessor for escalation, from the escalation model's manifest."""
+        return get_model_handle(self.escalation_model_path).preprocessor(self.policy)
+
+    @property
+    def version(self):
+        """Identifies the cascade's answers for the prediction cache."""
+        first = get_model_handle(self.first_model_path).version
+        escalation = get_model_handle(self.escalation_model_path).version
+        return f"{first}-{escalation}-c{self.threshold}@{self.first_size}"
+
+    def classify(self, source, run=_run_handle):
+        """
+        Classify one image through the cascade.
+
+        Args:
+            source: Path or binary file-like object.
+            run (callable): (tensor, model_path) -> (label, confidence); defaults
+                to a direct forward pass, ml_batching passes its engine instead.
+        Returns:
+            (label: str, confidence: float, escalated: bool)
+        Raises:
+            ValueError: If the image cannot be read.
+            RuntimeError: If model loading fails.
+        """
+        first, full = self.first, self.full
+        # Decoded at the larger stage's size so both stages can reuse it
+        image = decode_image(source, max(first.decode_size, full.decode_size))
+        start = time.perf_counter()
+        label, confidence = run(first.from_decoded(image), self.first_model_path)
+        first_done = time.perf_counter()
+        escalated = confidence < self.threshold
+        if escalated:
+            label, confidence = run(full.from_decoded(image), self.escalation_model_path)
+        with self._lock:
+            self.images += 1
+            self.first_seconds += first_done - start
+            if escalated:
+                self.escalated += 1
+                self.escalation_seconds += time.perf_counter() - first_done
+        return label, confidence, escalated
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threshold': self.threshold,
+                'first_size': self.first_size,
+                'first_model': self.first_model_path,
+                'escalation_model': self.escalation_model_path,
+                'images': self.images,
+                'escalated': self.escalated,
+                'escalation_rate': round(self.escalated / self.images, 4) if self.images else 0,
+                'first_ms_mean': round(self.first_seconds / self.images * 1000, 3) if self.images else None,
+                'escalation_ms_mean': (
+                    round(self.escalation_seconds / self.escalated * 1000, 3) if self.escalated else None),
+            }
+
+
+_cascade = None
+_cascade_lock = threading.Lock()
+
+
+def get_cascade():
+    """Process-wide Cascade, or None when ML_CASCADE_ENABLED=False."""
+    global _cascade
+    if not CASCADE_ENABLED:
+        return None
+    if _cascade is None:
+        with _cascade_lock:
+            if _cascade is None:
+                _cascade = Cascade()
+    return _cascade
+
+
+def labelled_images(directory):
+    """
+    Images with ground truth taken from subfolders named after the classes
+    (e.g. AI/, Handmade/, Print/, case-insensitive). Returns (paths, labels),
+    with labels None when the folder is not laid out that way.
+    """
+    names = {label.lower(): label for label in CLASS_LABELS.values()}
+    paths, labels = [], []
+    for entry in sorted(os.listdir(directory)):
+        label = names.get(entry.lower())
+        if label and os.path.isdir(os.path.join(directory, entry)):
+            found = find_images(os.path.join(directory, entry))
+            paths.extend(found)
+            labels.extend([label] * len(found))
+    if not paths:
+        return find_images(directory), None
+    return paths, labels
+
+
+def sweep_thresholds(paths, labels=None, thresholds=DEFAULT_THRESHOLDS, cascade=None):
+    """
+    Run both stages on every image once and derive what each threshold would do.
+
+    Accuracy is measured against `labels` when given, otherwise as agreement
+    with the escalation model alone. Latencies are forward-pass only (decoding
+    is identical either way) at batch size 1.
+
+    Returns:
+        dict: Baselines for each stage alone and one row per threshold with
+        escalation_rate, accuracy and mean_ms.
+    Raises:
+        ValueError: If no image could be read.
+    """
+    cascade = cascade or Cascade()
+    # First-stage shapes differ from the registry's warm-up input
+    for _ in range(WARMUP_RUNS):
+        get_model_handle(cascade.first_model_path).predict(torch.zeros(1, 3, cascade.first_size, cascade.first_size))
+    first, full = cascade.first, cascade.full
+    records = []
+    skipped = 0
+    for i, path in enumerate(paths):
+        try:
+            image = decode_image(path, max(first.decode_size, full.decode_size))
+        except ValueError:
+            skipped += 1
+            continue
+        start = time.perf_counter()
+        first_label, first_confidence = _run_handle(first.from_decoded(image), cascade.first_model_path)
+        first_done = time.perf_counter()
+        full_label, _ = _run_handle(full.from_decoded(image), cascade.escalation_model_path)
+        records.append({
+            'truth': labels[i] if labels else None,
+            'first_label': first_label,
+            'first_confidence': first_confidence,
+            'full_label': full_label,
+            'first_ms': (first_done - start) * 1000,
+            'full_ms': (time.perf_counter() - first_done) * 1000,
+        })
+    if not records:
+        raise ValueError("None of the images could be read")
+
+    def accuracy(predictions):
+        truths = [r['truth'] if labels else r['full_label'] for r in records]
+        return round(sum(p == t for p, t in zip(predictions, truths)) / len(records), 4)
+
+    rows = []
+    for threshold in sorted(thresholds):
+        escalate = [r['first_confidence'] < threshold for r in records]
+        predictions = [r['full_label'] if e else r['first_label'] for r, e in zip(records, escalate)]
+        rows.append({
+            'threshold': threshold,
+            'escalation_rate': round(sum(escalate) / len(records), 4),
+            'accuracy': accuracy(predictions),
+            'mean_ms': round(statistics.mean(
+                r['first_ms'] + (r['full_ms'] if e else 0) for r, e in zip(records, escalate)), 3),
+        })
+    return {
+        'images': len(records),
+        'skipped': skipped,
+        'accuracy_against': 'labels' if labels else 'escalation_model',
+        'first_size': cascade.first_size,
+        'first_only': {
+            'accuracy': accuracy([r['first_label'] for r in records]),
+            'mean_ms': round(statistics.mean(r['first_ms'] for r in records), 3),
+        },
+        'full_only': {
+            'accuracy': accuracy([r['full_label'] for r in records]),
+            'mean_ms': round(statistics.mean(r['full_ms'] for r in records), 3),
+        },
+        'thresholds': rows,
+    }
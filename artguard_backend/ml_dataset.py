@@ -0,0 +1,408 @@
+"""
+Preprocessed training datasets in memory-mapped uint8 shards.
+
+Training from a folder of JPEGs decodes and resizes every image again on
+every epoch. prepare_dataset does that work once: images are deduplicated
+by content hash, decoded, resized to a square store size (a little larger
+than the model input, leaving room for random crops) and appended to
+fixed-size shards:
+
+    dataset/
+        dataset.json        store size, resize policy, classes and shard row counts
+        shard-00000.u8      (rows, size, size, 3) uint8 pixels, row-major
+        labels.i16          class index per row (UNLABELLED when the folder had no classes)
+        sources.jsonl       source path and sha256 per row
+
+ShardLoader serves (inputs, labels) batches from the shards: each batch is
+gathered, cropped and optionally flipped with one fancy-indexing read per
+shard, then normalized in one fused kernel as in ml_preprocessing. Batches
+are assembled on a few threads ahead of the training loop, and the loader
+looks enough like a DataLoader (len, batch_size, dataset) to be passed to
+fine_tune_model or distill-style loops directly.
+
+Evaluation batches take the center crop; with the stretch policy a store
+size equal to the model input makes them match serving exactly (at the
+cost of crop augmentation, flips still apply).
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from ml_distillation import UNLABELLED
+from ml_inference import CLASS_LABELS, DECODE_WORKERS, IMAGENET_MEAN, IMAGENET_STD, INPUT_SIZE, decode_image
+from ml_preprocessing import CHANNELS_LAST, CROP_RESIZE, POLICIES, STRETCH, resize_for_policy
+
+logger = logging.getLogger(__name__)
+
+INFO_FILE = 'dataset.json'
+LABELS_FILE = 'labels.i16'
+SOURCES_FILE = 'sources.jsonl'
+FORMAT_VERSION = 1
+# 1024 rows of 256 x 256 pixels is 192 MiB per shard
+SHARD_ROWS = int(os.getenv('ML_DATASET_SHARD_ROWS', '1024'))
+
+
+def _shard_name(number):
+    return f"shard-{number:05d}.u8"
+
+
+def _load(path, store_size, policy):
+    """Read, hash, decode and resize one image; pixels is None when it cannot be decoded."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        image = decode_image(io.BytesIO(data), (store_size, store_size))
+    except ValueError as e:
+        return digest, None, str(e)
+    image = resize_for_policy(image, policy, store_size, crop_resize=store_size)
+    return digest, np.asarray(image, dtype=np.uint8), None
+
+
+def prepare_dataset(paths, labels, output, store_size=CROP_RESIZE, policy=STRETCH, shard_rows=SHARD_ROWS,
+                    workers=None, progress=None):
+    """
+    Decode a set of images once into a sharded uint8 dataset, replacing any dataset at output.
+
+    Images with the same content are stored once; when copies disagree on the
+    label, the first one (in path order) wins and the conflict is counted.
+    The dataset is written to a staging directory and renamed into place.
+
+    Args:
+        paths (list): Image paths.
+        labels (list): Class name per path (see CLASS_LABELS), or None.
+        output (str): Dataset directory.
+        store_size (int): Side of the stored square images; at least the model input.
+        policy (str): How images become square, see ml_preprocessing.
+        shard_rows (int): Images per shard file.
+        workers (int): Decode threads, defaults to ML_DECODE_WORKERS.
+        progress (callable): Called with the number of paths processed so far.
+    Returns:
+        dict: Counts of images written, duplicates, label conflicts and
+        unreadable files, per-class rows, shards, bytes and seconds.
+    Raises:
+        ValueError: On an unknown policy, a store size below the model input
+            or when no image could be read.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown resize policy '{policy}', expected one of {POLICIES}")
+    if store_size < INPUT_SIZE:
+        raise ValueError(f"Store size {store_size} is smaller than the model input {INPUT_SIZE}")
+    indices = {label: index for index, label in CLASS_LABELS.items()}
+    label_indices = [indices[label] for label in labels] if labels else [UNLABELLED] * len(paths)
+    output = os.path.abspath(output)
+    staging = f"{output}.prepare-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    start = time.perf_counter()
+
+    seen = {}
+    shards, rows_written, class_rows = [], [], Counter()
+    duplicates = conflicts = unreadable = 0
+    shard_file = None
+    workers = workers or DECODE_WORKERS
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+                open(os.path.join(staging, LABELS_FILE), 'wb') as labels_file, \
+                open(os.path.join(staging, SOURCES_FILE), 'w') as sources_file:
+            sources = iter(zip(paths, label_indices))
+            done = 0
+            while True:
+                # A bounded window keeps decoded images from piling up ahead of the writer
+                while len(pending) < workers * 4:
+                    try:
+                        path, label = next(sources)
+                    except StopIteration:
+                        break
+                    pending.append((path, label, executor.submit(_load, path, store_size, policy)))
+                if not pending:
+                    break
+                path, label, future = pending.popleft()
+                done += 1
+                try:
+                    digest, pixels, error = future.result()
+                except OSError as e:
+                    digest, pixels, error = None, None, str(e)
+                if digest in seen:
+                    duplicates += 1
+                    if seen[digest] != label:
+                        conflicts += 1
+                        logger.warning(f"{path} duplicates an image labelled "
+                                       f"{CLASS_LABELS.get(seen[digest], 'unlabelled')}, keeping that label")
+                elif pixels is None:
+                    unreadable += 1
+                    logger.warning(f"Skipping {path}: {error}")
+                else:
+                    seen[digest] = label
+                    if shard_file is None or rows_written[-1] == shard_rows:
+                        if shard_file is not None:
+                            shard_file.close()
+                        shards.append(_shard_name(len(shards)))
+                        rows_written.append(0)
+                        shard_file = open(os.path.join(staging, shards[-1]), 'wb')
+                    shard_file.write(pixels.tobytes())
+                    rows_written[-1] += 1
+                    labels_file.write(np.int16(label).tobytes())
+                    sources_file.write(json.dumps({'path': path, 'sha256': digest}) + '\n')
+                    class_rows[CLASS_LABELS.get(label, 'unlabelled')] += 1
+                if progress is not None:
+                    progress(done)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+        if shard_file is not None:
+            shard_file.close()
+    rows = sum(rows_written)
+    if not rows:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise ValueError("None of the images could be read")
+
+    info = {
+        'format_version': FORMAT_VERSION,
+        'size': store_size,
+        'policy': policy,
+        'classes': {str(index): label for index, label in CLASS_LABELS.items()},
+        'rows': rows,
+        'shards': [{'file': name, 'rows': count} for name, count in zip(shards, rows_written)],
+    }
+    with open(os.path.join(staging, INFO_FILE), 'w') as f:
+        json.dump(info, f, indent=2)
+    retired = f"{output}.old-{os.getpid()}"
+    if os.path.exists(output):
+        os.rename(output, retired)
+    os.rename(staging, output)
+    shutil.rmtree(retired, ignore_errors=True)
+    return {
+        'path': output,
+        'images': rows,
+        'duplicates': duplicates,
+        'label_conflicts': conflicts,
+        'unreadable': unreadable,
+        'classes': dict(class_rows),
+        'shards': len(shards),
+        'bytes': rows * store_size * store_size * 3,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+class ShardedDataset:
+    """Read-only view of a prepared dataset; shards are memory-mapped, not loaded."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            with open(os.path.join(directory, INFO_FILE)) as f:
+                info = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"{directory} is not a prepared dataset: {e}")
+        if info.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"{directory} has dataset format {info.get('format_version')}, "
+                             f"expected {FORMAT_VERSION}; prepare it again")
+        self.size = info['size']
+        self.policy = info['policy']
+        shape = (self.size, self.size, 3)
+        self._shards = [
+            np.memmap(os.path.join(directory, shard['file']), dtype=np.uint8, mode='r', shape=(shard['rows'], *shape))
+            for shard in info['shards']
+        ]
+        self._offsets = np.cumsum([0] + [shard['rows'] for shard in info['shards']])
+        self.labels = np.fromfile(os.path.join(directory, LABELS_FILE), dtype=np.int16).astype(np.int64)
+        if len(self.labels) != self._offsets[-1]:
+            raise ValueError(f"{directory} has {self._offsets[-1]} images but {len(self.labels)} labels")
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def labelled(self):
+        return bool(len(self.labels)) and bool((self.labels != UNLABELLED).all())
+
+    @staticmethod
+    def is_dataset(directory):
+        return os.path.isfile(os.path.join(directory, INFO_FILE))
+
+    def crops(self, indices, top, left, size, flip):
+        """
+        Crop rows straight out of the shards.
+
+        Args:
+            indices (np.ndarray): Dataset rows.
+            top, left (np.ndarray): Crop corner per row.
+            size (int): Crop side.
+            flip (np.ndarray): Rows to mirror horizontally.
+        Returns:
+            np.ndarray: (len(indices), size, size, 3) uint8 crops.
+        """
+        steps = np.arange(size)
+        rows = top[:, None] + steps
+        # A flipped crop reads its columns right to left
+        cols = left[:, None] + np.where(flip[:, None], size - 1 - steps, steps)
+        out = np.empty((len(indices), size, size, 3), dtype=np.uint8)
+        shard_of = np.searchsorted(self._offsets, indices, side='right') - 1
+        for shard in np.unique(shard_of):
+            mask = shard_of == shard
+            local = indices[mask] - self._offsets[shard]
+            out[mask] = self._shards[shard][local[:, None, None], rows[mask][:, :, None], cols[mask][:, None, :]]
+        return out
+
+    def split(self, val_fraction=0.2, seed=0):
+        """Deterministically shuffled (train, val) row indices, holding out val_fraction."""
+        order = np.random.default_rng(seed).permutation(len(self))
+        held_out = max(1, int(round(len(order) * val_fraction)))
+        if held_out >= len(order):
+            raise ValueError(f"{len(order)} images are too few to hold out {val_fraction:.0%} for validation")
+        return order[held_out:], order[:held_out]
+
+
+class _Rows:
+    """The rows a loader serves; stands in for DataLoader.dataset (only its length is used)."""
+
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ShardLoader:
+    """
+    Iterates (inputs, labels) batches over rows of a ShardedDataset.
+
+    Inputs are new normalized float tensors of shape (N, 3, crop, crop);
+    labels are int64. Random crops and flips are drawn per batch from a seed
+    fixed when iteration starts, so a loader seeded the same way yields the
+    same batches whatever the thread scheduling.
+
+    For data-parallel training every process creates the loader with the
+    same seed and its own rank: each epoch the rows are shuffled identically
+    everywhere, then dealt out round-robin, wrapping around so that every
+    rank gets the same number of batches (as torch's DistributedSampler does).
+    """
+
+    def __init__(self, dataset, batch_size=32, indices=None, shuffle=False, augment=False, crop_size=INPUT_SIZE,
+                 workers=None, seed=None, drop_last=False, channels_last=CHANNELS_LAST,
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD, rank=0, world_size=1):
+        if crop_size > dataset.size:
+            raise ValueError(f"Crop size {crop_size} is larger than the stored images ({dataset.size})")
+        indices = np.arange(len(dataset)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.dataset = _Rows(dataset, indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.crop_size = crop_size
+        self.workers = workers or DECODE_WORKERS
+        self.drop_last = drop_last
+        self.channels_last = channels_last
+        self.rank = rank
+        self.world_size = world_size
+        self._rng = np.random.default_rng(seed)
+        mean = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+        self._scale = 1.0 / (255.0 * std)
+        self._shift = -mean / std
+
+    def __len__(self):
+        rows = -(-len(self.dataset) // self.world_size)
+        return rows // self.batch_size if self.drop_last else -(-rows // self.batch_size)
+
+    def _batch(self, rows, seed):
+        dataset = self.dataset.dataset
+        count, margin = len(rows), dataset.size - self.crop_size
+        if self.augment:
+            rng = np.random.default_rng(seed)
+            top, left = rng.integers(0, margin + 1, size=(2, count))
+            flip = rng.random(count) < 0.5
+        else:
+            top = left = np.full(count, margin // 2)
+            flip = np.zeros(count, dtype=bool)
+        pixels = torch.from_numpy(dataset.crops(rows, top, left, self.crop_size, flip)).permute(0, 3, 1, 2)
+        inputs = torch.empty(count, 3, self.crop_size, self.crop_size)
+        if self.channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        torch.addcmul(self._shift, pixels, self._scale, out=inputs)
+        return inputs, torch.from_numpy(dataset.labels[rows])
+
+    def __iter__(self):
+        rows = self.dataset.indices
+        if self.shuffle:
+            rows = rows[self._rng.permutation(len(rows))]
+        if self.world_size > 1:
+            rows = np.resize(rows, -(-len(rows) // self.world_size) * self.world_size)[self.rank::self.world_size]
+        chunks = [rows[i:i + self.batch_size] for i in range(0, len(rows), self.batch_size)]
+        if self.drop_last and chunks and len(chunks[-1]) < self.batch_size:
+            chunks.pop()
+        # Drawn for every rank so all ranks' generators stay in step
+        seeds = self._rng.integers(2 ** 63, size=(self.world_size, len(chunks)))[self.rank]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for chunk, seed in zip(chunks, seeds):
+                pending.append(executor.submit(self._batch, chunk, seed))
+                if len(pending) > self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def measure_loader(loader, batches=None):
+    """
+    Time one pass (or the first `batches` batches) of a loader.
+
+    Returns:
+        dict: images, seconds and images_per_second.
+    """
+    images = 0
+    start = time.perf_counter()
+    for n, (inputs, _) in enumerate(loader):
+        images += len(inputs)
+        if batches is not None and n + 1 >= batches:
+            break
+    seconds = time.perf_counter() - start
+    return {
+        'images': images,
+        'seconds': round(seconds, 3),
+        'images_per_second': round(images / seconds, 1) if seconds else None,
+    }
+
+
+def measure_decode(paths, policy=STRETCH, workers=None):
+    """
+    Time decoding, resizing and normalizing image files the way a folder-based
+    loader does every epoch, for comparison with measure_loader.
+
+    Returns:
+        dict: images, seconds and images_per_second.
+    """
+    from ml_preprocessing import get_preprocessor
+
+    preprocessor = get_preprocessor(policy)
+
+    def load(path):
+        try:
+            return preprocessor.preprocess(path)
+        except ValueError:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or DECODE_WORKERS) as executor:
+        images = sum(tensor is not None for tensor in executor.map(load, paths))
+    seconds = time.perf_counter() - start
+    return {
+        'images': images,
+        'seconds': round(seconds, 3),
+        'images_per_second': round(images / seconds, 1) if seconds else None,
+    }
@@ -0,0 +1,386 @@
+"""
+Knowledge distillation and structured pruning for a slimmer serving model.
+
+A large teacher (the ResNet18 ArtworkClassifier of
+public/model/model_architecture.py, or any checkpoint ml_inference can load)
+is distilled into a MobileNetV2 student: the student is trained on the
+teacher's temperature-softened class probabilities, mixed with the ground
+truth labels when the training folder has them.
+
+Optionally the student is then pruned structurally: every inverted residual
+block keeps only its most important expansion channels (the hidden width
+between the 1x1 expand and 1x1 project convolutions; the block's inputs and
+outputs, and with them the residual connections, are untouched). A few
+recovery epochs of distillation win back the accuracy lost by pruning.
+
+Unpruned students are plain MobileNetV2 state_dicts. Pruned ones are saved
+tagged with their per-block widths and are rebuilt by load_pruned_state when
+ml_inference.load_model reads them, so either can be served, exported or
+published like any other checkpoint.
+"""
+
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ml_export import measure_latency
+from ml_inference import CLASS_LABELS, DECODE_WORKERS, INPUT_SIZE, load_model
+
+logger = logging.getLogger(__name__)
+
+PRUNED_FORMAT = 'pruned'
+# Kept widths are rounded to multiples of this, which vectorized conv kernels prefer
+CHANNEL_DIVISOR = 8
+UNLABELLED = -1
+
+
+def mobilenet_v2_student(init_path=None):
+    """
+    MobileNetV2 student, starting from a MobileNetV2 checkpoint (e.g. the
+    current serving model) when one is given, from random weights otherwise.
+    """
+    from torchvision.models import mobilenet_v2
+    if init_path is None:
+        return mobilenet_v2(num_classes=len(CLASS_LABELS))
+    model = load_model(init_path, mmap=False)
+    if type(model).__name__ != 'MobileNetV2':
+        raise ValueError(f"{init_path} is a {type(model).__name__}, the student must start from a MobileNetV2")
+    return model
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=4.0, alpha=0.7):
+    """
+    alpha * T^2 * KL(teacher || student) on softened probabilities, plus
+    (1 - alpha) * cross-entropy on the rows that have a label.
+    """
+    soft = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=1),
+        F.softmax(teacher_logits / temperature, dim=1),
+        reduction='batchmean',
+    ) * temperature ** 2
+    labelled = labels != UNLABELLED
+    if alpha >= 1.0 or not labelled.any():
+        return soft
+    hard = F.cross_entropy(student_logits[labelled], labels[labelled])
+    return alpha * soft + (1 - alpha) * hard
+
+
+def _batches(samples, preprocessor, executor, rng=None, flip=False):
+    """
+    (inputs, labels) batches of the readable samples, shuffled when rng is
+    given, decoding the next batch while the caller trains on the current one.
+    The inputs tensor is the preprocessor's reused buffer.
+    """
+    order = list(range(len(samples)))
+    if rng is not None:
+        rng.shuffle(order)
+    size = preprocessor.max_batch_size
+    chunks = [order[i:i + size] for i in range(0, len(order), size)]
+
+    def submit(chunk):
+        return [(samples[i][1], executor.submit(preprocessor.load, samples[i][0])) for i in chunk]
+
+    pending = submit(chunks[0]) if chunks else []
+    for n in range(len(chunks)):
+        current = pending
+        pending = submit(chunks[n + 1]) if n + 1 < len(chunks) else []
+        images, labels = [], []
+        for label, future in current:
+            try:
+                images.append(future.result())
+            except ValueError:
+                continue
+            labels.append(label)
+        if not images:
+            continue
+        inputs = preprocessor.fill(images)
+        if flip:
+            # Horizontal flips: artworks stay artworks when mirrored
+            rows = [row for row in range(len(images)) if rng.random() < 0.5]
+            if rows:
+                inputs[rows] = inputs[rows].flip(-1)
+        yield inputs, torch.tensor(labels)
+
+
+def evaluate(model, teacher, samples, preprocessor, executor):
+    """Accuracy against the labels (None without labels) and top-1 agreement with the teacher."""
+    model.eval()
+    correct = labelled = agree = total = 0
+    with torch.no_grad():
+        for inputs, labels in _batches(samples, preprocessor, executor):
+            predicted = model(inputs).argmax(dim=1)
+            agree += int((predicted == teacher(inputs).argmax(dim=1)).sum())
+            total += len(labels)
+            mask = labels != UNLABELLED
+            labelled += int(mask.sum())
+            correct += int((predicted[mask] == labels[mask]).sum())
+    return {
+        'accuracy': round(correct / labelled, 4) if labelled else None,
+        'teacher_agreement': round(agree / total, 4) if total else None,
+    }
+
+
+def distill(student, teacher, train, val, preprocessor, epochs, lr=1e-3, temperature=4.0, alpha=0.7,
+            seed=0, phase='distill', progress=None):
+    """
+    Train the student on the teacher's soft targets (and the labels).
+
+    Returns:
+        list: Per-epoch history (phase, epoch, loss, seconds, accuracy, teacher_agreement).
+    """
+    teacher.eval()
+    optimizer = torch.optim.Adam([p for p in student.parameters() if p.requires_grad], lr=lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max(1, epochs))
+    rng = random.Random(seed)
+    history = []
+    with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as executor:
+        for epoch in range(epochs):
+            student.train()
+            start = time.perf_counter()
+            running, steps = 0.0, 0
+            for inputs, labels in _batches(train, preprocessor, executor, rng, flip=True):
+                with torch.no_grad():
+                    teacher_logits = teacher(inputs)
+                loss = distillation_loss(student(inputs), teacher_logits, labels, temperature, alpha)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                running += loss.item()
+                steps += 1
+            scheduler.step()
+            entry = {
+                'phase': phase,
+                'epoch': epoch + 1,
+                'loss': round(running / max(1, steps), 4),
+                'seconds': round(time.perf_counter() - start, 2),
+                **evaluate(student, teacher, val, preprocessor, executor),
+            }
+            history.append(entry)
+            if progress:
+                progress(entry)
+    student.eval()
+    return history
+
+
+def _round_channels(channels, divisor=CHANNEL_DIVISOR):
+    return max(divisor, int(round(channels / divisor)) * divisor)
+
+
+def _expanding_blocks(model):
+    """(feature index, InvertedResidual) of the blocks with a 1x1 expansion, the ones that can be pruned."""
+    from torchvision.models.mobilenetv2 import InvertedResidual
+    return [(index, block) for index, block in enumerate(model.features)
+            if isinstance(block, InvertedResidual) and len(block.conv) == 4]
+
+
+def _channel_importance(block):
+    # How strongly each hidden channel reaches the block's output: scale of its
+    # depthwise batch norm times the L1 norm of its projection weights
+    depthwise_bn = block.conv[1][1]
+    project = block.conv[2]
+    return depthwise_bn.weight.detach().abs() * project.weight.detach().abs().sum(dim=(0, 2, 3))
+
+
+def _select(module, attribute, index, dim=0):
+    tensor = getattr(module, attribute)
+    selected = tensor.detach().index_select(dim, index).clone()
+    if isinstance(tensor, nn.Parameter):
+        selected = nn.Parameter(selected, requires_grad=tensor.requires_grad)
+    setattr(module, attribute, selected)
+
+
+def _shrink_block(block, keep):
+    """Keep only the hidden channels in `keep` (a sorted index tensor), in place."""
+    expand, depthwise, project = block.conv[0][0], block.conv[1][0], block.conv[2]
+    expand_bn, depthwise_bn = block.conv[0][1], block.conv[1][1]
+    _select(expand, 'weight', keep)
+    expand.out_channels = len(keep)
+    for bn in (expand_bn, depthwise_bn):
+        for attribute in ('weight', 'bias', 'running_mean', 'running_var'):
+            _select(bn, attribute, keep)
+        bn.num_features = len(keep)
+    _select(depthwise, 'weight', keep)
+    depthwise.in_channels = depthwise.out_channels = depthwise.groups = len(keep)
+    _select(project, 'weight', keep, dim=1)
+    project.in_channels = len(keep)
+
+
+def prune_mobilenet_v2(model, ratio, divisor=CHANNEL_DIVISOR):
+    """
+    Remove the least important fraction `ratio` of every expanding block's
+    hidden channels, in place.
+
+    Returns:
+        dict: Kept hidden width per feature index, as stored in the checkpoint.
+    """
+    if not 0.0 <= ratio < 1.0:
+        raise ValueError(f"Pruning ratio must be in [0, 1), got {ratio}")
+    widths = {}
+    for index, block in _expanding_blocks(model):
+        hidden = block.conv[0][0].out_channels
+        kept = min(hidden, _round_channels(hidden * (1.0 - ratio), divisor))
+        if kept < hidden:
+            keep = _channel_importance(block).topk(kept).indices.sort().values
+            _shrink_block(block, keep)
+        widths[index] = kept
+    return widths
+
+
+def save_student(model, path, widths=None):
+    """Write the student where ml_inference.load_model can read it: tagged when pruned, a plain state_dict otherwise."""
+    if widths is None:
+        torch.save(model.state_dict(), path)
+    else:
+        torch.save({'format': PRUNED_FORMAT, 'architecture': 'mobilenet_v2',
+                    'widths': widths, 'state_dict': model.state_dict()}, path)
+    return path
+
+
+def load_pruned_state(checkpoint):
+    """Rebuild a pruned MobileNetV2 from a checkpoint written by save_student."""
+    from torchvision.models import mobilenet_v2
+    state = checkpoint['state_dict']
+    # Built on the meta device and then given the checkpoint's tensors, which
+    # stay memory-mapped when load_model mapped the file
+    with torch.device('meta'):
+        model = mobilenet_v2(num_classes=state['classifier.1.weight'].shape[0])
+        for index, width in checkpoint['widths'].items():
+            _shrink_block(model.features[int(index)], torch.arange(width))
+    model.load_state_dict(state, assign=True)
+    model.eval()
+    return model
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def count_macs(model, size=INPUT_SIZE):
+    """Multiply-accumulates of one forward pass over a single image (convolutions and linear layers)."""
+    macs = 0
+
+    def conv_hook(module, inputs, output):
+        nonlocal macs
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        macs += output[0].numel() * (module.in_channels // module.groups) * kernel
+
+    def linear_hook(module, inputs, output):
+        nonlocal macs
+        macs += module.in_features * module.out_features
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+    try:
+        with torch.no_grad():
+            model.eval()(torch.zeros(1, 3, size, size))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return macs
+
+
+def model_summary(model, teacher, val, preprocessor, latency_runs=30):
+    """Accuracy, teacher agreement, parameters, FLOPs and latency of one model."""
+    with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as executor:
+        quality = evaluate(model, teacher, val, preprocessor, executor)
+    macs = count_macs(model)
+    return {
+        **quality,
+        'parameters': count_parameters(model),
+        'macs': macs,
+        'flops': 2 * macs,
+        'latency': measure_latency(model.eval(), latency_runs),
+    }
+
+
+def split_samples(paths, labels, val_fraction=0.2, seed=0):
+    """Shuffle (path, label index) samples deterministically and hold out val_fraction of them."""
+    indices = {label: index for index, label in CLASS_LABELS.items()}
+    samples = [(path, indices[label] if labels else UNLABELLED) for path, label in zip(paths, labels or paths)]
+    random.Random(seed).shuffle(samples)
+    held_out = max(1, int(round(len(samples) * val_fraction)))
+    if held_out >= len(samples):
+        raise ValueError(f"{len(samples)} images are too few to hold out {val_fraction:.0%} for validation")
+    return samples[held_out:], samples[:held_out]
+
+
+def run_distillation(teacher_path, train, val, output_path, student_init=None, epochs=5, prune_ratio=0.0,
+                     recovery_epochs=2, batch_size=32, lr=1e-3, temperature=4.0, alpha=0.7, seed=0,
+                     latency_runs=30, progress=None):
+    """
+    Distill, optionally prune and recover, save the student and compare it with the teacher.
+
+    Args:
+        teacher_path (str): Teacher checkpoint (e.g. a trained ArtworkClassifier).
+        train, val (list): (path, label index or UNLABELLED) samples.
+        output_path (str): Where to write the student checkpoint.
+        student_init (str): MobileNetV2 checkpoint to start the student from.
+        prune_ratio (float): Fraction of hidden channels to remove (0 disables pruning).
+        recovery_epochs (int): Distillation epochs after pruning.
+        progress (callable): Called with each epoch's history entry.
+    Returns:
+        dict: Report with a summary per model (teacher, student and, when
+        pruned, pruned), the training history and the output path.
+    Raises:
+        RuntimeError: If a checkpoint cannot be loaded.
+        ValueError: If the student checkpoint is not a MobileNetV2.
+    """
+    from ml_preprocessing import STRETCH, Preprocessor
+
+    torch.manual_seed(seed)
+    teacher = load_model(teacher_path, mmap=False)
+    for param in teacher.parameters():
+        param.requires_grad = False
+    student = mobilenet_v2_student(student_init)
+    for param in student.parameters():
+        param.requires_grad = True
+    preprocessor = Preprocessor(STRETCH, INPUT_SIZE, batch_size, channels_last=False)
+
+    start = time.perf_counter()
+    history = distill(student, teacher, train, val, preprocessor, epochs, lr, temperature, alpha, seed,
+                      progress=progress)
+    report = {
+        'teacher': {'path': teacher_path, 'architecture': type(teacher).__name__,
+                    **model_summary(teacher, teacher, val, preprocessor, latency_runs)},
+        'student': {'architecture': 'MobileNetV2', **model_summary(student, teacher, val, preprocessor, latency_runs)},
+    }
+
+    widths = None
+    if prune_ratio > 0:
+        widths = prune_mobilenet_v2(student, prune_ratio)
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as executor:
+            after_pruning = evaluate(student, teacher, val, preprocessor, executor)
+        history += distill(student, teacher, train, val, preprocessor, recovery_epochs, lr / 10, temperature,
+                           alpha, seed + 1, phase='recover', progress=progress)
+        report['pruned'] = {
+            'architecture': 'MobileNetV2 (pruned)',
+            'prune_ratio': prune_ratio,
+            'accuracy_before_recovery': after_pruning['accuracy'],
+            'teacher_agreement_before_recovery': after_pruning['teacher_agreement'],
+            **model_summary(student, teacher, val, preprocessor, latency_runs),
+        }
+
+    save_student(student, output_path, widths)
+    report['training'] = {
+        'train_images': len(train),
+        'val_images': len(val),
+        'epochs': epochs,
+        'recovery_epochs': recovery_epochs if widths is not None else 0,
+        'batch_size': batch_size,
+        'lr': lr,
+        'temperature': temperature,
+        'alpha': alpha,
+        'seconds': round(time.perf_counter() - start, 2),
+        'history': history,
+    }
+    report['output'] = output_path
+    return report
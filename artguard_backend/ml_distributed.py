@@ -0,0 +1,159 @@
+"""
+Data-parallel CPU training of the ArtworkClassifier across local processes.
+
+train_distributed starts one process per rank (torch.multiprocessing,
+spawn) joined in a gloo process group over localhost. Every rank loads the
+same starting weights (DistributedDataParallel broadcasts rank 0's anyway),
+takes its own round-robin share of each epoch's shuffled rows from a
+prepared dataset (ml_dataset.ShardLoader) and runs
+model_architecture.fine_tune_model, which averages gradients through DDP,
+sums losses and accuracy over the ranks and checkpoints from rank 0 only.
+
+The global batch size is fixed and split evenly between the ranks, so runs
+with different process counts take the same optimization steps and
+measure_scaling compares like with like (strong scaling). The CPUs are
+divided between the ranks with ml_threads.plan_threads.
+"""
+
+import socket
+import time
+
+from ml_threads import available_cpus
+
+DEFAULT_WORLD_SIZES = (1, 2, 4, 8)
+# Threads per rank that assemble the next batches while the model trains
+LOADER_WORKERS = 2
+
+
+def free_port():
+    """An unused localhost TCP port for the process group rendezvous."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _train_rank(rank, world_size, port, config, results):
+    import torch
+    import torch.distributed as dist
+
+    from ml_dataset import ShardedDataset, ShardLoader
+    from ml_inference import artwork_classifier_module, load_model
+    from ml_threads import apply_plan, plan_threads
+
+    apply_plan(plan_threads(workers=world_size, worker_index=rank, pin=config['pin']))
+    dist.init_process_group('gloo', init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    try:
+        dataset = ShardedDataset(config['dataset'])
+        if config['val_dataset']:
+            val_dataset, train = ShardedDataset(config['val_dataset']), None
+            val = list(range(len(val_dataset)))
+        else:
+            val_dataset = dataset
+            train, val = dataset.split(config['val_fraction'], config['seed'])
+        batch_size = config['batch_size'] // world_size
+        train_loader = ShardLoader(dataset, batch_size, train, shuffle=True, augment=config['augment'],
+                                   workers=LOADER_WORKERS, seed=config['seed'], rank=rank, world_size=world_size)
+        # Validation rows are split without wrapping so none is counted twice
+        val_loader = ShardLoader(val_dataset, batch_size, val[rank::world_size], workers=LOADER_WORKERS)
+
+        architecture = artwork_classifier_module()
+        torch.manual_seed(config['seed'])
+        if config['init']:
+            model = load_model(config['init'], mmap=False)
+        else:
+            model = architecture.ArtworkClassifier(pretrained=True)
+        stats = {}
+        dist.barrier()
+        start = time.perf_counter()
+        architecture.fine_tune_model(model, train_loader, val_loader, config['epochs'], stats=stats,
+                                     checkpoint_path=config['output'])
+        if rank == 0:
+            results.put({
+                'world_size': world_size,
+                'batch_size_per_rank': batch_size,
+                'train_images': len(train_loader.dataset),
+                'val_images': len(val),
+                'seconds': round(time.perf_counter() - start, 3),
+                **stats,
+            })
+        # Tear the group down together; a rank leaving early can abort its peers' gloo threads
+        dist.barrier()
+    finally:
+        dist.destroy_process_group()
+
+
+def train_distributed(dataset, world_size, init_path=None, val_dataset=None, val_fraction=0.2, epochs=1,
+                      batch_size=32, augment=False, seed=0, output=None, pin=False):
+    """
+    Fine-tune an ArtworkClassifier with world_size local processes.
+
+    Args:
+        dataset (str): Labelled dataset written by ml_dataset.prepare_dataset.
+        world_size (int): Processes (ranks) to train with.
+        init_path (str): ArtworkClassifier checkpoint to start from (default: ImageNet weights).
+        val_dataset (str): Validation dataset; default holds out val_fraction of dataset.
+        epochs (int): Training epochs.
+        batch_size (int): Global batch size, split evenly between the ranks.
+        augment (bool): Random crops and flips.
+        seed (int): Split, shuffling and initialization seed, shared by all ranks.
+        output (str): Checkpoint saved by rank 0 after every epoch.
+        pin (bool): Pin each rank to its own cores.
+    Returns:
+        dict: Rank 0's view: per-epoch seconds, validation accuracy over all
+        ranks, total seconds and training images per second.
+    Raises:
+        ValueError: If the batch cannot be split between the ranks.
+        RuntimeError: If a rank fails.
+    """
+    import torch.multiprocessing as mp
+
+    if world_size < 1 or batch_size < world_size:
+        raise ValueError(f"A batch of {batch_size} cannot be split between {world_size} processes")
+    config = {
+        'dataset': dataset, 'val_dataset': val_dataset, 'val_fraction': val_fraction, 'init': init_path,
+        'epochs': epochs, 'batch_size': batch_size, 'augment': augment, 'seed': seed, 'output': output, 'pin': pin,
+    }
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    try:
+        mp.start_processes(_train_rank, (world_size, free_port(), config, results), nprocs=world_size,
+                           join=True, start_method='spawn')
+    except mp.ProcessRaisedException as e:
+        raise RuntimeError(f"Distributed training failed: {e}")
+    except mp.ProcessExitedException as e:
+        raise RuntimeError(f"A training process died: {e}")
+    report = results.get()
+    epoch_seconds = report['epoch_seconds']
+    report['images_per_second'] = round(report['train_images'] * len(epoch_seconds) / sum(epoch_seconds), 1)
+    return report
+
+
+def measure_scaling(dataset, world_sizes=DEFAULT_WORLD_SIZES, progress=None, **options):
+    """
+    Train the same number of epochs at several process counts and compare throughput.
+
+    Speedup is relative to the first (normally single-process) run, and
+    efficiency is speedup divided by the relative increase in processes.
+    Process counts beyond the available CPUs are still run; expect their
+    efficiency to collapse.
+
+    Args:
+        dataset (str): Prepared dataset.
+        world_sizes (iterable): Process counts to compare.
+        progress (callable): Called with each run's report as it finishes.
+        **options: Passed on to train_distributed (not output).
+    Returns:
+        dict: available_cpus and one row per process count.
+    """
+    runs = []
+    for world_size in world_sizes:
+        report = train_distributed(dataset, world_size, **options)
+        if progress is not None:
+            progress(report)
+        runs.append(report)
+    base = runs[0]
+    for run in runs:
+        speedup = run['images_per_second'] / base['images_per_second']
+        run['speedup'] = round(speedup, 2)
+        run['efficiency'] = round(speedup / (run['world_size'] / base['world_size']), 2)
+    return {'available_cpus': available_cpus(), 'runs': runs}
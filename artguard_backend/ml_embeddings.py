@@ -0,0 +1,440 @@
+"""
+Near-duplicate detection over past scans.
+
+Every completed scan's penultimate-layer embedding (computed by
+ml_batching.classify_image_bytes, from the same forward pass as the
+prediction when the served model is the embedding model) is L2-normalized and appended to an on-disk index, one per embedding model
+version:
+
+    embedding_index/
+        3f2a9c0d11b84e07/
+            index.json      embedding model version and dimension
+            vectors.f32     row-major float32 matrix, one row per scan
+            entries.jsonl   scan id, label, confidence, classifier version and norm per row
+            .lock           serializes appends across worker processes
+
+The matrix is memory-mapped, so every worker shares one page-cache copy, and
+a search is a single matrix-vector product (cosine similarity, since rows
+are normalized) followed by a partial sort for the top k. Rows are only ever
+appended; a reader sees the first min(vector rows, entry lines) rows, so a
+crash between the two writes leaves nothing half visible and the next
+append trims the leftovers. rebuild_embedding_index builds a fresh index
+from scan_history and swaps it in.
+
+Frozen TorchScript graphs and ONNX models only expose their logits, so
+embeddings come from ML_EMBEDDING_MODEL, or the served checkpoint when it is
+an eager or int8 .pth, or else MODEL_PATH (the checkpoint those exports are
+made from).
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from ml_inference import MODEL_PATH, default_model_path, embed_images, get_model_handle
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_INDEX_ENABLED = os.getenv('ML_EMBEDDING_INDEX_ENABLED', 'True') == 'True'
+EMBEDDING_INDEX_DIR = os.getenv(
+    'ML_EMBEDDING_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_index'))
+# Cosine similarity at or above which a scan reuses the earlier scan's result
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('ML_NEAR_DUPLICATE_THRESHOLD', '0.97'))
+# Empty picks the served checkpoint if it can expose embeddings, otherwise MODEL_PATH
+EMBEDDING_MODEL = os.getenv('ML_EMBEDDING_MODEL') or None
+
+VECTORS_FILE = 'vectors.f32'
+ENTRIES_FILE = 'entries.jsonl'
+INFO_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+
+def embedding_model_path():
+    """Checkpoint embeddings are computed with (see the module docstring)."""
+    if EMBEDDING_MODEL:
+        return EMBEDDING_MODEL
+    served = default_model_path()
+    if served.endswith(('.torchscript', '.onnx')):
+        return MODEL_PATH
+    return served
+
+
+def normalize(vectors):
+    """L2-normalize rows (or a single vector) as float32; zero vectors stay zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class _FileLock:
+    """Exclusive flock on a file; a no-op where fcntl is unavailable."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        try:
+            import fcntl
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        return self
+
+    def __exit__(self, *exc):
+        # Closing the file releases the lock
+        self._file.close()
+        self._file = None
+
+
+class EmbeddingIndex:
+    """
+    Append-only, memory-mapped matrix of normalized embeddings with cosine top-k search.
+
+    Safe to share between threads; several processes may append to the same
+    directory concurrently.
+    """
+
+    def __init__(self, directory, model_version=None):
+        self.directory = directory
+        self.model_version = model_version
+        self.dim = None
+        self._lock = threading.Lock()
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._entries = []
+        self._entries_offset = 0
+        # Classifier version of every row as a small int, so searches can filter without touching the entries
+        self._version_codes = {}
+        self._codes = np.empty(0, dtype=np.int32)
+        self._vectors_inode = None
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __len__(self):
+        self._refresh()
+        return len(self._matrix)
+
+    def _read_info(self):
+        try:
+            with open(self._path(INFO_FILE)) as f:
+                return json.load(f)
+        except OSError:
+            return None
+
+    def _refresh(self):
+        """Pick up rows appended by any process (or a rebuilt index swapped in) since the last call."""
+        with self._lock:
+            try:
+                stat = os.stat(self._path(VECTORS_FILE))
+            except OSError:
+                # Nothing recorded yet, or a rebuild over an empty scan history removed the index
+                self._matrix = np.empty((0, self.dim or 0), dtype=np.float32)
+                self._entries, self._entries_offset, self._vectors_inode = [], 0, None
+                self._version_codes, self._codes = {}, np.empty(0, dtype=np.int32)
+                return
+            if stat.st_ino != self._vectors_inode:
+                # First look, or rebuild_embedding_index replaced the files
+                info = self._read_info()
+                if info is None:
+                    return
+                self.dim = info['dim']
+                self.model_version = info.get('model_version', self.model_version)
+                self._vectors_inode = stat.st_ino
+                self._matrix = np.empty((0, self.dim), dtype=np.float32)
+                self._entries, self._entries_offset = [], 0
+                self._version_codes, self._codes = {}, np.empty(0, dtype=np.int32)
+            codes = []
+            try:
+                with open(self._path(ENTRIES_FILE), 'rb') as f:
+                    f.seek(self._entries_offset)
+                    for line in f:
+                        # A line without its newline is still being written
+                        if not line.endswith(b'\n'):
+                            break
+                        entry = json.loads(line)
+                        self._entries.append(entry)
+                        self._entries_offset += len(line)
+                        codes.append(self._version_codes.setdefault(entry.get('model_version'),
+                                                                    len(self._version_codes)))
+            except OSError:
+                pass
+            if codes:
+                self._codes = np.concatenate([self._codes, np.array(codes, dtype=np.int32)])
+            rows = min(stat.st_size // (4 * self.dim), len(self._entries))
+            if rows != len(self._matrix):
+                # Remapping only covers the new length; pages already read stay in the page cache
+                self._matrix = np.memmap(self._path(VECTORS_FILE), dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def add(self, entries, vectors):
+        """
+        Append rows to the index.
+
+        Args:
+            entries (list): One JSON-serializable dict per row, e.g.
+                {'scan_id', 'label', 'confidence', 'model_version'}.
+            vectors (array-like): Matching embeddings of shape (N, D); normalized
+                here, with each one's norm added to its entry so the raw
+                embedding can be recovered (see ml_feedback).
+        Raises:
+            ValueError: If the counts or the dimension do not match the index.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if len(entries) != len(vectors):
+            raise ValueError(f"Got {len(entries)} entries for {len(vectors)} vectors")
+        entries = [{**entry, 'norm': round(float(norm), 6)}
+                   for entry, norm in zip(entries, np.linalg.norm(vectors, axis=-1))]
+        vectors = normalize(vectors)
+        if not entries:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with _FileLock(self._path(LOCK_FILE)):
+            info = self._read_info()
+            if info is None:
+                info = {'model_version': self.model_version, 'dim': vectors.shape[1]}
+                with open(self._path(INFO_FILE), 'w') as f:
+                    json.dump(info, f)
+            if vectors.shape[1] != info['dim']:
+                raise ValueError(f"Embedding has {vectors.shape[1]} dimensions, the index has {info['dim']}")
+            self._refresh()
+            with open(self._path(VECTORS_FILE), 'ab') as vectors_file, \
+                    open(self._path(ENTRIES_FILE), 'ab') as entries_file:
+                # Drop what an interrupted append left behind (vectors without
+                # entries, a partial last line) so rows and entries line up again
+                with self._lock:
+                    row_bytes = 4 * info['dim']
+                    rows = min(os.fstat(vectors_file.fileno()).st_size // row_bytes, len(self._entries))
+                    vectors_file.truncate(rows * row_bytes)
+                    entries_file.truncate(self._entries_offset)
+                # Vectors first: readers only count rows that have an entry line too
+                vectors_file.write(vectors.tobytes())
+                vectors_file.flush()
+                os.fsync(vectors_file.fileno())
+                entries_file.write(b''.join(json.dumps(entry).encode() + b'\n' for entry in entries))
+                entries_file.flush()
+                os.fsync(entries_file.fileno())
+
+    def snapshot(self):
+        """(matrix, entries): the current normalized rows (memory-mapped) and their entry dicts."""
+        self._refresh()
+        with self._lock:
+            return self._matrix, self._entries[:len(self._matrix)]
+
+    def search(self, embedding, k=5, model_version=None):
+        """
+        Most similar rows to an embedding.
+
+        Args:
+            embedding (array-like): Query vector; normalized here.
+            k (int): Rows to return.
+            model_version (str): Only consider rows recorded with this classifier version.
+        Returns:
+            list: Up to k entry dicts, most similar first, each with its 'similarity'.
+        """
+        self._refresh()
+        with self._lock:
+            matrix, entries, codes = self._matrix, self._entries, self._codes
+            code = self._version_codes.get(model_version)
+        if not len(matrix) or (model_version is not None and code is None):
+            return []
+        start = time.perf_counter()
+        scores = matrix @ normalize(embedding)
+        rows = np.flatnonzero(codes[:len(scores)] == code) if model_version is not None else None
+        candidates = scores[rows] if rows is not None else scores
+        k = min(k, len(candidates))
+        # Partial sort: only the top k are ordered
+        top = np.argpartition(-candidates, k - 1)[:k]
+        top = top[np.argsort(-candidates[top])]
+        if rows is not None:
+            top = rows[top]
+        with self._lock:
+            self.searches += 1
+            self.search_seconds += time.perf_counter() - start
+        return [{**entries[i], 'similarity': round(float(scores[i]), 6)} for i in top]
+
+    def stats(self):
+        size = len(self)
+        return {
+            'path': self.directory,
+            'model_version': self.model_version,
+            'rows': size,
+            'dim': self.dim,
+            'bytes': size * 4 * (self.dim or 0),
+            'searches': self.searches,
+            'search_ms_mean': round(self.search_seconds / self.searches * 1000, 3) if self.searches else None,
+        }
+
+
+def index_directory(model_version, root=EMBEDDING_INDEX_DIR):
+    return os.path.join(root, model_version)
+
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def get_index(model_path=None):
+    """
+    Process-wide index for the embedding model, or None when ML_EMBEDDING_INDEX_ENABLED=False.
+
+    Raises:
+        RuntimeError: If the embedding model cannot be loaded.
+    """
+    if not EMBEDDING_INDEX_ENABLED:
+        return None
+    version = get_model_handle(model_path or embedding_model_path()).version
+    index = _indexes.get(version)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(version)
+            if index is None:
+                index = _indexes[version] = EmbeddingIndex(index_directory(version), version)
+    return index
+
+
+def index_stats():
+    """Stats of the indexes this process has opened (none are opened just to report)."""
+    return [index.stats() for index in list(_indexes.values())]
+
+
+def match_embedding(embedding, model_version, threshold=NEAR_DUPLICATE_THRESHOLD, model_path=None):
+    """
+    Look an image's embedding up in the index.
+
+    Args:
+        embedding (numpy.ndarray): The image's embedding from the embedding model.
+        model_version (str): Only scans classified by this version are reused.
+        threshold (float): Minimum cosine similarity.
+        model_path (str): Embedding model, defaults to embedding_model_path().
+    Returns:
+        dict or None: The closest earlier scan at or above the threshold; None
+        also when the index is disabled.
+    Raises:
+        RuntimeError: If the embedding model cannot be loaded.
+    """
+    index = get_index(model_path)
+    if index is None:
+        return None
+    matches = index.search(embedding, 1, model_version)
+    if matches and matches[0]['similarity'] >= threshold:
+        return matches[0]
+    return None
+
+
+def record_scan(scan_id, embedding, label, confidence, model_version):
+    """Append a completed scan to the index so later uploads can match it."""
+    index = get_index()
+    if index is not None:
+        index.add([{'scan_id': scan_id, 'label': label, 'confidence': confidence,
+                    'model_version': model_version}], [embedding])
+
+
+def copy_index(from_version, to_version, root=EMBEDDING_INDEX_DIR):
+    """
+    Copy one embedding model version's index to another that computes the
+    same embeddings (e.g. a checkpoint whose classifier head alone was refit).
+
+    Returns:
+        bool: False when there was nothing to copy or the target already exists.
+    """
+    source, target = index_directory(from_version, root), index_directory(to_version, root)
+    if not os.path.exists(os.path.join(source, VECTORS_FILE)) or os.path.exists(target):
+        return False
+    staging = f"{target}.copy-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        # Appends hold the lock, so vectors and entries are copied consistently
+        with _FileLock(os.path.join(source, LOCK_FILE)):
+            for name in (VECTORS_FILE, ENTRIES_FILE, INFO_FILE):
+                shutil.copy2(os.path.join(source, name), os.path.join(staging, name))
+        with open(os.path.join(staging, INFO_FILE)) as f:
+            info = json.load(f)
+        info['model_version'] = to_version
+        with open(os.path.join(staging, INFO_FILE), 'w') as f:
+            json.dump(info, f)
+        os.rename(staging, target)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return True
+
+
+def build_index(records, model_path=None, batch_size=16, root=EMBEDDING_INDEX_DIR, progress=None):
+    """
+    Build a new index from scratch and swap it in for the live one.
+
+    The index is written to a staging directory first, so workers keep
+    searching the old one until the rename; they pick up the new files on
+    their next search. Scans recorded by workers while the build runs are
+    lost with the old index; rerun the build to pick them up.
+
+    Args:
+        records (iterable): (entry, source) pairs; entry is the dict stored for
+            the row (scan_id, label, confidence, model_version) and source a
+            path or binary file-like object.
+        model_path (str): Embedding model, defaults to embedding_model_path().
+        batch_size (int): Images per forward pass.
+        progress (callable): Called with the number of records processed so far.
+    Returns:
+        dict: Rows indexed, unreadable images, embedding model version and seconds.
+    Raises:
+        RuntimeError: If the embedding model cannot be loaded or expose embeddings.
+    """
+    model_path = model_path or embedding_model_path()
+    version = get_model_handle(model_path).version
+    target = index_directory(version, root)
+    staging = f"{target}.rebuild-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    index = EmbeddingIndex(staging, version)
+    start = time.perf_counter()
+    pending = deque()
+
+    def sources():
+        for entry, source in records:
+            pending.append(entry)
+            yield source
+
+    entries, vectors = [], []
+    indexed = errors = 0
+    for result in embed_images(sources(), batch_size, model_path=model_path):
+        entry = pending.popleft()
+        if result['error'] is not None:
+            logger.warning(f"Skipping scan {entry.get('scan_id')}: {result['error']}")
+            errors += 1
+        else:
+            entries.append(entry)
+            vectors.append(result['embedding'])
+        if len(entries) >= 256:
+            index.add(entries, vectors)
+            indexed += len(entries)
+            entries, vectors = [], []
+        if progress is not None:
+            progress(indexed + len(entries) + errors)
+    if entries:
+        index.add(entries, vectors)
+        indexed += len(entries)
+
+    retired = f"{target}.old-{os.getpid()}"
+    if os.path.exists(target):
+        os.rename(target, retired)
+    if indexed:
+        os.rename(staging, target)
+    shutil.rmtree(retired, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
+    return {
+        'indexed': indexed,
+        'errors': errors,
+        'model_version': version,
+        'path': target,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
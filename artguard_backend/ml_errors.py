@@ -0,0 +1,16 @@
+"""
+Exceptions shared by the inference modules and their callers.
+
+Kept free of torch and the model code so web workers that only talk to the
+inference sidecar (ml_sidecar) can catch them without importing the ML stack.
+"""
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the engine is saturated and cannot accept more work."""
+    pass
+
+
+class UnknownVersionError(LookupError):
+    """Raised when a requested model version is not in the store."""
+    pass
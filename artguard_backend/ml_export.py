@@ -0,0 +1,185 @@
+"""
+Export the trained artwork classifier to deployment formats.
+
+Exported artifacts live next to artguard_cnn.pth and are loaded through
+ml_inference.load_model, so the serving code does not change. ml_inference
+serves an export as soon as it appears, so each one is written to a staging
+directory next to its destination, checked against the eager model from the
+written file, and only moved into place if it is within tolerance.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import torch
+
+from ml_inference import INPUT_SIZE, MODEL_PATH, ONNX_MODEL_PATH, TORCHSCRIPT_MODEL_PATH, load_model
+
+ONNX_OPSET = 18
+# Largest logit difference against the eager model an export may show
+TORCHSCRIPT_TOLERANCE = 1e-3
+ONNX_TOLERANCE = 1e-4
+
+
+def _example_input(batch_size=1):
+    return torch.randn(batch_size, 3, INPUT_SIZE, INPUT_SIZE)
+
+
+def max_abs_difference(reference, candidate, runs=3, batch_size=4):
+    """Largest absolute logit difference between two models over random inputs."""
+    worst = 0.0
+    with torch.no_grad():
+        for _ in range(runs):
+            batch = _example_input(batch_size)
+            worst = max(worst, float((reference(batch) - candidate(batch)).abs().max()))
+    return worst
+
+
+@contextmanager
+def _staging(output_path):
+    """
+    Path with output_path's file name inside a fresh directory next to it
+    (same filesystem, so _install is a rename). The directory is removed on
+    exit, taking a rejected export with it.
+    """
+    staging = tempfile.mkdtemp(prefix='.export-', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        yield os.path.join(staging, os.path.basename(output_path))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _install(staged_path, output_path):
+    """Move a checked export into place, external data files written next to it first."""
+    staging = os.path.dirname(staged_path)
+    target = os.path.dirname(os.path.abspath(output_path))
+    for entry in os.listdir(staging):
+        if entry != os.path.basename(staged_path):
+            os.replace(os.path.join(staging, entry), os.path.join(target, entry))
+    os.replace(staged_path, output_path)
+
+
+def _check_tolerance(max_abs_diff, tolerance):
+    if max_abs_diff > tolerance:
+        raise ValueError(f"Exported model differs from eager by {max_abs_diff:.2e} (tolerance {tolerance:.0e})")
+
+
+def export_torchscript(model_path=MODEL_PATH, output_path=TORCHSCRIPT_MODEL_PATH, tolerance=TORCHSCRIPT_TOLERANCE):
+    """
+    Trace and freeze the eval-mode model into a TorchScript archive.
+
+    Freezing inlines the weights as constants and folds batch norm into the
+    preceding convolutions. optimize_for_inference is not applied because
+    its MKL-DNN prepacked weights do not survive save/load.
+
+    Returns:
+        dict: Output path and the max logit difference against the eager model.
+    Raises:
+        ValueError: If the saved archive differs from the eager model by more
+            than tolerance; output_path is left untouched.
+        RuntimeError: If the model cannot be loaded.
+    """
+    model = load_model(model_path)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, _example_input())
+        frozen = torch.jit.freeze(traced)
+    with _staging(output_path) as staged_path:
+        frozen.save(staged_path)
+        max_abs_diff = max_abs_difference(model, torch.jit.load(staged_path, map_location='cpu'))
+        _check_tolerance(max_abs_diff, tolerance)
+        _install(staged_path, output_path)
+    return {
+        'output': output_path,
+        'max_abs_diff': max_abs_diff,
+    }
+
+
+def export_onnx(model_path=MODEL_PATH, output_path=ONNX_MODEL_PATH, opset=ONNX_OPSET, tolerance=ONNX_TOLERANCE):
+    """
+    Export the eval-mode model to ONNX with dynamic batch and spatial
+    dimensions (the cascade's first stage runs below INPUT_SIZE) and check
+    it against PyTorch with ONNX Runtime.
+
+    The graph is written under its final file name in a staging directory,
+    so an external data file it references by name (output_path + '.data')
+    stays valid when both are moved into place.
+
+    Returns:
+        dict: Output path and the max logit difference against the eager model.
+    Raises:
+        ValueError: If ONNX Runtime's logits differ from PyTorch's by more than
+            tolerance; output_path is left untouched.
+        RuntimeError: If the model cannot be loaded or onnxruntime is missing.
+    """
+    from ml_backends import OnnxRuntimeBackend
+    model = load_model(model_path)
+    with _staging(output_path) as staged_path:
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                _example_input(),
+                staged_path,
+                input_names=['input'],
+                output_names=['logits'],
+                dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'}, 'logits': {0: 'batch'}},
+                opset_version=opset,
+            )
+        backend = OnnxRuntimeBackend()
+        backend.load(staged_path)
+
+        def run_onnx(batch):
+            return torch.from_numpy(backend.session.run(None, {backend.input_name: batch.numpy()})[0])
+
+        max_abs_diff = max_abs_difference(model, run_onnx)
+        _check_tolerance(max_abs_diff, tolerance)
+        # A previous export's external data would otherwise be counted with this graph
+        stale_data = output_path + '.data'
+        if os.path.exists(stale_data) and not os.path.exists(staged_path + '.data'):
+            os.remove(stale_data)
+        _install(staged_path, output_path)
+    return {
+        'output': output_path,
+        'max_abs_diff': max_abs_diff,
+    }
+
+
+def measure_cold_start(loader, path):
+    """Seconds to load a model and complete its first forward pass."""
+    start = time.perf_counter()
+    model = loader(path)
+    with torch.no_grad():
+        model(_example_input())
+    return time.perf_counter() - start, model
+
+
+def measure_latency(model, runs=50, warmup=5, batch_size=1):
+    """Median and p95 per-image forward latency in milliseconds."""
+    batch = _example_input(batch_size)
+    timings = []
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(batch)
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(batch)
+            timings.append((time.perf_counter() - start) / batch_size)
+    timings.sort()
+    return {
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(0.95 * len(timings)))] * 1000, 3),
+    }
+
+
+def compare_with_eager(artifact_path, loader=load_model, model_path=MODEL_PATH, runs=50):
+    """Cold-start and per-image latency of an exported artifact against the eager model."""
+    report = {}
+    for name, path in (('eager', model_path), ('exported', artifact_path)):
+        cold_start, model = measure_cold_start(loader, path)
+        report[name] = {'cold_start_seconds': round(cold_start, 4), **measure_latency(model, runs)}
+    report['cold_start_speedup'] = round(
+        report['eager']['cold_start_seconds'] / report['exported']['cold_start_seconds'], 2)
+    report['latency_speedup'] = round(report['eager']['p50_ms'] / report['exported']['p50_ms'], 2)
+    return report
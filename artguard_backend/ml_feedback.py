@@ -0,0 +1,249 @@
+"""
+Cheap retraining of the classification head from user feedback.
+
+Every completed scan's embedding is already in the near-duplicate index
+(ml_embeddings): the input of the model's last Linear layer, stored
+normalized next to its norm. Feedback (scanner.views.submit_feedback)
+turns some scans into labelled examples: the corrected label when the user
+gave one, the predicted label when the user confirmed it. refit_head
+trains only that last layer on those examples, straight from the cached
+embeddings, so a refit takes seconds instead of a fine_tune_model run:
+
+    1. Feedback scans are split by a hash of their scan id into training
+       and holdout sets, so a scan never moves between the two across runs.
+    2. Scans without feedback are sampled as anchors, labelled with the
+       current head's own predictions, so the refit fixes mistakes without
+       drifting on everything else. Their total loss weight matches the
+       feedback's, so corrections are never outvoted by the old head.
+    3. The refit head starts from the current one and is trained full-batch.
+    4. The guard compares old and new heads on the holdout; a head that
+       does not match or beat the old one, or changes no prediction at all,
+       is not written.
+
+The backbone is untouched, so the published checkpoint computes the same
+embeddings: refit_head's command copies the index to the new version
+(ml_embeddings.copy_index), and the next refit has every scan again.
+"""
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from ml_embeddings import embedding_model_path, get_index
+from ml_inference import CLASS_LABELS, MODEL_PATH, load_model
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(MODEL_PATH), 'artguard_cnn_refit.pth')
+HOLDOUT_PERCENT = 20
+# Unlabelled anchor scans sampled per training example
+ANCHOR_RATIO = 4.0
+MIN_FEEDBACK = 20
+MIN_HOLDOUT = 5
+
+
+def feedback_targets(rows):
+    """
+    Label each scan's latest usable feedback points to.
+
+    Args:
+        rows (iterable): Feedback records oldest first, with scan_id, helpful,
+            predicted_label and corrected_label.
+    Returns:
+        dict: scan_id -> label name; scans whose latest verdict is a thumbs
+        down without a correction are left out.
+    """
+    latest = {}
+    for row in rows:
+        latest[row['scan_id']] = row
+    labels = set(CLASS_LABELS.values())
+    targets = {}
+    for scan_id, row in latest.items():
+        label = row.get('corrected_label') or (row.get('predicted_label') if row.get('helpful') else None)
+        if label in labels:
+            targets[scan_id] = label
+    return targets
+
+
+def in_holdout(scan_id, percent=HOLDOUT_PERCENT):
+    """Stable assignment of a scan to the holdout set."""
+    return int(hashlib.sha256(str(scan_id).encode()).hexdigest()[:8], 16) % 100 < percent
+
+
+def head_of(model):
+    """
+    (name, module) of the classification layer: the last Linear, whose input
+    is what the index stores.
+
+    Raises:
+        ValueError: If the model has no float Linear head (TorchScript, int8).
+    """
+    import torch
+
+    linears = [(name, module) for name, module in model.named_modules() if type(module).__name__ == 'Linear']
+    if not linears or not isinstance(linears[-1][1], torch.nn.Linear):
+        raise ValueError(f"{type(model).__name__} has no float Linear head; refit the fp32 .pth checkpoint")
+    return linears[-1]
+
+
+def fit_head(layer, features, labels, steps=300, lr=0.01, weight_decay=1e-4, weights=None):
+    """
+    Train a copy of a Linear layer full-batch with cross-entropy.
+
+    Args:
+        weights (torch.Tensor): Optional per-example loss weights.
+    Returns:
+        (torch.nn.Linear, float): The refit layer and its final training loss.
+    """
+    import copy
+
+    import torch
+    import torch.nn.functional as F
+
+    head = copy.deepcopy(layer).train()
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr, weight_decay=weight_decay)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        losses = F.cross_entropy(head(features), labels, reduction='none')
+        loss = losses.mean() if weights is None else (losses * weights).sum() / weights.sum()
+        loss.backward()
+        optimizer.step()
+    return head.eval(), loss.item()
+
+
+def _predict(layer, features):
+    import torch
+    with torch.no_grad():
+        return layer(features).argmax(dim=1)
+
+
+def write_checkpoint(base_path, layer_name, head, output):
+    """Copy a .pth checkpoint (plain or pruned) with the head's weights replaced."""
+    import torch
+
+    from ml_distillation import PRUNED_FORMAT
+
+    checkpoint = torch.load(base_path, map_location=torch.device('cpu'))
+    tagged = isinstance(checkpoint, dict) and 'format' in checkpoint
+    if tagged and checkpoint['format'] != PRUNED_FORMAT:
+        raise ValueError(f"Cannot refit a {checkpoint['format']} checkpoint; refit the fp32 .pth")
+    state = checkpoint['state_dict'] if tagged else checkpoint
+    state[f'{layer_name}.weight'] = head.weight.detach().clone()
+    state[f'{layer_name}.bias'] = head.bias.detach().clone()
+    torch.save(checkpoint, output)
+    return output
+
+
+def refit_head(feedback, base_path=None, output=DEFAULT_OUTPUT, holdout_percent=HOLDOUT_PERCENT,
+               anchor_ratio=ANCHOR_RATIO, steps=300, lr=0.01, min_feedback=MIN_FEEDBACK, min_holdout=MIN_HOLDOUT,
+               min_gain=0.0, seed=0):
+    """
+    Refit the classification head of the embedding model on feedback.
+
+    Args:
+        feedback (iterable): Feedback records oldest first (see feedback_targets).
+        base_path (str): Eager .pth to refit, defaults to embedding_model_path();
+            its index holds the cached embeddings.
+        output (str): Where to write the refit checkpoint when it passes the guard.
+        holdout_percent (int): Share of feedback scans kept for the guard.
+        anchor_ratio (float): Unlabelled scans sampled per training example.
+        steps (int), lr (float): Full-batch Adam steps and learning rate.
+        min_feedback (int): Training examples needed to refit at all.
+        min_holdout (int): Holdout examples needed to judge the refit.
+        min_gain (float): Holdout accuracy the new head must gain over the old.
+        seed (int): Anchor sampling seed.
+    Returns:
+        dict: Example counts, old and new holdout accuracy, the share of all
+        indexed scans whose prediction changes, seconds, and either the
+        written 'checkpoint' or the 'refused' reason.
+    Raises:
+        ValueError: If steps is below 1, the checkpoint cannot be refit or the
+            index is disabled.
+        RuntimeError: If the checkpoint cannot be loaded.
+    """
+    import torch
+
+    if steps < 1:
+        raise ValueError(f"steps must be at least 1, got {steps}")
+    start = time.perf_counter()
+    base_path = base_path or embedding_model_path()
+    model = load_model(base_path, mmap=False)
+    layer_name, layer = head_of(model)
+    index = get_index(base_path)
+    if index is None:
+        raise ValueError("The embedding index is disabled (ML_EMBEDDING_INDEX_ENABLED=False)")
+    matrix, entries = index.snapshot()
+    targets = feedback_targets(feedback)
+
+    # Latest row per scan; rows recorded before norms were kept cannot be used
+    rows, missing_norm = {}, 0
+    for row, entry in enumerate(entries):
+        if entry.get('norm') is None:
+            missing_norm += entry.get('scan_id') in targets
+            continue
+        rows[entry['scan_id']] = row
+    labelled = [scan_id for scan_id in targets if scan_id in rows]
+    train = [scan_id for scan_id in labelled if not in_holdout(scan_id, holdout_percent)]
+    holdout = [scan_id for scan_id in labelled if in_holdout(scan_id, holdout_percent)]
+    others = [row for scan_id, row in rows.items() if scan_id not in targets]
+    rng = np.random.default_rng(seed)
+    anchors = rng.permutation(others)[:int(len(train) * anchor_ratio)].tolist()
+    report = {
+        'base': base_path,
+        'base_version': index.model_version,
+        'head': layer_name,
+        'feedback_scans': len(targets),
+        'not_indexed': len(targets) - len(labelled),
+        'missing_norm': missing_norm,
+        'train': len(train),
+        'holdout': len(holdout),
+        'anchors': len(anchors),
+    }
+
+    def refuse(reason):
+        report['refused'] = reason
+        report['seconds'] = round(time.perf_counter() - start, 3)
+        return report
+
+    if len(train) < min_feedback:
+        return refuse(f"{len(train)} training examples, at least {min_feedback} needed")
+    if len(holdout) < min_holdout:
+        return refuse(f"{len(holdout)} holdout examples, at least {min_holdout} needed to judge the refit")
+
+    norms = np.array([entry.get('norm') or 0.0 for entry in entries], dtype=np.float32)
+
+    def features(selected):
+        selected = np.asarray(selected, dtype=np.int64)
+        return torch.from_numpy(np.asarray(matrix[selected]) * norms[selected, None])
+
+    label_index = {label: index for index, label in CLASS_LABELS.items()}
+    train_x = features([rows[scan_id] for scan_id in train] + anchors)
+    anchor_labels = _predict(layer, train_x[len(train):])
+    train_y = torch.cat([torch.tensor([label_index[targets[scan_id]] for scan_id in train]), anchor_labels])
+    weights = torch.ones(len(train_y))
+    if anchors:
+        weights[len(train):] = min(1.0, len(train) / len(anchors))
+    head, loss = fit_head(layer, train_x, train_y, steps, lr, weights=weights)
+
+    holdout_x = features([rows[scan_id] for scan_id in holdout])
+    holdout_y = torch.tensor([label_index[targets[scan_id]] for scan_id in holdout])
+    old_accuracy = (_predict(layer, holdout_x) == holdout_y).float().mean().item()
+    new_accuracy = (_predict(head, holdout_x) == holdout_y).float().mean().item()
+    everything = features(list(rows.values()))
+    report.update({
+        'train_loss': round(loss, 4),
+        'holdout_accuracy_before': round(old_accuracy, 4),
+        'holdout_accuracy_after': round(new_accuracy, 4),
+        'changed_predictions': round(
+            (_predict(layer, everything) != _predict(head, everything)).float().mean().item(), 4),
+    })
+    if new_accuracy < old_accuracy + min_gain:
+        return refuse(f"holdout accuracy {new_accuracy:.2%} against {old_accuracy:.2%} before "
+                      f"(needs a gain of at least {min_gain:.2%})")
+    if report['changed_predictions'] == 0:
+        return refuse("the refit head predicts the same label as the current one for every indexed scan")
+
+    report['checkpoint'] = write_checkpoint(base_path, layer_name, head, output)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
@@ -1,59 +1,569 @@
-import torch
-import torch.nn as nn
-from torchvision import transforms
 from PIL import Image
+import hashlib
+import io
+import logging
 import os
+import threading
+import time
+import zipfile
+
+from ml_metrics import ERRORS, STAGE_SECONDS
 
 MODEL_PATH = os.path.join(os.path.dirname(__file__), 'artguard_cnn.pth')
+QUANTIZED_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'artguard_cnn_int8.pth')
+TORCHSCRIPT_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'artguard_cnn.torchscript')
+ONNX_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'artguard_cnn.onnx')
+# Reference ResNet18 ArtworkClassifier (public/model/model_architecture.py)
+ARTWORK_CLASSIFIER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public', 'model')
+# "torch" serves the checkpoints below through PyTorch, "onnxruntime" serves ONNX_MODEL_PATH
+INFERENCE_BACKEND = os.getenv('ML_INFERENCE_BACKEND', 'torch')
+# "fp32" serves MODEL_PATH, "int8" serves the calibrated QUANTIZED_MODEL_PATH
+INFERENCE_MODE = os.getenv('ML_INFERENCE_MODE', 'fp32')
+# In fp32 mode, serve the frozen TorchScript export instead of the eager module when it is up to date
+USE_TORCHSCRIPT = os.getenv('ML_USE_TORCHSCRIPT', 'True') == 'True'
+# Map .pth weights from the page cache (shared by all workers) instead of copying them per process
+MMAP_WEIGHTS = os.getenv('ML_MMAP_WEIGHTS', 'True') == 'True'
+# Decode large images at reduced resolution when the format allows it
+FAST_DECODE = os.getenv('ML_FAST_DECODE', 'True') == 'True'
+# Resident models may hold at most this many MiB of weights (0 = unlimited); least recently used go first
+MODEL_MEMORY_BUDGET_MB = float(os.getenv('ML_MODEL_MEMORY_BUDGET_MB', '0'))
+# Threads decoding images for predict_artwork_types
+DECODE_WORKERS = int(os.getenv('ML_DECODE_WORKERS', str(min(8, os.cpu_count() or 1))))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
 CLASS_LABELS = {0: "Handmade", 1: "AI", 2: "Print"}
 
 # ImageNet normalization values
 IMAGENET_MEAN = [0.485, 0.456, 0.406]
 IMAGENET_STD = [0.229, 0.224, 0.225]
+INPUT_SIZE = 224
+WARMUP_RUNS = 3
+
+logger = logging.getLogger(__name__)
+
+DECODE_SECONDS = STAGE_SECONDS.labels('decode')
+FORWARD_SECONDS = STAGE_SECONDS.labels('forward')
+UNREADABLE_IMAGES = ERRORS.labels('unreadable')
+
+def default_model_path():
+    """
+    Checkpoint served by default: the active version of the model store
+    (ml_versions) if one was activated, otherwise the file selected by
+    ML_INFERENCE_BACKEND and ML_INFERENCE_MODE.
+    """
+    from ml_versions import get_store
+    active = get_store().active_model_path()
+    if active:
+        return active
+    if INFERENCE_BACKEND == 'onnxruntime':
+        return ONNX_MODEL_PATH
+    if INFERENCE_MODE == 'int8':
+        return QUANTIZED_MODEL_PATH
+    if USE_TORCHSCRIPT and os.path.exists(TORCHSCRIPT_MODEL_PATH):
+        if not os.path.exists(MODEL_PATH) or os.path.getmtime(TORCHSCRIPT_MODEL_PATH) >= os.path.getmtime(MODEL_PATH):
+            return TORCHSCRIPT_MODEL_PATH
+        logger.warning(f"{TORCHSCRIPT_MODEL_PATH} is older than {MODEL_PATH}, serving the eager model")
+    return MODEL_PATH
 
-def load_model():
+def load_model(model_path=MODEL_PATH, mmap=None):
+    """
+    Load a checkpoint for inference.
+
+    With mmap (default ML_MMAP_WEIGHTS), the tensors of a zip-format .pth are
+    memory-mapped from the file and used in place, so every worker on the
+    node shares one page-cache copy of the weights instead of holding a
+    private one.
+    """
+    import torch
+
+    mmap = MMAP_WEIGHTS if mmap is None else mmap
     try:
-        # Load the model architecture
-        from torchvision.models import mobilenet_v2
-        model = mobilenet_v2(num_classes=3)
+        # Frozen graphs written by ml_export.export_torchscript
+        if model_path.endswith('.torchscript'):
+            model = torch.jit.load(model_path, map_location=torch.device('cpu'))
+            model.eval()
+            return model
+        # Only checkpoints in torch.save's zip format can be mapped
+        mmap = mmap and zipfile.is_zipfile(model_path)
+        checkpoint = torch.load(model_path, map_location=torch.device('cpu'), mmap=mmap)
+        # Quantized checkpoints are tagged by ml_quantization.save_quantized_model
+        if isinstance(checkpoint, dict) and checkpoint.get('format') == 'int8':
+            from ml_quantization import load_quantized_state
+            return load_quantized_state(checkpoint)
+        # Pruned students are tagged by ml_distillation.save_student
+        if isinstance(checkpoint, dict) and checkpoint.get('format') == 'pruned':
+            from ml_distillation import load_pruned_state
+            return load_pruned_state(checkpoint)
+        # Load the model architecture; with mmap, on the meta device since
+        # every parameter is replaced by its mapped tensor anyway
+        with torch.device('meta' if mmap else 'cpu'):
+            if any(key.startswith('base_model.') for key in checkpoint):
+                model = _artwork_classifier()
+            else:
+                from torchvision.models import mobilenet_v2
+                model = mobilenet_v2(num_classes=3)
         # Load the trained weights
-        model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
+        model.load_state_dict(checkpoint, assign=mmap)
         model.eval()
         return model
     except Exception as e:
         raise RuntimeError(f"Failed to load model: {e}")
 
-def preprocess_image(image_path):
+def artwork_classifier_module():
+    """public/model/model_architecture.py: the ArtworkClassifier and its training loop."""
+    import sys
+    if ARTWORK_CLASSIFIER_DIR not in sys.path:
+        sys.path.insert(0, ARTWORK_CLASSIFIER_DIR)
+    import model_architecture
+    return model_architecture
+
+
+def _artwork_classifier():
+    """Untrained ResNet18 ArtworkClassifier, for loading its saved state_dict."""
+    return artwork_classifier_module().ArtworkClassifier(num_classes=len(CLASS_LABELS), pretrained=False)
+
+def find_images(directory):
+    """Sorted paths of all image files below a directory."""
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def checkpoint_version(model_path):
+    """Short content hash of a checkpoint (and its external data file, if any)."""
+    digest = hashlib.sha256()
+    for path in (model_path, model_path + '.data'):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def _current_rss_bytes():
+    """Resident set size of this process in bytes, or 0 if it cannot be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class ModelHandle:
+    """
+    Thread-safe handle around a model loaded by the ModelRegistry.
+
+    Forward passes are serialized with a per-model lock so that a single
+    backend instance can be shared by every request thread in the process.
+    """
+
+    def __init__(self, name, backend, load_seconds, rss_delta_bytes, version=None, manifest=None):
+        self.name = name
+        self.version = version
+        self.manifest = manifest or {}
+        labels = self.manifest.get('labels')
+        self.labels = dict(enumerate(labels)) if labels else CLASS_LABELS
+        self.input_size = self.manifest.get('input_size', INPUT_SIZE)
+        self.mean = self.manifest.get('mean', IMAGENET_MEAN)
+        self.std = self.manifest.get('std', IMAGENET_STD)
+        self.last_used = time.monotonic()
+        self.backend = backend
+        self.load_seconds = load_seconds
+        self.weight_bytes = backend.weight_bytes()
+        self.rss_delta_bytes = rss_delta_bytes
+        self.warmup_seconds = None
+        self._lock = threading.Lock()
+
+    def predict(self, batch):
+        """
+        Run a forward pass and return softmax probabilities.
+
+        Args:
+            batch (torch.Tensor): Float tensor of shape (N, 3, H, W).
+        Returns:
+            torch.Tensor: Probabilities of shape (N, num_classes).
+        """
+        with self._lock:
+            start = time.perf_counter()
+            probs = self.backend.predict_batch(batch)
+            FORWARD_SECONDS.observe(time.perf_counter() - start)
+            return probs
+
+    def embed(self, batch):
+        """
+        Run a forward pass and return the penultimate-layer features with the probabilities.
+
+        Returns:
+            (torch.Tensor, torch.Tensor): Features (N, D) and probabilities (N, num_classes).
+        Raises:
+            RuntimeError: If the backend cannot expose embeddings (frozen TorchScript, ONNX).
+        """
+        with self._lock:
+            start = time.perf_counter()
+            outputs = self.backend.embed_batch(batch)
+            FORWARD_SECONDS.observe(time.perf_counter() - start)
+            return outputs
+
+    def preprocessor(self, policy=None):
+        """Shared ml_preprocessing.Preprocessor matching this model's input size and normalization."""
+        from ml_preprocessing import STRETCH, get_preprocessor
+        return get_preprocessor(policy or STRETCH, self.input_size, self.mean, self.std)
+
+    def warm_up(self):
+        """Run dummy forward passes so the first real request is not slowed by lazy init."""
+        start = time.perf_counter()
+        with self._lock:
+            self.backend.warm_up(WARMUP_RUNS, self.input_size)
+        self.warmup_seconds = time.perf_counter() - start
+        return self.warmup_seconds
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'architecture': self.manifest.get('architecture'),
+            'input_size': self.input_size,
+            **self.backend.describe(),
+            'load_seconds': round(self.load_seconds, 4),
+            'warmup_seconds': round(self.warmup_seconds, 4) if self.warmup_seconds is not None else None,
+            'weight_bytes': self.weight_bytes,
+            'rss_delta_bytes': self.rss_delta_bytes,
+        }
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models, keyed by checkpoint path.
+
+    Each checkpoint is loaded and warmed up at most once per process; later
+    calls to get() return the same ModelHandle. The backend is chosen from
+    the checkpoint type (see ml_backends.backend_for_path).
+
+    With a memory budget, loading a model evicts the least recently used
+    others until the resident weights fit again; the default model is never
+    evicted. Eviction only drops the registry's reference, so requests that
+    already hold a handle finish normally.
+    """
+
+    def __init__(self, backend_factory=None, max_bytes=int(MODEL_MEMORY_BUDGET_MB * 2**20)):
+        self._backend_factory = backend_factory
+        self.max_bytes = max_bytes
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._evict_listeners = []
+
+    def get(self, model_path=None):
+        model_path = model_path or default_model_path()
+        handle = self._handles.get(model_path)
+        if handle is not None:
+            handle.last_used = time.monotonic()
+            return handle
+        evicted = []
+        with self._lock:
+            # Another thread may have finished loading while we waited
+            handle = self._handles.get(model_path)
+            if handle is None:
+                handle = self._load(model_path)
+                self._handles[model_path] = handle
+                evicted = self._evict_over_budget(keep={model_path, default_model_path()})
+        for path in evicted:
+            for listener in self._evict_listeners:
+                listener(path)
+        return handle
+
+    def _evict_over_budget(self, keep):
+        if not self.max_bytes:
+            return []
+        evicted = []
+        resident = sum(handle.weight_bytes for handle in self._handles.values())
+        candidates = sorted((path for path in self._handles if path not in keep),
+                            key=lambda path: self._handles[path].last_used)
+        for path in candidates:
+            if resident <= self.max_bytes:
+                break
+            handle = self._handles.pop(path)
+            resident -= handle.weight_bytes
+            evicted.append(path)
+            logger.info(f"Evicted model {handle.name} to stay within the memory budget")
+        return evicted
+
+    def add_evict_listener(self, listener):
+        """Call listener(model_path) whenever a model is evicted, e.g. to stop its batching engine."""
+        self._evict_listeners.append(listener)
+
+    def _load(self, model_path):
+        from ml_backends import backend_for_path
+        factory = self._backend_factory or backend_for_path
+        rss_before = _current_rss_bytes()
+        start = time.perf_counter()
+        backend = factory(model_path)
+        backend.load(model_path)
+        load_seconds = time.perf_counter() - start
+        from ml_versions import manifest_for
+        manifest = manifest_for(model_path)
+        name = os.path.basename(model_path)
+        handle = ModelHandle(
+            name=f"{manifest['version']}/{name}" if manifest else name,
+            backend=backend,
+            load_seconds=load_seconds,
+            rss_delta_bytes=max(_current_rss_bytes() - rss_before, 0),
+            version=manifest['version'] if manifest else checkpoint_version(model_path),
+            manifest=manifest,
+        )
+        handle.warm_up()
+        logger.info(
+            f"Loaded model {handle.name} with {backend.name} backend in {load_seconds:.3f}s "
+            f"(warm-up {handle.warmup_seconds:.3f}s, weights {handle.weight_bytes / 2**20:.1f} MiB, "
+            f"RSS +{handle.rss_delta_bytes / 2**20:.1f} MiB)"
+        )
+        return handle
+
+    def describe(self):
+        return [handle.describe() for handle in list(self._handles.values())]
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+
+
+registry = ModelRegistry()
+
+
+def get_model_handle(model_path=None):
+    """
+    Return the shared ModelHandle for a checkpoint, loading it on first use.
+    Defaults to the checkpoint selected by ML_INFERENCE_BACKEND and ML_INFERENCE_MODE.
+
+    Raises:
+        RuntimeError: If model loading fails.
+    """
+    # Size torch's thread pools for this worker before its first forward pass
+    from ml_threads import configure_threads
+    configure_threads()
+    return registry.get(model_path)
+
+
+def warm_up():
+    """Load and warm up the default model; intended to be called at process startup."""
+    return get_model_handle().describe()
+
+
+def decode_image(source, size=(INPUT_SIZE, INPUT_SIZE), fast=FAST_DECODE):
+    """
+    Decode an image to RGB, skipping pixels the final resize would throw away.
+
+    JPEGs are decoded with libjpeg DCT scaling (1/2, 1/4 or 1/8) through
+    Image.draft; other formats are box-reduced by an integer factor right after
+    decoding. Either way both sides stay at least as large as `size`, so the
+    subsequent Resize still sees enough pixels.
+
+    Args:
+        source: Path or binary file-like object.
+        size (tuple): (width, height) the caller will resize to.
+        fast (bool): Disable to force a full-resolution decode.
+    Returns:
+        PIL.Image.Image: RGB image.
+    Raises:
+        ValueError: If the image cannot be read.
+    """
+    start = time.perf_counter()
     try:
-        image = Image.open(image_path).convert('RGB')
+        image = Image.open(source)
+        if fast:
+            image.draft('RGB', size)
+        image = image.convert('RGB')
     except Exception as e:
+        UNREADABLE_IMAGES.inc()
         raise ValueError(f"Invalid image path or unreadable image: {e}")
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
-    ])
-    return transform(image).unsqueeze(0)  # Add batch dimension
+    if fast:
+        factor = min(image.width // size[0], image.height // size[1])
+        if factor >= 2:
+            image = image.reduce(factor)
+    DECODE_SECONDS.observe(time.perf_counter() - start)
+    return image
+
+def preprocess_image(image_path):
+    # Resize((224, 224)) + ToTensor + Normalize, fused by ml_preprocessing
+    from ml_preprocessing import get_preprocessor, STRETCH
+    return get_preprocessor(STRETCH).preprocess(image_path)  # Already has a batch dimension
+
+def _predict_with_handle(handle, source):
+    input_tensor = handle.preprocessor().preprocess(source)
+    probs = handle.predict(input_tensor)
+    confidence, pred_idx = probs.max(dim=1)
+    label = handle.labels.get(pred_idx.item(), "Unknown")
+    return label, confidence.item()
 
-def predict_artwork_type(image_path: str):
+def predict_artwork_type(image_path: str, model_path=None):
     """
     Predicts the artwork type from an image file.
     Args:
         image_path (str): Path to the image file.
+        model_path (str): Checkpoint to use, defaults to default_model_path().
     Returns:
         (label: str, confidence: float): Predicted label and confidence score.
     Raises:
         ValueError: If image loading fails.
         RuntimeError: If model loading fails.
     """
-    # Preprocess image
-    input_tensor = preprocess_image(image_path)
-    # Load model
-    model = load_model()
-    # Run inference
-    with torch.no_grad():
-        outputs = model(input_tensor)
-        probs = torch.softmax(outputs, dim=1)
-        confidence, pred_idx = torch.max(probs, dim=1)
-        label = CLASS_LABELS.get(pred_idx.item(), "Unknown")
-        return label, confidence.item()
+    from ml_cache import get_cache
+    from ml_metadata import get_metadata_stage
+    from ml_preprocessing import STRETCH
+    cache = get_cache()
+    stage = get_metadata_stage()
+    if cache is None and stage is None:
+        # Get the shared, already warmed-up model
+        return _predict_with_handle(get_model_handle(model_path), image_path)
+    try:
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+    except OSError as e:
+        raise ValueError(f"Invalid image path or unreadable image: {e}")
+    # Decisive metadata (generator parameters, C2PA, ...) answers without the model
+    answer = stage.classify(image_bytes) if stage is not None else None
+    if answer is not None:
+        return answer['label'], answer['confidence']
+    handle = get_model_handle(model_path)
+    if cache is None:
+        return _predict_with_handle(handle, io.BytesIO(image_bytes))
+    # Rescans of identical files are answered from the prediction cache
+    label, confidence, _ = cache.lookup_or_predict(
+        image_bytes, handle.version, STRETCH,
+        lambda: _predict_with_handle(handle, io.BytesIO(image_bytes)),
+    )
+    return label, confidence
+
+def _run_batches(handle, paths_or_buffers, batch_size, workers, timings, forward):
+    """
+    Decode sources on a thread pool and run them through `forward` in
+    batches, decoding the next batch while the current one runs. At most two
+    batches are held in memory at a time.
+
+    Yields:
+        (source, outputs, row, error): `outputs` is what forward returned for
+        the source's batch and `row` its index in it; unreadable sources get
+        outputs None and an error message.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import islice
+    from ml_preprocessing import Preprocessor, STRETCH
+
+    preprocessor = Preprocessor(STRETCH, handle.input_size, batch_size, mean=handle.mean, std=handle.std)
+    sources = iter(paths_or_buffers)
+    if timings is not None:
+        for stage in ('decode_seconds', 'decode_wait_seconds', 'forward_seconds'):
+            timings.setdefault(stage, 0.0)
+
+    def load(source):
+        start = time.perf_counter()
+        try:
+            return preprocessor.load(source), None, time.perf_counter() - start
+        except Exception as e:
+            return None, str(e), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers or DECODE_WORKERS) as executor:
+        def submit_next():
+            chunk = list(islice(sources, batch_size))
+            return chunk, [executor.submit(load, source) for source in chunk]
+
+        pending = submit_next()
+        while pending[0]:
+            chunk, futures = pending
+            # Start decoding the next batch before this one goes through the model
+            pending = submit_next()
+            waited = time.perf_counter()
+            loaded = [future.result() for future in futures]
+            started = time.perf_counter()
+            images = [image for image, _, _ in loaded if image is not None]
+            outputs = forward(preprocessor.fill(images)) if images else None
+            if timings is not None:
+                timings['decode_seconds'] += sum(seconds for _, _, seconds in loaded)
+                timings['decode_wait_seconds'] += started - waited
+                timings['forward_seconds'] += time.perf_counter() - started
+            row = 0
+            for source, (image, error, _) in zip(chunk, loaded):
+                if image is None:
+                    yield source, None, None, error
+                    continue
+                yield source, outputs, row, None
+                row += 1
+
+def predict_artwork_types(paths_or_buffers, batch_size=16, workers=None, model_path=None, timings=None):
+    """
+    Predicts artwork types for many images, yielding results in input order.
+
+    Images are decoded and resized by a thread pool; the next batch is
+    decoded while the current one runs through the model, and at most two
+    batches are held in memory at a time, so arbitrarily long inputs
+    (including generators) can be streamed.
+    Args:
+        paths_or_buffers (iterable): Image paths or binary file-like objects.
+        batch_size (int): Images per forward pass.
+        workers (int): Decode threads, defaults to ML_DECODE_WORKERS.
+        model_path (str): Checkpoint to use, defaults to default_model_path().
+        timings (dict): If given, accumulates 'decode_seconds' (summed over
+            threads), 'decode_wait_seconds' and 'forward_seconds' into it.
+    Yields:
+        dict: {'input', 'label', 'confidence', 'error'}; unreadable images get
+        label/confidence None and an error message instead of aborting the run.
+    Raises:
+        RuntimeError: If model loading fails.
+    """
+    handle = get_model_handle(model_path)
+    for source, probs, row, error in _run_batches(handle, paths_or_buffers, batch_size, workers, timings,
+                                                  handle.predict):
+        if error is not None:
+            yield {'input': source, 'label': None, 'confidence': None, 'error': error}
+            continue
+        confidence, pred_idx = probs[row].max(dim=0)
+        yield {
+            'input': source,
+            'label': handle.labels.get(pred_idx.item(), "Unknown"),
+            'confidence': confidence.item(),
+            'error': None,
+        }
+
+def embed_image(source, model_path=None):
+    """
+    Penultimate-layer embedding of one image, with the prediction from the same forward pass.
+    Args:
+        source: Path or binary file-like object.
+        model_path (str): Eager or int8 .pth checkpoint, defaults to default_model_path().
+    Returns:
+        (embedding: numpy.ndarray, label: str, confidence: float): float32 vector, not normalized.
+    Raises:
+        ValueError: If image loading fails.
+        RuntimeError: If model loading fails or the model cannot expose embeddings.
+    """
+    handle = get_model_handle(model_path)
+    features, probs = handle.embed(handle.preprocessor().preprocess(source))
+    confidence, pred_idx = probs.max(dim=1)
+    return features[0].numpy(), handle.labels.get(pred_idx.item(), "Unknown"), confidence.item()
+
+def embed_images(paths_or_buffers, batch_size=16, workers=None, model_path=None):
+    """
+    Batched embed_image for many images, yielding results in input order
+    (see predict_artwork_types for the decode pipeline).
+    Yields:
+        dict: {'input', 'embedding', 'label', 'confidence', 'error'}; unreadable
+        images get None values and an error message.
+    Raises:
+        RuntimeError: If model loading fails or the model cannot expose embeddings.
+    """
+    handle = get_model_handle(model_path)
+    for source, outputs, row, error in _run_batches(handle, paths_or_buffers, batch_size, workers, None,
+                                                    handle.embed):
+        if error is not None:
+            yield {'input': source, 'embedding': None, 'label': None, 'confidence': None, 'error': error}
+            continue
+        features, probs = outputs
+        confidence, pred_idx = probs[row].max(dim=0)
+        yield {
+            'input': source,
+            'embedding': features[row].numpy(),
+            'label': handle.labels.get(pred_idx.item(), "Unknown"),
+            'confidence': confidence.item(),
+            'error': None,
+        }
@@ -0,0 +1,473 @@
+"""
+Metadata fast path ahead of the classifier.
+
+Many files say where they came from: Stable Diffusion front ends write their
+generation parameters into PNG text chunks or the EXIF UserComment, hosted
+generators put their name in the EXIF Software tag or XMP CreatorTool,
+provenance manifests (C2PA) and IPTC metadata record a digital source type
+such as trainedAlgorithmicMedia, and flatbed scanners sign their output.
+
+inspect_metadata walks only the container structure of the upload: PNG chunks
+up to IEND, JPEG segments up to the first scan (SOS), WebP RIFF chunks.
+Pixel data (IDAT, the entropy-coded scan, VP8 frames) is skipped by its
+length field and never decoded. Every signal found becomes a piece of
+evidence with a label and a confidence; MetadataStage answers with the
+strongest one when it reaches ML_METADATA_THRESHOLD and the evidence does
+not disagree, and the scan never reaches preprocess_image or the model.
+
+Scanner EXIF is weaker evidence than a generator's own parameters: a scanned
+painting is still Handmade. It is reported below the default threshold and
+only answers when ML_METADATA_THRESHOLD is lowered to SCANNER_CONFIDENCE.
+
+measure_metadata (see the benchmark_metadata management command) reports
+how often the fast path fires on a folder, whether it agrees with the labels
+or the model, and what it costs next to full inference.
+"""
+
+import io
+import os
+import re
+import statistics
+import struct
+import threading
+import time
+import zlib
+
+from ml_metrics import STAGE_SECONDS
+
+METADATA_ENABLED = os.getenv('ML_METADATA_ENABLED', 'True') == 'True'
+METADATA_THRESHOLD = float(os.getenv('ML_METADATA_THRESHOLD', '0.95'))
+# Bumped whenever the rules change; fast-path answers report it as their model_version
+RULES_VERSION = 2
+METADATA_VERSION = f"metadata-v{RULES_VERSION}"
+
+GENERATOR_CONFIDENCE = 0.99
+SOFTWARE_CONFIDENCE = 0.97
+SOURCE_TYPE_CONFIDENCE = 0.97
+SCANNER_CONFIDENCE = 0.85
+# Edited with a generative tool (e.g. generative fill), not generated outright
+COMPOSITE_CONFIDENCE = 0.9
+
+# Text fields are only searched, so anything past this is dropped (and zTXt/iTXt bombs are capped)
+MAX_TEXT = 64 * 1024
+MAX_EVIDENCE_DETAIL = 200
+
+METADATA_SECONDS = STAGE_SECONDS.labels('metadata')
+
+GENERATOR_NAMES = re.compile(
+    r'midjourney|dall[-\s·.]?e|stable[-\s]?diffusion|novelai|comfyui|automatic1111|invokeai|fooocus|'
+    r'firefly|dreamstudio|leonardo\.ai|ideogram|nightcafe|craiyon|image creator|openai',
+    re.IGNORECASE)
+SCANNER_NAMES = re.compile(r'scan|silverfast|perfection\s*v?\d|opticbook|opticpro|plustek', re.IGNORECASE)
+SOURCE_TYPES = {
+    'trainedalgorithmicmedia': ('AI', SOURCE_TYPE_CONFIDENCE),
+    'compositewithtrainedalgorithmicmedia': ('AI', COMPOSITE_CONFIDENCE),
+    'print': ('Print', SOURCE_TYPE_CONFIDENCE),
+}
+SOURCE_TYPE_PATTERN = re.compile(rb'digitalsourcetype/([A-Za-z]+)')
+# CBOR-encoded claim keys: C2PA 1.x claim_generator (a text string) and 2.x
+# claim_generator_info (maps whose "name" is the generator). Ingredients and
+# actions can name a generative tool that only edited the image, so they are
+# never searched.
+CLAIM_GENERATOR_KEY = b'\x6fclaim_generator'
+CLAIM_GENERATOR_INFO_KEY = b'\x74claim_generator_info'
+CBOR_NAME_KEY = b'\x64name'
+# How far past claim_generator_info its first "name" may sit
+CLAIM_GENERATOR_INFO_SPAN = 64
+CREATOR_TOOL_PATTERN = re.compile(r'CreatorTool(?:="([^"]*)"|>([^<]*)<)')
+# PNG text keys written by generation front ends, with a check on the value
+GENERATOR_KEYS = {
+    'parameters': lambda value: 'Steps:' in value,  # AUTOMATIC1111, Forge, SD.Next
+    'prompt': lambda value: '"class_type"' in value,  # ComfyUI
+    'workflow': lambda value: '"nodes"' in value,  # ComfyUI
+    'invokeai_metadata': lambda value: True,
+    'sd-metadata': lambda value: True,  # InvokeAI 2.x
+    'dream': lambda value: True,  # InvokeAI 1.x
+}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_XMP_KEY = 'XML:com.adobe.xmp'
+JPEG_SOI = b'\xff\xd8'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+EXIF_HEADER = b'Exif\x00\x00'
+# EXIF tags read from IFD0 and the Exif sub-IFD
+SOFTWARE, MAKE, MODEL, IMAGE_DESCRIPTION, ARTIST, EXIF_IFD, USER_COMMENT = (
+    0x0131, 0x010F, 0x0110, 0x010E, 0x013B, 0x8769, 0x9286)
+
+
+class _Found:
+    """Raw metadata gathered from the container, before the rules run."""
+
+    def __init__(self, container):
+        self.container = container
+        self.text = {}  # PNG text chunk key -> value
+        self.exif = []
+        self.xmp = []
+        self.c2pa = []
+        self.comments = []
+
+
+def _latin1(data):
+    return bytes(data[:MAX_TEXT]).decode('latin-1')
+
+
+def _inflate(data):
+    try:
+        return zlib.decompressobj().decompress(bytes(data), MAX_TEXT)
+    except zlib.error:
+        return b''
+
+
+def _read_png(data, found):
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack_from('>I4s', data, offset)
+        body = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+        if kind == b'IEND':
+            break
+        if kind == b'tEXt':
+            key, _, value = bytes(body).partition(b'\x00')
+            found.text[_latin1(key)] = _latin1(value)
+        elif kind == b'zTXt':
+            key, _, rest = bytes(body).partition(b'\x00')
+            found.text[_latin1(key)] = _latin1(_inflate(rest[1:]))
+        elif kind == b'iTXt':
+            key, _, rest = bytes(body).partition(b'\x00')
+            compressed = rest[:1] == b'\x01'
+            _, _, rest = rest[2:].partition(b'\x00')  # language tag
+            _, _, text = rest.partition(b'\x00')  # translated keyword
+            text = _inflate(text) if compressed else text[:MAX_TEXT]
+            found.text[_latin1(key)] = text.decode('utf-8', 'replace')
+        elif kind == b'eXIf':
+            found.exif.append(bytes(body))
+        elif kind == b'caBX':
+            found.c2pa.append(bytes(body))
+
+
+def _read_jpeg(data, found):
+    offset = len(JPEG_SOI)
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            break
+        marker = data[offset + 1]
+        if marker == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        if marker in (0xDA, 0xD9):  # Start of scan: entropy-coded pixels follow
+            break
+        length = struct.unpack_from('>H', data, offset + 2)[0]
+        body = data[offset + 4:offset + 2 + length]
+        offset += 2 + length
+        if marker == 0xE1:
+            if body[:len(EXIF_HEADER)] == EXIF_HEADER:
+                found.exif.append(bytes(body))
+            elif body[:len(XMP_HEADER)] == XMP_HEADER:
+                found.xmp.append(bytes(body[len(XMP_HEADER):]).decode('utf-8', 'replace'))
+        elif marker == 0xEB:  # APP11: JUMBF boxes, where C2PA manifests live
+            found.c2pa.append(bytes(body))
+        elif marker == 0xFE:
+            found.comments.append(_latin1(body))
+
+
+def _read_webp(data, found):
+    offset = 12
+    while offset + 8 <= len(data):
+        kind, length = struct.unpack_from('<4sI', data, offset)
+        body = data[offset + 8:offset + 8 + length]
+        offset += 8 + length + (length & 1)
+        if kind == b'EXIF':
+            found.exif.append(bytes(body))
+        elif kind == b'XMP ':
+            found.xmp.append(bytes(body).decode('utf-8', 'replace'))
+        elif kind == b'C2PA':
+            found.c2pa.append(bytes(body))
+
+
+def _exif_fields(raw):
+    """Text of the EXIF tags the rules look at; unparseable EXIF yields nothing."""
+    from PIL import Image
+
+    exif = Image.Exif()
+    try:
+        exif.load(raw)
+        sub_ifd = exif.get_ifd(EXIF_IFD)
+    except Exception:
+        return {}
+    fields = {tag: exif.get(tag) for tag in (SOFTWARE, MAKE, MODEL, IMAGE_DESCRIPTION, ARTIST)}
+    comment = sub_ifd.get(USER_COMMENT)
+    if isinstance(comment, bytes):
+        # 8-byte character code, then the text; AUTOMATIC1111 writes UNICODE as UTF-16BE
+        code, body = comment[:8], comment[8:MAX_TEXT]
+        if code.startswith(b'UNICODE'):
+            comment = body.decode('utf-16-be' if body[:1] == b'\x00' else 'utf-16-le', 'replace')
+        else:
+            comment = body.decode('utf-8', 'replace')
+    fields[USER_COMMENT] = comment
+    return {tag: str(value).strip('\x00 ') for tag, value in fields.items() if value}
+
+
+def _evidence(label, confidence, source, detail):
+    return {'label': label, 'confidence': confidence, 'source': source, 'detail': detail[:MAX_EVIDENCE_DETAIL]}
+
+
+def _cbor_text(data, offset):
+    """The CBOR text string starting at data[offset], or '' if there is none."""
+    if offset >= len(data):
+        return ''
+    head = data[offset]
+    if 0x60 <= head <= 0x77:
+        length, start = head - 0x60, offset + 1
+    elif head == 0x78 and offset + 1 < len(data):
+        length, start = data[offset + 1], offset + 2
+    elif head == 0x79 and offset + 2 < len(data):
+        length, start = int.from_bytes(data[offset + 1:offset + 3], 'big'), offset + 3
+    else:
+        return ''
+    return data[start:start + min(length, MAX_TEXT)].decode('utf-8', 'replace')
+
+
+def _claim_generators(manifest):
+    """Names of the tools that produced C2PA claims, from claim_generator(_info) only."""
+    names = []
+    for match in re.finditer(re.escape(CLAIM_GENERATOR_KEY), manifest):
+        names.append(_cbor_text(manifest, match.end()))
+    for match in re.finditer(re.escape(CLAIM_GENERATOR_INFO_KEY), manifest):
+        name = manifest.find(CBOR_NAME_KEY, match.end(), match.end() + CLAIM_GENERATOR_INFO_SPAN)
+        if name != -1:
+            names.append(_cbor_text(manifest, name + len(CBOR_NAME_KEY)))
+    return [name for name in names if name]
+
+
+def _source_types(raw, source):
+    evidence = []
+    for match in set(SOURCE_TYPE_PATTERN.findall(raw)):
+        rule = SOURCE_TYPES.get(match.decode().lower())
+        if rule:
+            evidence.append(_evidence(rule[0], rule[1], source, f"digitalSourceType {match.decode()}"))
+    return evidence
+
+
+def _apply_rules(found):
+    evidence = []
+    for key, value in found.text.items():
+        check = GENERATOR_KEYS.get(key.lower())
+        if check is not None and check(value):
+            evidence.append(_evidence('AI', GENERATOR_CONFIDENCE, f"png:{key}", value))
+        elif key.lower() in ('software', 'comment', 'source') and GENERATOR_NAMES.search(value):
+            evidence.append(_evidence('AI', SOFTWARE_CONFIDENCE, f"png:{key}", value))
+    for raw in found.exif:
+        fields = _exif_fields(raw)
+        comment = ' '.join(fields.get(tag, '') for tag in (USER_COMMENT, IMAGE_DESCRIPTION))
+        if 'Steps:' in comment and 'Sampler:' in comment:
+            evidence.append(_evidence('AI', GENERATOR_CONFIDENCE, 'exif:UserComment', comment))
+        for tag, name in ((SOFTWARE, 'Software'), (ARTIST, 'Artist'), (MAKE, 'Make')):
+            if GENERATOR_NAMES.search(fields.get(tag, '')):
+                evidence.append(_evidence('AI', SOFTWARE_CONFIDENCE, f"exif:{name}", fields[tag]))
+        scanner = ' '.join(fields.get(tag, '') for tag in (SOFTWARE, MAKE, MODEL))
+        if SCANNER_NAMES.search(scanner):
+            evidence.append(_evidence('Print', SCANNER_CONFIDENCE, 'exif:scanner', scanner.strip()))
+    for xmp in found.xmp + [value for key, value in found.text.items() if key == PNG_XMP_KEY]:
+        evidence.extend(_source_types(xmp.encode(), 'xmp'))
+        for groups in CREATOR_TOOL_PATTERN.findall(xmp):
+            tool = groups[0] or groups[1]
+            if GENERATOR_NAMES.search(tool):
+                evidence.append(_evidence('AI', SOFTWARE_CONFIDENCE, 'xmp:CreatorTool', tool))
+    for comment in found.comments:
+        if GENERATOR_NAMES.search(comment) or ('Steps:' in comment and 'Sampler:' in comment):
+            evidence.append(_evidence('AI', SOFTWARE_CONFIDENCE, 'jpeg:comment', comment))
+    if found.c2pa:
+        manifest = b''.join(found.c2pa)
+        evidence.extend(_source_types(manifest, 'c2pa'))
+        for name in _claim_generators(manifest):
+            if GENERATOR_NAMES.search(name):
+                evidence.append(_evidence('AI', SOFTWARE_CONFIDENCE, 'c2pa:claim_generator', name))
+    return evidence
+
+
+def inspect_metadata(image_bytes):
+    """
+    Collect labelled evidence from an image's metadata without decoding pixels.
+
+    Args:
+        image_bytes (bytes): Raw file contents; PNG, JPEG and WebP are read,
+            other formats yield no evidence.
+    Returns:
+        dict: 'format' (png, jpeg, webp or None) and 'evidence', a list of
+        {'label', 'confidence', 'source', 'detail'} strongest first.
+    """
+    data = memoryview(image_bytes)
+    if data[:len(PNG_SIGNATURE)] == PNG_SIGNATURE:
+        found, reader = _Found('png'), _read_png
+    elif data[:2] == JPEG_SOI:
+        found, reader = _Found('jpeg'), _read_jpeg
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        found, reader = _Found('webp'), _read_webp
+    else:
+        return {'format': None, 'evidence': []}
+    try:
+        reader(data, found)
+    except (struct.error, IndexError):
+        # Truncated or malformed structure: keep what was read before it
+        pass
+    evidence = sorted(_apply_rules(found), key=lambda e: e['confidence'], reverse=True)
+    return {'format': found.container, 'evidence': evidence}
+
+
+def decide(evidence, threshold=METADATA_THRESHOLD):
+    """
+    The label decisive evidence points to, or None.
+
+    Evidence at or above `threshold` decides; if it names more than one
+    label (a generated image claiming a scanner, say) nothing is decided.
+    """
+    decisive = {e['label'] for e in evidence if e['confidence'] >= threshold}
+    if len(decisive) != 1:
+        return None
+    return decisive.pop()
+
+
+class MetadataStage:
+    """
+    Answers from metadata when it is decisive and counts how often it does.
+    """
+
+    def __init__(self, threshold=METADATA_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.images = 0
+        self.fired = 0
+        self.seconds = 0.0
+        self.by_label = {}
+
+    def classify(self, image_bytes):
+        """
+        Args:
+            image_bytes (bytes): Raw image file contents.
+        Returns:
+            dict: {'label', 'confidence', 'evidence'} when the metadata is
+            decisive, otherwise None and the image goes to the model.
+        """
+        start = time.perf_counter()
+        evidence = inspect_metadata(image_bytes)['evidence']
+        label = decide(evidence, self.threshold)
+        elapsed = time.perf_counter() - start
+        METADATA_SECONDS.observe(elapsed)
+        with self._lock:
+            self.images += 1
+            self.seconds += elapsed
+            if label is not None:
+                self.fired += 1
+                self.by_label[label] = self.by_label.get(label, 0) + 1
+        if label is None:
+            return None
+        return {
+            'label': label,
+            'confidence': max(e['confidence'] for e in evidence if e['label'] == label),
+            'evidence': [e for e in evidence if e['label'] == label],
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threshold': self.threshold,
+                'rules_version': RULES_VERSION,
+                'images': self.images,
+                'fired': self.fired,
+                'fire_rate': round(self.fired / self.images, 4) if self.images else 0,
+                'by_label': dict(self.by_label),
+                'ms_mean': round(self.seconds / self.images * 1000, 4) if self.images else None,
+            }
+
+
+_stage = None
+_stage_lock = threading.Lock()
+
+
+def get_metadata_stage():
+    """Process-wide MetadataStage, or None when ML_METADATA_ENABLED=False."""
+    global _stage
+    if not METADATA_ENABLED:
+        return None
+    if _stage is None:
+        with _stage_lock:
+            if _stage is None:
+                _stage = MetadataStage()
+    return _stage
+
+
+def measure_metadata(paths, labels=None, threshold=METADATA_THRESHOLD, model_path=None):
+    """
+    Run the metadata stage and full inference on every image and compare them.
+
+    Model latency covers decode, preprocessing and the forward pass at batch
+    size 1, i.e. everything the fast path skips; metadata latency covers
+    parsing the already read file.
+
+    Args:
+        paths (list): Image paths.
+        labels (list): Ground truth per path, or None to measure agreement
+            with the model instead.
+        threshold (float): Confidence at which evidence decides.
+        model_path (str): Checkpoint to compare with, defaults to the served one.
+    Returns:
+        dict: Fire rate, answers per label and evidence source, accuracy of the
+        fired answers, mean milliseconds of each path and of the combined
+        pipeline.
+    Raises:
+        ValueError: If no image could be read.
+        RuntimeError: If model loading fails.
+    """
+    from ml_inference import _predict_with_handle, get_model_handle
+
+    handle = get_model_handle(model_path)
+    stage = MetadataStage(threshold)
+    records, skipped, sources = [], 0, {}
+    for i, path in enumerate(paths):
+        try:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            start = time.perf_counter()
+            answer = stage.classify(image_bytes)
+            metadata_done = time.perf_counter()
+            model_label, _ = _predict_with_handle(handle, io.BytesIO(image_bytes))
+        except (OSError, ValueError):
+            skipped += 1
+            continue
+        records.append({
+            'truth': labels[i] if labels else model_label,
+            'answer': answer['label'] if answer else None,
+            'model_label': model_label,
+            'metadata_ms': (metadata_done - start) * 1000,
+            'model_ms': (time.perf_counter() - metadata_done) * 1000,
+        })
+        for e in (answer or {}).get('evidence', []):
+            sources[e['source']] = sources.get(e['source'], 0) + 1
+    if not records:
+        raise ValueError("None of the images could be read")
+
+    fired = [r for r in records if r['answer'] is not None]
+    by_label = {}
+    for r in fired:
+        by_label[r['answer']] = by_label.get(r['answer'], 0) + 1
+    return {
+        'images': len(records),
+        'skipped': skipped,
+        'threshold': threshold,
+        'accuracy_against': 'labels' if labels else 'model',
+        'fired': len(fired),
+        'fire_rate': round(len(fired) / len(records), 4),
+        'by_label': by_label,
+        'by_source': sources,
+        'fired_accuracy': round(sum(r['answer'] == r['truth'] for r in fired) / len(fired), 4) if fired else None,
+        'model_accuracy_on_fired': (
+            round(sum(r['model_label'] == r['truth'] for r in fired) / len(fired), 4) if fired else None),
+        'metadata_ms_mean': round(statistics.mean(r['metadata_ms'] for r in records), 4),
+        'model_ms_mean': round(statistics.mean(r['model_ms'] for r in records), 3),
+        # What a scan costs on average with the stage in front of the model
+        'pipeline_ms_mean': round(statistics.mean(
+            r['metadata_ms'] + (0 if r['answer'] else r['model_ms']) for r in records), 3),
+    }
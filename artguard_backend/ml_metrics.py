@@ -0,0 +1,384 @@
+"""
+Inference metrics in the Prometheus text exposition format.
+
+Every process records into its own small array of float64 slots, so that
+recording is an in-place add under a process-local lock (no syscalls, no I/O
+on the hot path). Without ML_METRICS_DIR the array is private memory and a
+scrape reports that process alone. The server sets ML_METRICS_DIR, and only
+the server: each of its workers then memory-maps a file there, and a scrape
+of /api/metrics/ (or /metrics on the FastAPI app) sums the files of all
+processes, so whichever worker answers reports the whole server. Management
+commands and benchmarks run without it and stay out of the server's totals.
+
+When a worker has exited, the next scrape folds its counters and histograms
+into the directory's retired totals and deletes its file, so exited workers
+keep counting without their files piling up, and a new process that reuses
+the PID starts from zero instead of truncating them. Gauges only include live
+processes. Empty ML_METRICS_DIR when the server (re)starts, e.g. in the
+process manager's start hook, so totals do not carry over between
+deployments.
+
+All metrics are declared in this module, which fixes the slot layout; files
+written with a different layout (an older release) are ignored.
+"""
+
+import ctypes
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv('ML_METRICS_ENABLED', 'True') == 'True'
+# Shared by the server's workers only; unset keeps metrics in each process's memory
+METRICS_DIR = os.getenv('ML_METRICS_DIR') or None
+
+# Seconds; spans a fast cache hit up to a slow upload
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+_metrics = []
+_slot_count = 0
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_name=None, label_values=(None,), slots_per_child=1):
+        global _slot_count
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self.label_values = tuple(label_values)
+        self.offset = _slot_count
+        self.slots_per_child = slots_per_child
+        _slot_count += slots_per_child * len(self.label_values)
+        _metrics.append(self)
+
+    def _child_offset(self, label_value):
+        try:
+            return self.offset + self.label_values.index(label_value) * self.slots_per_child
+        except ValueError:
+            raise ValueError(f"{self.name} has no {self.label_name}='{label_value}'")
+
+    def _labels(self, label_value, **extra):
+        pairs = ([(self.label_name, label_value)] if self.label_name else []) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class _CounterChild:
+    __slots__ = ('_slot',)
+
+    def __init__(self, slot):
+        self._slot = slot
+
+    def inc(self, amount=1):
+        slots = _slots if _slots is not None else _process_slots()
+        with _lock:
+            slots[self._slot] += amount
+
+
+class Counter(_Metric):
+    """Monotonic total, summed over all processes (dead ones included)."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_name=None, label_values=(None,)):
+        super().__init__(name, documentation, label_name, label_values)
+        self._children = {value: _CounterChild(self._child_offset(value)) for value in self.label_values}
+
+    def labels(self, label_value):
+        self._child_offset(label_value)
+        return self._children[label_value]
+
+    def inc(self, amount=1):
+        self._children[None].inc(amount)
+
+    def expose(self, totals, live):
+        lines = []
+        for value in self.label_values:
+            lines.append(f"{self.name}_total{self._labels(value)} {_number(totals[self._child_offset(value)])}")
+        return lines
+
+
+class _GaugeChild:
+    __slots__ = ('_slot',)
+
+    def __init__(self, slot):
+        self._slot = slot
+
+    def set(self, value):
+        slots = _slots if _slots is not None else _process_slots()
+        with _lock:
+            slots[self._slot] = value
+
+
+class Gauge(_Metric):
+    """Current value per process, summed over live processes."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, label_name=None, label_values=(None,)):
+        super().__init__(name, documentation, label_name, label_values)
+        self._children = {value: _GaugeChild(self._child_offset(value)) for value in self.label_values}
+
+    def labels(self, label_value):
+        self._child_offset(label_value)
+        return self._children[label_value]
+
+    def set(self, value):
+        self._children[None].set(value)
+
+    def expose(self, totals, live):
+        return [f"{self.name}{self._labels(value)} {_number(live[self._child_offset(value)])}"
+                for value in self.label_values]
+
+
+class _HistogramChild:
+    __slots__ = ('_buckets', '_offset', '_sum_slot')
+
+    def __init__(self, buckets, offset):
+        self._buckets = buckets
+        self._offset = offset
+        # One slot per bucket, one for +Inf, then the sum
+        self._sum_slot = offset + len(buckets) + 1
+
+    def observe(self, value):
+        index = bisect_left(self._buckets, value)
+        slots = _slots if _slots is not None else _process_slots()
+        with _lock:
+            slots[self._offset + index] += 1
+            slots[self._sum_slot] += value
+
+    @contextmanager
+    def time(self):
+        """Observe the seconds spent in the with-block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    """Bucketed distribution (Prometheus histogram), summed over all processes."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, label_name=None, label_values=(None,)):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_name, label_values, slots_per_child=len(self.buckets) + 2)
+        self._children = {
+            value: _HistogramChild(self.buckets, self._child_offset(value)) for value in self.label_values
+        }
+
+    def labels(self, label_value):
+        self._child_offset(label_value)
+        return self._children[label_value]
+
+    def observe(self, value):
+        self._children[None].observe(value)
+
+    def time(self):
+        return self._children[None].time()
+
+    def expose(self, totals, live):
+        lines = []
+        for value in self.label_values:
+            offset = self._child_offset(value)
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + (float('inf'),)):
+                cumulative += totals[offset + i]
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f"{self.name}_bucket{self._labels(value, le=le)} {_number(cumulative)}")
+            lines.append(f"{self.name}_sum{self._labels(value)} {_number(totals[offset + len(self.buckets) + 1])}")
+            lines.append(f"{self.name}_count{self._labels(value)} {_number(cumulative)}")
+        return lines
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# The metric catalog. Stages: decode (file to RGB), resize and normalize
+# (ml_preprocessing), queue_wait (time in the batching queue), forward (model
+# forward pass), upload (Cloudinary), supabase (scan_history insert),
+# near_duplicate (embedding lookup) and request (whole complete_scan / predict call).
+STAGES = (
+    'metadata', 'decode', 'resize', 'normalize', 'queue_wait', 'forward', 'near_duplicate', 'upload', 'supabase',
+    'request')
+STAGE_SECONDS = Histogram(
+    'artguard_stage_seconds', 'Seconds spent per inference stage', label_name='stage', label_values=STAGES)
+BATCH_SIZE = Histogram(
+    'artguard_batch_size', 'Images per forward pass of the batching engine', buckets=SIZE_BUCKETS)
+QUEUE_DEPTH = Histogram(
+    'artguard_queue_depth', 'Requests left in the batching queue after collecting a batch', buckets=SIZE_BUCKETS)
+QUEUE_DEPTH_CURRENT = Gauge(
+    'artguard_queue_depth_current', 'Requests in the batching queues of live workers at the last batch')
+PREDICTIONS = Counter(
+    'artguard_predictions', 'Predictions served, by where the answer came from',
+    label_name='source', label_values=('model', 'cache', 'near_duplicate', 'metadata'))
+ERRORS = Counter(
+    'artguard_inference_errors', 'Failed predictions by cause',
+    label_name='kind', label_values=('unreadable', 'queue_full', 'forward', 'timeout'))
+
+_LAYOUT = hashlib.sha256(
+    ';'.join(f"{m.name}:{m.kind}:{m.offset}:{m.slots_per_child}:{m.label_values}" for m in _metrics).encode()
+).hexdigest()[:12]
+# Gauges describe live processes, so they are never carried into the retired totals
+_GAUGE_SLOTS = frozenset(
+    slot for m in _metrics if m.kind == 'gauge'
+    for slot in range(m.offset, m.offset + m.slots_per_child * len(m.label_values)))
+# Counters and histograms of exited processes, outside the per-process name pattern
+_RETIRED = f"{_LAYOUT}.retired"
+
+_lock = threading.Lock()
+_slots = None
+_mapping = None
+
+
+def _process_file(pid):
+    return f"{_LAYOUT}-{pid}.metrics"
+
+
+@contextmanager
+def _directory_lock():
+    """Serialize retiring and summing files across the server's processes."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(os.path.join(METRICS_DIR, f"{_LAYOUT}.lock"), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_slots(name):
+    try:
+        with open(os.path.join(METRICS_DIR, name), 'rb') as f:
+            data = f.read(_slot_count * 8)
+    except OSError:
+        return None
+    if len(data) != _slot_count * 8:
+        return None
+    return list((ctypes.c_double * _slot_count).from_buffer_copy(data))
+
+
+def _retire(name):
+    """Fold an exited process's file into the retired totals and delete it; call under _directory_lock."""
+    values = _read_slots(name)
+    if values is not None:
+        retired = _read_slots(_RETIRED) or [0.0] * _slot_count
+        for i, value in enumerate(values):
+            if i not in _GAUGE_SLOTS:
+                retired[i] += value
+        staging = os.path.join(METRICS_DIR, f"{_RETIRED}.{os.getpid()}")
+        with open(staging, 'wb') as f:
+            f.write(bytes((ctypes.c_double * _slot_count)(*retired)))
+        os.replace(staging, os.path.join(METRICS_DIR, _RETIRED))
+    try:
+        os.remove(os.path.join(METRICS_DIR, name))
+    except FileNotFoundError:
+        pass
+
+
+def _open_slots():
+    """This process's slot array: a file in METRICS_DIR, or private memory if unset or not writable."""
+    global _mapping
+    size = _slot_count * 8
+    if METRICS_ENABLED and METRICS_DIR:
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            name = _process_file(os.getpid())
+            with _directory_lock():
+                # Left by an exited process that had this PID
+                if os.path.exists(os.path.join(METRICS_DIR, name)):
+                    _retire(name)
+            with open(os.path.join(METRICS_DIR, name), 'w+b') as f:
+                f.truncate(size)
+                _mapping = mmap.mmap(f.fileno(), size)
+            return (ctypes.c_double * _slot_count).from_buffer(_mapping)
+        except OSError as e:
+            logger.warning(f"Metrics are per-process only, {METRICS_DIR} is not writable: {e}")
+    _mapping = mmap.mmap(-1, size)
+    return (ctypes.c_double * _slot_count).from_buffer(_mapping)
+
+
+def _process_slots():
+    global _slots
+    if _slots is None:
+        with _lock:
+            if _slots is None:
+                _slots = _open_slots()
+    return _slots
+
+
+def _forget_after_fork():
+    # A forked child must not keep writing into its parent's file
+    global _slots, _mapping, _lock
+    _slots = _mapping = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_after_fork)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _aggregate():
+    """(totals over every process, exited ones included; totals over live processes only)."""
+    own = _process_slots()
+    with _lock:
+        totals = list(own)
+    live = list(totals)
+    own_name = _process_file(os.getpid())
+    if not (METRICS_ENABLED and METRICS_DIR and os.path.isdir(METRICS_DIR)):
+        return totals, live
+    with _directory_lock():
+        for name in os.listdir(METRICS_DIR):
+            if not name.startswith(_LAYOUT + '-') or name == own_name:
+                continue
+            if not _alive(int(name[len(_LAYOUT) + 1:].split('.')[0])):
+                _retire(name)
+                continue
+            values = _read_slots(name)
+            for i, value in enumerate(values or ()):
+                totals[i] += value
+                live[i] += value
+        for i, value in enumerate(_read_slots(_RETIRED) or ()):
+            totals[i] += value
+    return totals, live
+
+
+def exposition():
+    """All metrics, aggregated across processes, in the Prometheus text format (version 0.0.4)."""
+    totals, live = _aggregate()
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.expose(totals, live))
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
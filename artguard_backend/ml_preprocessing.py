@@ -0,0 +1,171 @@
+"""
+Vectorized preprocessing for the artwork classifier.
+
+Replaces the per-call torchvision Compose (ToTensor, Normalize, unsqueeze),
+which allocates several full-size float tensors per image. A Preprocessor
+converts uint8 pixels straight into normalized floats with one fused
+kernel, writing into a preallocated batch buffer that is reused between
+calls.
+
+Two resize policies are supported so every entry point shares one pipeline:
+
+    stretch      Resize((224, 224))                 (ml_inference, Django)
+    center_crop  Resize(256) + CenterCrop(224)      (public/fastapi_backend.py)
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from ml_inference import IMAGENET_MEAN, IMAGENET_STD, INPUT_SIZE, decode_image
+from ml_metrics import STAGE_SECONDS
+
+STRETCH = 'stretch'
+CENTER_CROP = 'center_crop'
+POLICIES = (STRETCH, CENTER_CROP)
+
+# Shorter side used by the center_crop policy before cropping to INPUT_SIZE
+CROP_RESIZE = 256
+# Write batches in NHWC order, which oneDNN convolutions prefer on CPU
+CHANNELS_LAST = os.getenv('ML_CHANNELS_LAST', 'False') == 'True'
+
+RESIZE_SECONDS = STAGE_SECONDS.labels('resize')
+NORMALIZE_SECONDS = STAGE_SECONDS.labels('normalize')
+
+
+def resize_for_policy(image, policy=STRETCH, size=INPUT_SIZE, crop_resize=CROP_RESIZE):
+    """
+    Resize a decoded RGB image to size x size, matching the torchvision
+    transforms each policy replaces.
+    """
+    start = time.perf_counter()
+    resized = _resize(image, policy, size, crop_resize)
+    RESIZE_SECONDS.observe(time.perf_counter() - start)
+    return resized
+
+
+def _resize(image, policy, size, crop_resize):
+    if policy == STRETCH:
+        return image.resize((size, size), Image.BILINEAR)
+    if policy == CENTER_CROP:
+        width, height = image.size
+        # Same rounding as transforms.Resize(int) and transforms.CenterCrop
+        if width <= height:
+            resized = (crop_resize, int(crop_resize * height / width))
+        else:
+            resized = (int(crop_resize * width / height), crop_resize)
+        image = image.resize(resized, Image.BILINEAR)
+        left = int(round((resized[0] - size) / 2.0))
+        top = int(round((resized[1] - size) / 2.0))
+        return image.crop((left, top, left + size, top + size))
+    raise ValueError(f"Unknown resize policy '{policy}', expected one of {POLICIES}")
+
+
+class Preprocessor:
+    """
+    Decodes, resizes and normalizes images into a reusable (N, 3, H, W) buffer.
+
+    Normalization is computed as pixel * (1 / (255 * std)) - mean / std in a
+    single addcmul per image, so no intermediate float tensors are created.
+    Buffers are per thread; a tensor returned by fill() is only valid until
+    the same thread calls fill() again.
+    """
+
+    def __init__(self, policy=STRETCH, size=INPUT_SIZE, max_batch_size=16, channels_last=CHANNELS_LAST,
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown resize policy '{policy}', expected one of {POLICIES}")
+        self.policy = policy
+        self.size = size
+        self.max_batch_size = max_batch_size
+        self.channels_last = channels_last
+        mean = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+        self._scale = 1.0 / (255.0 * std)
+        self._shift = -mean / std
+        self._local = threading.local()
+
+    @property
+    def decode_size(self):
+        """Smallest (width, height) the decoder may reduce an image to for this policy."""
+        if self.policy == CENTER_CROP:
+            return (CROP_RESIZE, CROP_RESIZE)
+        return (self.size, self.size)
+
+    def _buffers(self):
+        local = self._local
+        if getattr(local, 'batch', None) is None:
+            batch = torch.empty(self.max_batch_size, 3, self.size, self.size)
+            if self.channels_last:
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            local.batch = batch
+            local.pixels = np.empty((self.size, self.size, 3), dtype=np.uint8)
+            local.pixels_chw = torch.from_numpy(local.pixels).permute(2, 0, 1)
+        return local
+
+    def load(self, source):
+        """Decode and resize one image to a size x size RGB PIL image."""
+        return resize_for_policy(decode_image(source, self.decode_size), self.policy, self.size)
+
+    def write(self, image, out):
+        """Normalize a size x size RGB image into `out`, a (3, H, W) float tensor."""
+        start = time.perf_counter()
+        local = self._buffers()
+        np.copyto(local.pixels, np.asarray(image))
+        torch.addcmul(self._shift, local.pixels_chw, self._scale, out=out)
+        NORMALIZE_SECONDS.observe(time.perf_counter() - start)
+        return out
+
+    def fill(self, sources):
+        """
+        Preprocess up to max_batch_size images into the thread's reusable buffer.
+
+        Args:
+            sources: Paths, file-like objects or already loaded PIL images.
+        Returns:
+            torch.Tensor: View of shape (len(sources), 3, H, W) into the buffer.
+        Raises:
+            ValueError: If an image cannot be read or there are too many sources.
+        """
+        if len(sources) > self.max_batch_size:
+            raise ValueError(f"At most {self.max_batch_size} images per batch, got {len(sources)}")
+        batch = self._buffers().batch
+        for i, source in enumerate(sources):
+            image = source if isinstance(source, Image.Image) else self.load(source)
+            self.write(image, batch[i])
+        return batch[:len(sources)]
+
+    def preprocess(self, source):
+        """
+        Preprocess one image into a new (1, 3, H, W) tensor the caller may keep,
+        e.g. to hand to the batching engine.
+        """
+        return self.from_decoded(decode_image(source, self.decode_size))
+
+    def from_decoded(self, image):
+        """Like preprocess(), for an RGB image already returned by decode_image."""
+        out = torch.empty(1, 3, self.size, self.size)
+        if self.channels_last:
+            out = out.contiguous(memory_format=torch.channels_last)
+        self.write(resize_for_policy(image, self.policy, self.size), out[0])
+        return out
+
+
+_preprocessors = {}
+_preprocessors_lock = threading.Lock()
+
+
+def get_preprocessor(policy=STRETCH, size=INPUT_SIZE, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+    """Shared Preprocessor for a resize policy, input size and normalization."""
+    key = (policy, size, tuple(mean), tuple(std))
+    preprocessor = _preprocessors.get(key)
+    if preprocessor is None:
+        with _preprocessors_lock:
+            preprocessor = _preprocessors.get(key)
+            if preprocessor is None:
+                preprocessor = _preprocessors[key] = Preprocessor(policy, size, mean=mean, std=std)
+    return preprocessor
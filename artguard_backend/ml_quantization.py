@@ -0,0 +1,157 @@
+"""
+Post-training static int8 quantization for the MobileNetV2 artwork classifier.
+
+The fp32 checkpoint is loaded into torchvision's quantizable MobileNetV2,
+conv/bn/relu blocks are fused, activation ranges are calibrated over a folder
+of sample artworks and the model is converted to int8. The result is saved
+next to artguard_cnn.pth and is picked up by ml_inference.load_model.
+"""
+
+import logging
+import time
+
+import torch
+
+from ml_inference import (
+    CLASS_LABELS,
+    MODEL_PATH,
+    QUANTIZED_MODEL_PATH,
+    preprocess_image,
+)
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_FORMAT = 'int8'
+
+
+def default_backend():
+    """fbgemm on x86, qnnpack on ARM nodes."""
+    supported = torch.backends.quantized.supported_engines
+    return 'fbgemm' if 'fbgemm' in supported else 'qnnpack'
+
+
+def _prepared_model(backend, state_dict=None):
+    """Fused, observer-instrumented quantizable MobileNetV2 in eval mode."""
+    from torchvision.models.quantization import mobilenet_v2
+    torch.backends.quantized.engine = backend
+    model = mobilenet_v2(num_classes=3, quantize=False)
+    if state_dict is not None:
+        # Weights must go in before fusion folds batch norm into the convolutions
+        model.load_state_dict(state_dict)
+    model.eval()
+    model.fuse_model()
+    model.qconfig = torch.ao.quantization.get_default_qconfig(backend)
+    torch.ao.quantization.prepare(model, inplace=True)
+    return model
+
+
+def quantize_model(calibration_paths, model_path=MODEL_PATH, backend=None):
+    """
+    Calibrate and convert the fp32 checkpoint to int8.
+
+    Args:
+        calibration_paths (list): Image paths used to observe activation ranges.
+        model_path (str): fp32 state_dict to quantize.
+        backend (str): Quantized engine, defaults to default_backend().
+    Returns:
+        (model, stats): The converted model and a dict of calibration stats.
+    Raises:
+        ValueError: If no calibration image could be read.
+    """
+    backend = backend or default_backend()
+    state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+    model = _prepared_model(backend, state_dict)
+
+    used, skipped = 0, 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for path in calibration_paths:
+            try:
+                model(preprocess_image(path))
+                used += 1
+            except ValueError as e:
+                logger.warning(f"Skipping calibration image {path}: {e}")
+                skipped += 1
+    if used == 0:
+        raise ValueError("No readable calibration images")
+    torch.ao.quantization.convert(model, inplace=True)
+    return model, {
+        'backend': backend,
+        'calibration_images': used,
+        'skipped_images': skipped,
+        'calibration_seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def save_quantized_model(model, backend, path=QUANTIZED_MODEL_PATH):
+    torch.save({
+        'format': QUANTIZED_FORMAT,
+        'backend': backend,
+        'state_dict': model.state_dict(),
+    }, path)
+    return path
+
+
+def load_quantized_state(checkpoint):
+    """Rebuild an int8 model from a checkpoint written by save_quantized_model."""
+    backend = checkpoint.get('backend') or default_backend()
+    if backend not in torch.backends.quantized.supported_engines:
+        raise RuntimeError(f"Quantized engine '{backend}' is not supported on this CPU")
+    model = _prepared_model(backend)
+    torch.ao.quantization.convert(model, inplace=True)
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    return model
+
+
+def parity_report(fp32_model, int8_model, paths):
+    """
+    Compare int8 predictions against fp32 on a held-out set.
+
+    Returns:
+        dict: Label agreement, confidence drift and per-image latency for both models.
+    """
+    agree, compared = 0, 0
+    drifts = []
+    disagreements = []
+    fp32_seconds, int8_seconds = 0.0, 0.0
+    with torch.no_grad():
+        for path in paths:
+            try:
+                batch = preprocess_image(path)
+            except ValueError:
+                continue
+            start = time.perf_counter()
+            fp32_probs = torch.softmax(fp32_model(batch), dim=1)[0]
+            fp32_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            int8_probs = torch.softmax(int8_model(batch), dim=1)[0]
+            int8_seconds += time.perf_counter() - start
+
+            fp32_idx = int(fp32_probs.argmax())
+            int8_idx = int(int8_probs.argmax())
+            compared += 1
+            if fp32_idx == int8_idx:
+                agree += 1
+            else:
+                disagreements.append({
+                    'path': path,
+                    'fp32': CLASS_LABELS.get(fp32_idx, "Unknown"),
+                    'int8': CLASS_LABELS.get(int8_idx, "Unknown"),
+                })
+            # Drift of the confidence the fp32 model assigned to its own label
+            drifts.append(abs(float(fp32_probs[fp32_idx]) - float(int8_probs[fp32_idx])))
+
+    if compared == 0:
+        raise ValueError("No readable held-out images")
+    drifts.sort()
+    return {
+        'images': compared,
+        'label_agreement': round(agree / compared, 4),
+        'mean_confidence_drift': round(sum(drifts) / compared, 4),
+        'p95_confidence_drift': round(drifts[min(compared - 1, int(0.95 * compared))], 4),
+        'max_confidence_drift': round(drifts[-1], 4),
+        'fp32_ms_per_image': round(fp32_seconds / compared * 1000, 3),
+        'int8_ms_per_image': round(int8_seconds / compared * 1000, 3),
+        'disagreements': disagreements,
+    }
@@ -0,0 +1,489 @@
+"""
+Out-of-process inference over a Unix domain socket.
+
+With ML_SIDECAR_SOCKET set, web workers do not load torch or any model: the
+run_inference_server command hosts the ML stack (model registry, batching
+engine, prediction cache, cascade, metadata fast path, embedding index) in one
+process, and
+complete_scan talks to it through a pooled SidecarClient. Requests from every
+web worker meet in that process's batching engine, so they are batched
+together instead of per worker.
+
+Wire format (all integers big-endian). Every request is one frame:
+
+    header   2s magic b'AG', B protocol version, B kind, B policy, B flags,
+             H meta length, I payload length
+    meta     UTF-8: the pinned model version for IMAGE/PIXELS/VERSION, JSON for RECORD
+    payload  IMAGE:  the encoded image file, as uploaded
+             PIXELS: H width, H height, then width * height * 3 bytes of RGB
+                     already resized to the model's input size
+             RECORD: the scan's embedding, little-endian float32
+
+and gets one response frame on the same connection:
+
+    header   2s magic, B protocol version, B status, I meta length, I payload length
+    meta     UTF-8 JSON: the result, or {"error": message}
+    payload  IMAGE with FLAG_NEAR_DUPLICATE: the image's embedding (float32),
+             to send back with RECORD once the scan has an id
+
+Connections are persistent; a client may send any number of requests on one,
+one at a time.
+"""
+
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from ml_errors import QueueFullError, UnknownVersionError
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_SOCKET = os.getenv('ML_SIDECAR_SOCKET', '')
+SIDECAR_POOL_SIZE = int(os.getenv('ML_SIDECAR_POOL_SIZE', '8'))
+# Covers the server's own batching timeout (ML_BATCH_TIMEOUT_SECONDS) plus transfer
+SIDECAR_TIMEOUT = float(os.getenv('ML_SIDECAR_TIMEOUT_SECONDS', '15'))
+
+MAGIC = b'AG'
+PROTOCOL_VERSION = 1
+REQUEST_HEADER = struct.Struct('!2sBBBBHI')
+RESPONSE_HEADER = struct.Struct('!2sBBII')
+PIXELS_HEADER = struct.Struct('!HH')
+MAX_PAYLOAD_BYTES = 32 * 2**20
+
+# Request kinds
+IMAGE = 1
+PIXELS = 2
+RECORD = 3
+VERSION = 4
+STATUS = 5
+
+# Request flags
+FLAG_NEAR_DUPLICATE = 1
+
+# Response statuses
+OK = 0
+BAD_REQUEST = 1
+UNKNOWN_VERSION = 2
+QUEUE_FULL = 3
+ERROR = 4
+
+# Resize policies by wire code; the names are ml_preprocessing's
+POLICIES = ('stretch', 'center_crop')
+
+
+class ProtocolError(ConnectionError):
+    """Raised when the peer sends something that is not a valid frame."""
+    pass
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
+                raise EOFError("Connection closed")
+            raise ProtocolError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return bytes(buffer)
+
+
+def send_request(sock, kind, meta=b'', payload=b'', policy=0, flags=0):
+    header = REQUEST_HEADER.pack(MAGIC, PROTOCOL_VERSION, kind, policy, flags, len(meta), len(payload))
+    sock.sendall(header + meta)
+    if payload:
+        sock.sendall(payload)
+
+
+def read_request(sock):
+    """(kind, policy, flags, meta, payload) of the next request; EOFError at a clean end of stream."""
+    magic, version, kind, policy, flags, meta_length, payload_length = REQUEST_HEADER.unpack(
+        _recv_exact(sock, REQUEST_HEADER.size))
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Not an inference request (magic {magic!r}, version {version})")
+    if payload_length > MAX_PAYLOAD_BYTES:
+        raise ProtocolError(f"Payload of {payload_length} bytes exceeds {MAX_PAYLOAD_BYTES}")
+    meta = _recv_exact(sock, meta_length) if meta_length else b''
+    payload = _recv_exact(sock, payload_length) if payload_length else b''
+    return kind, policy, flags, meta, payload
+
+
+def send_response(sock, status, result, payload=b''):
+    meta = json.dumps(result).encode()
+    sock.sendall(RESPONSE_HEADER.pack(MAGIC, PROTOCOL_VERSION, status, len(meta), len(payload)) + meta)
+    if payload:
+        sock.sendall(payload)
+
+
+def read_response(sock):
+    """(status, result dict, payload) of the next response."""
+    magic, version, status, meta_length, payload_length = RESPONSE_HEADER.unpack(
+        _recv_exact(sock, RESPONSE_HEADER.size))
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Not an inference response (magic {magic!r}, version {version})")
+    result = json.loads(_recv_exact(sock, meta_length)) if meta_length else {}
+    payload = _recv_exact(sock, payload_length) if payload_length else b''
+    return status, result, payload
+
+
+# Server side. The ML modules are imported by the handlers, so importing this
+# module (as the web workers do for the client) never pulls in torch.
+
+def _classify_image(policy, flags, model_version, image_bytes):
+    from ml_batching import classify_image_bytes
+    from ml_metadata import METADATA_VERSION, get_metadata_stage
+    from ml_metrics import PREDICTIONS
+
+    stage = get_metadata_stage() if not model_version else None
+    answer = stage.classify(image_bytes) if stage is not None else None
+    if answer is not None:
+        PREDICTIONS.labels('metadata').inc()
+        return {
+            'label': answer['label'],
+            'confidence': answer['confidence'],
+            'cached': False,
+            'model_version': METADATA_VERSION,
+            'near_duplicate_of': None,
+            'similarity': None,
+            'evidence': answer['evidence'],
+        }, b''
+
+    result = classify_image_bytes(image_bytes, policy, model_version=model_version,
+                                  near_duplicate=bool(flags & FLAG_NEAR_DUPLICATE))
+    embedding = result.pop('embedding')
+    return result, embedding.astype('<f4').tobytes() if embedding is not None else b''
+
+
+def _classify_pixels(model_version, payload):
+    from ml_batching import predict_pixels
+
+    if len(payload) < PIXELS_HEADER.size:
+        raise ValueError("Pixel payload is missing its width and height")
+    width, height = PIXELS_HEADER.unpack_from(payload)
+    label, confidence, cached, used_version = predict_pixels(
+        payload[PIXELS_HEADER.size:], width, height, model_version=model_version)
+    return {'label': label, 'confidence': confidence, 'cached': cached, 'model_version': used_version}, b''
+
+
+def _record(meta, payload):
+    import numpy as np
+
+    from ml_embeddings import record_scan
+
+    entry = json.loads(meta)
+    record_scan(entry['scan_id'], np.frombuffer(payload, dtype='<f4'), entry['label'], entry['confidence'],
+                entry['model_version'])
+    return {}, b''
+
+
+def _check_version(model_version):
+    from ml_versions import get_store
+
+    get_store().manifest(model_version)
+    return {}, b''
+
+
+def _status():
+    from ml_batching import engine_stats
+    from ml_cache import get_cache
+    from ml_cascade import get_cascade
+    from ml_embeddings import embedding_model_path, index_stats
+    from ml_inference import registry
+    from ml_metadata import get_metadata_stage
+    from ml_threads import current_plan
+    from ml_versions import get_store
+
+    cache = get_cache()
+    cascade = get_cascade()
+    stage = get_metadata_stage()
+    plan = current_plan()
+    return {
+        'models': registry.describe(),
+        'active_version': get_store().active_version,
+        'batching': engine_stats(),
+        'embedding_batching': engine_stats(embedding_model_path(), embed=True),
+        'cache': cache.stats() if cache else None,
+        'cascade': cascade.stats() if cascade else None,
+        'metadata': stage.stats() if stage else None,
+        'threads': plan.describe() if plan else None,
+        'embedding_index': index_stats(),
+    }, b''
+
+
+def handle_request(kind, policy, flags, meta, payload):
+    """
+    Run one decoded request.
+
+    Returns:
+        (status: int, result: dict, payload: bytes)
+    """
+    try:
+        if policy >= len(POLICIES):
+            raise ValueError(f"Unknown resize policy code {policy}")
+        if kind == IMAGE:
+            result, out = _classify_image(POLICIES[policy], flags, meta.decode() or None, payload)
+        elif kind == PIXELS:
+            result, out = _classify_pixels(meta.decode() or None, payload)
+        elif kind == RECORD:
+            result, out = _record(meta, payload)
+        elif kind == VERSION:
+            result, out = _check_version(meta.decode())
+        elif kind == STATUS:
+            result, out = _status()
+        else:
+            raise ValueError(f"Unknown request kind {kind}")
+    except ValueError as e:
+        return BAD_REQUEST, {'error': str(e)}, b''
+    except UnknownVersionError as e:
+        return UNKNOWN_VERSION, {'error': str(e)}, b''
+    except QueueFullError as e:
+        return QUEUE_FULL, {'error': str(e)}, b''
+    except Exception as e:
+        logger.exception("Inference request failed")
+        return ERROR, {'error': f"{type(e).__name__}: {e}"}, b''
+    return OK, result, out
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = read_request(self.request)
+            except EOFError:
+                return
+            except ProtocolError as e:
+                logger.warning(f"Dropping inference client: {e}")
+                return
+            try:
+                send_response(self.request, *handle_request(*request))
+            except OSError:
+                # The client gave up (timeout) or went away
+                return
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the wire protocol on a Unix domain socket, one thread per client
+    connection. All threads share the process's batching engine, which is
+    where requests from different web workers are grouped into one forward pass.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=SIDECAR_SOCKET, mode=0o660):
+        if not socket_path:
+            raise ValueError("No socket path given and ML_SIDECAR_SOCKET is not set")
+        if os.path.exists(socket_path):
+            # A stale socket from a previous run; refuse to steal a live one
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError(f"An inference server is already listening on {socket_path}")
+            finally:
+                probe.close()
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, mode)
+        self.socket_path = socket_path
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+# Client side
+
+class _StaleConnection(Exception):
+    pass
+
+
+class SidecarClient:
+    """
+    Thread-safe client keeping up to pool_size connections to the inference
+    server open. A connection that turns out to be dead (the server restarted)
+    is replaced and the request retried once; requests are idempotent, so a
+    retry can at worst classify an image twice.
+    """
+
+    def __init__(self, socket_path=SIDECAR_SOCKET, pool_size=SIDECAR_POOL_SIZE, timeout=SIDECAR_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @contextmanager
+    def _connection(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise QueueFullError("All inference server connections are busy, try again later")
+        try:
+            try:
+                sock, reused = self._idle.get_nowait(), True
+            except queue.Empty:
+                sock, reused = self._connect(), False
+            try:
+                yield sock, reused
+            except BaseException:
+                # The stream may be mid-frame; never hand it out again
+                sock.close()
+                raise
+            self._idle.put(sock)
+        finally:
+            self._slots.release()
+
+    def _call(self, kind, meta=b'', payload=b'', policy=0, flags=0):
+        for attempt in range(2):
+            try:
+                with self._connection() as (sock, reused):
+                    try:
+                        send_request(sock, kind, meta, payload, policy, flags)
+                        status, result, out = read_response(sock)
+                    except (EOFError, ConnectionError) as e:
+                        if reused and attempt == 0:
+                            raise _StaleConnection() from e
+                        raise
+            except _StaleConnection:
+                # The server went away since the connection was pooled; the other
+                # idle connections date from before too
+                self.close()
+                continue
+            except socket.timeout:
+                raise TimeoutError(f"Inference server did not answer within {self.timeout}s")
+            except (EOFError, OSError) as e:
+                raise RuntimeError(f"Inference server at {self.socket_path} is unavailable: {e}")
+            break
+
+        if status == OK:
+            return result, out
+        message = result.get('error', 'Inference server error')
+        if status == BAD_REQUEST:
+            raise ValueError(message)
+        if status == UNKNOWN_VERSION:
+            raise UnknownVersionError(message)
+        if status == QUEUE_FULL:
+            raise QueueFullError(message)
+        raise RuntimeError(message)
+
+    def classify(self, image_bytes, policy='stretch', model_version=None, near_duplicate=False):
+        """
+        Classify an uploaded image in the inference server.
+
+        Args:
+            image_bytes (bytes): Raw image file contents.
+            policy (str): ml_preprocessing resize policy.
+            model_version (str): Published version to use instead of the active one.
+            near_duplicate (bool): Answer from the embedding index when an
+                earlier scan is a near-duplicate (ignored with model_version).
+        Returns:
+            dict: label, confidence, cached, model_version, near_duplicate_of,
+            similarity and embedding (bytes to pass to record_scan, or None);
+            answers from the metadata fast path also carry 'evidence'.
+        Raises:
+            ValueError: If the image cannot be read.
+            UnknownVersionError: If model_version was never published.
+            QueueFullError: If the server's engine or this client's pool is saturated.
+            TimeoutError: If the server does not answer in time.
+            RuntimeError: If the server is unreachable or inference fails.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown resize policy '{policy}', expected one of {POLICIES}")
+        result, embedding = self._call(
+            IMAGE, (model_version or '').encode(), image_bytes, POLICIES.index(policy),
+            FLAG_NEAR_DUPLICATE if near_duplicate else 0)
+        result['embedding'] = embedding or None
+        return result
+
+    def classify_pixels(self, pixels, width, height, model_version=None):
+        """
+        Classify RGB pixels already resized to the model's input size (see
+        status()['models'] for input_size), skipping decode and resize in the server.
+
+        Returns:
+            dict: label, confidence, cached and model_version.
+        """
+        payload = PIXELS_HEADER.pack(width, height) + bytes(pixels)
+        result, _ = self._call(PIXELS, (model_version or '').encode(), payload)
+        return result
+
+    def record_scan(self, scan_id, embedding, label, confidence, model_version):
+        """Add a completed scan to the server's embedding index; embedding as returned by classify()."""
+        meta = json.dumps({'scan_id': scan_id, 'label': label, 'confidence': confidence,
+                           'model_version': model_version}).encode()
+        self._call(RECORD, meta, embedding)
+
+    def check_version(self, model_version):
+        """Raise UnknownVersionError unless the server's store has this version."""
+        self._call(VERSION, model_version.encode())
+
+    def status(self):
+        """The server's inference diagnostics (models, batching, cache, cascade, metadata, threads, index)."""
+        result, _ = self._call(STATUS)
+        return result
+
+    def wait_until_ready(self, timeout=30.0):
+        """Poll status() until the server answers; raises the last error after timeout seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.status()
+            except (RuntimeError, TimeoutError):
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide SidecarClient, or None when ML_SIDECAR_SOCKET is not set (in-process inference)."""
+    global _client
+    if not SIDECAR_SOCKET:
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SidecarClient()
+    return _client
+
+
+def _forget_after_fork():
+    # Pooled sockets must not be shared between a parent and its forked children
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_after_fork)
@@ -0,0 +1,251 @@
+"""
+CPU thread planning for inference under multi-process servers.
+
+torch sizes its intra-op pool from the machine's core count. It ignores
+container CPU quotas and knows nothing about the other gunicorn/uvicorn
+workers on the node, so N workers end up with N x cores threads competing for
+the same cores. A ThreadPlan divides the CPUs this process may actually use
+(affinity mask, capped by the cgroup quota) evenly among ML_SERVER_WORKERS
+processes, sets torch's intra- and inter-op thread counts accordingly and,
+with ML_PIN_WORKERS, pins each worker to its own core set.
+
+Workers find their index for pinning by claiming a slot lock file, so no
+cooperation from the process manager is needed. Only worker processes (forked
+or spawned children) pin or claim a slot: a preloading master's affinity would
+be inherited by every worker it forks. A forked child also goes back to the
+affinity mask the process started with (e.g. set by taskset or numactl)
+before it plans.
+"""
+
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Server worker processes sharing this node's CPUs (gunicorn and uvicorn read WEB_CONCURRENCY too)
+SERVER_WORKERS = int(os.getenv('ML_SERVER_WORKERS', os.getenv('WEB_CONCURRENCY', '1')))
+# 0 divides the available CPUs evenly among the workers
+INTRAOP_THREADS = int(os.getenv('ML_INTRAOP_THREADS', '0'))
+INTEROP_THREADS = int(os.getenv('ML_INTEROP_THREADS', '1'))
+PIN_WORKERS = os.getenv('ML_PIN_WORKERS', 'False') == 'True'
+SLOT_DIR = os.getenv('ML_WORKER_SLOT_DIR', os.path.join(tempfile.gettempdir(), 'artguard-worker-slots'))
+
+
+def affinity_cpus():
+    """Sorted ids of the CPUs this process may run on."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_quota():
+    """
+    CPUs granted by the cgroup CPU quota (e.g. docker --cpus), or None if unlimited.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>", at the root inside containers
+    relative = ''
+    for line in (_read('/proc/self/cgroup') or '').splitlines():
+        if line.startswith('0::'):
+            relative = line[3:].lstrip('/')
+    for base in (os.path.join('/sys/fs/cgroup', relative), '/sys/fs/cgroup'):
+        value = _read(os.path.join(base, 'cpu.max'))
+        if value:
+            quota, _, period = value.partition(' ')
+            if quota == 'max':
+                return None
+            return int(quota) / int(period)
+    # cgroup v1: a quota of -1 means unlimited
+    quota = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+# What this process could run on before anything here pinned it; forked
+# children inherit it and restore it, keeping any operator-set mask
+_startup_cpus = affinity_cpus()
+
+
+def available_cpus():
+    """Number of CPUs this process can keep busy: affinity mask capped by the cgroup quota."""
+    cpus = len(affinity_cpus())
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+
+class ThreadPlan:
+    """How many torch threads one worker runs, and optionally which cores it is pinned to."""
+
+    def __init__(self, cpus, workers, intra_op, inter_op, worker_index=None, cores=None, quota=None):
+        self.cpus = cpus
+        self.workers = workers
+        self.intra_op = intra_op
+        self.inter_op = inter_op
+        self.worker_index = worker_index
+        self.cores = cores
+        self.quota = quota
+
+    def describe(self):
+        return {
+            'available_cpus': self.cpus,
+            'cgroup_quota': self.quota,
+            'workers': self.workers,
+            'worker_index': self.worker_index,
+            'intra_op_threads': self.intra_op,
+            'inter_op_threads': self.inter_op,
+            'pinned_cores': self.cores,
+        }
+
+    def __str__(self):
+        quota = f", cgroup quota {self.quota:g}" if self.quota is not None else ''
+        pinned = f", pinned to CPUs {','.join(map(str, self.cores))}" if self.cores else ''
+        worker = f"worker {self.worker_index}" if self.worker_index is not None else "this worker"
+        return (
+            f"{self.cpus} CPUs available{quota}, {self.workers} workers: {worker} runs "
+            f"{self.intra_op} intra-op / {self.inter_op} inter-op threads{pinned}"
+        )
+
+
+def plan_threads(workers=None, intra_op=None, inter_op=None, worker_index=None, pin=False):
+    """
+    Divide the available CPUs among `workers` processes.
+
+    Args:
+        workers (int): Processes sharing the CPUs, defaults to ML_SERVER_WORKERS.
+        intra_op (int): Override the even split (ML_INTRAOP_THREADS).
+        inter_op (int): Inter-op threads, defaults to ML_INTEROP_THREADS.
+        worker_index (int): This process's slot; required for pinning.
+        pin (bool): Pin the worker to cores [index * intra_op, (index + 1) * intra_op).
+    Returns:
+        ThreadPlan
+    """
+    cpus = available_cpus()
+    workers = max(1, workers or SERVER_WORKERS)
+    intra_op = max(1, intra_op or INTRAOP_THREADS or cpus // workers)
+    inter_op = max(1, inter_op or INTEROP_THREADS)
+    cores = None
+    if pin and worker_index is not None:
+        allowed = affinity_cpus()
+        cores = allowed[worker_index * intra_op:(worker_index + 1) * intra_op] or None
+        if cores is None:
+            logger.warning(f"No free cores to pin worker {worker_index} to, leaving it unpinned")
+    return ThreadPlan(cpus, workers, intra_op, inter_op, worker_index, cores, cgroup_cpu_quota())
+
+
+_forked = False
+
+
+def _is_worker_process():
+    """True in a forked or multiprocessing-spawned child, False in a master or standalone process."""
+    return _forked or multiprocessing.parent_process() is not None
+
+
+def apply_plan(plan):
+    """
+    Set torch's thread pools for this process, and its CPU affinity if the plan
+    is pinned and this is a worker process. A master is never pinned: everything
+    it forks would inherit the affinity.
+    """
+    import torch
+    torch.set_num_threads(plan.intra_op)
+    try:
+        torch.set_num_interop_threads(plan.inter_op)
+    except RuntimeError:
+        # Only possible before the first inter-op parallel work in the process
+        if torch.get_num_interop_threads() != plan.inter_op:
+            logger.warning(f"Inter-op pool already started with {torch.get_num_interop_threads()} threads")
+    if plan.cores:
+        if _is_worker_process():
+            os.sched_setaffinity(0, plan.cores)
+        else:
+            logger.warning("Not pinning the master process; its workers would inherit the affinity")
+
+
+_slot_file = None
+
+
+def _claim_slot(workers):
+    """Index of the first free worker slot, held until this process exits."""
+    global _slot_file
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    os.makedirs(SLOT_DIR, exist_ok=True)
+    for index in range(workers):
+        slot = open(os.path.join(SLOT_DIR, f"slot-{index}.lock"), 'w')
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot.close()
+            continue
+        _slot_file = slot
+        return index
+    return None
+
+
+def _forget_after_fork():
+    global _slot_file, _plan, _plan_pid, _forked
+    _forked = True
+    if _slot_file is not None:
+        # flock belongs to the open file, so closing the inherited descriptor leaves the parent's slot held
+        _slot_file.close()
+        _slot_file = None
+    _plan = _plan_pid = None
+    # Plan from the startup affinity mask, not whatever cores the parent was pinned to
+    if hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, _startup_cpus)
+        except OSError as e:
+            logger.warning(f"Could not reset CPU affinity after fork: {e}")
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_after_fork)
+
+_plan = None
+_plan_pid = None
+_plan_lock = threading.Lock()
+
+
+def configure_threads(plan=None):
+    """
+    Apply a thread plan once per process and log it.
+
+    Without an explicit plan, one is built from ML_SERVER_WORKERS,
+    ML_INTRAOP_THREADS, ML_INTEROP_THREADS and ML_PIN_WORKERS. Later calls in
+    the same process return the plan already in effect.
+    """
+    global _plan, _plan_pid
+    if _plan is not None and _plan_pid == os.getpid():
+        return _plan
+    with _plan_lock:
+        if _plan is None or _plan_pid != os.getpid():
+            if plan is None:
+                pin = PIN_WORKERS and _is_worker_process()
+                index = _claim_slot(max(1, SERVER_WORKERS)) if pin else None
+                plan = plan_threads(worker_index=index, pin=pin)
+            apply_plan(plan)
+            logger.info(f"Inference thread plan: {plan}")
+            _plan, _plan_pid = plan, os.getpid()
+    return _plan
+
+
+def current_plan():
+    """The plan applied in this process, or None if no model has been loaded yet."""
+    return _plan if _plan_pid == os.getpid() else None
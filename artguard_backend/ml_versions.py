@@ -0,0 +1,266 @@
+"""
+Versioned model store with hot-swap.
+
+Checkpoints are published into ML_MODEL_REGISTRY_DIR, one directory per
+version, next to a manifest describing how to serve them:
+
+    model_registry/
+        ACTIVE                  version id currently served (replaced atomically)
+        3f2a9c0d11b84e07/
+            manifest.json       version, architecture, labels, input_size, mean, std, ...
+            artguard_cnn.pth    checkpoint (.pth, .torchscript or .onnx [+ .data])
+
+Publishing and activating are atomic renames, so workers never see a
+half-written version. Each worker re-reads ACTIVE at most every
+ML_MODEL_REGISTRY_POLL_SECONDS; when it changes, the new version is loaded and
+warmed up in the background while requests keep going to the old one, then
+new requests switch over. Requests already running finish on the model they
+started with. Which versions stay resident is decided by the ModelRegistry's
+LRU memory budget (ML_MODEL_MEMORY_BUDGET_MB).
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+from ml_errors import UnknownVersionError
+from ml_inference import (
+    CLASS_LABELS, IMAGENET_MEAN, IMAGENET_STD, INPUT_SIZE, checkpoint_version, get_model_handle,
+)
+
+logger = logging.getLogger(__name__)
+
+MODEL_REGISTRY_DIR = os.getenv(
+    'ML_MODEL_REGISTRY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_registry'))
+POLL_SECONDS = float(os.getenv('ML_MODEL_REGISTRY_POLL_SECONDS', '2'))
+ACTIVE_FILE = 'ACTIVE'
+MANIFEST_FILE = 'manifest.json'
+
+
+def manifest_for(model_path):
+    """Manifest of the version a checkpoint belongs to, or None for checkpoints outside the store."""
+    path = os.path.join(os.path.dirname(os.path.abspath(model_path)), MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _architecture(backend):
+    model = getattr(backend, 'model', None)
+    if model is None:
+        return 'onnx'
+    if type(model).__name__ == 'RecursiveScriptModule':
+        return 'torchscript'
+    return type(model).__name__
+
+
+def _write_atomically(path, text):
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ModelStore:
+    """Published model versions on disk plus this worker's view of the active one."""
+
+    def __init__(self, root=MODEL_REGISTRY_DIR, poll_seconds=POLL_SECONDS):
+        self.root = root
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._next_poll = 0.0
+        self._active_version = None
+        self._active_path = None
+        self._loading = None
+        self._failed = None
+
+    def _version_dir(self, version):
+        return os.path.join(self.root, version)
+
+    def manifest(self, version):
+        """
+        Raises:
+            UnknownVersionError: If the version was never published.
+        """
+        path = os.path.join(self._version_dir(version), MANIFEST_FILE)
+        if os.sep in version or not os.path.exists(path):
+            raise UnknownVersionError(f"Unknown model version '{version}'")
+        with open(path) as f:
+            return json.load(f)
+
+    def model_path(self, version):
+        return os.path.join(self._version_dir(version), self.manifest(version)['checkpoint'])
+
+    def versions(self):
+        """Manifests of every published version, oldest first."""
+        if not os.path.isdir(self.root):
+            return []
+        manifests = []
+        for entry in os.listdir(self.root):
+            if os.path.exists(os.path.join(self.root, entry, MANIFEST_FILE)):
+                manifests.append(self.manifest(entry))
+        return sorted(manifests, key=lambda manifest: manifest['created_at'])
+
+    def read_active(self):
+        """Version named in the ACTIVE file, or None if nothing was activated yet."""
+        try:
+            with open(os.path.join(self.root, ACTIVE_FILE)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def publish(self, checkpoint_path, version=None, labels=None, input_size=INPUT_SIZE,
+                mean=IMAGENET_MEAN, std=IMAGENET_STD, notes=''):
+        """
+        Copy a checkpoint into the store after checking that it loads and
+        produces one output per label.
+
+        Args:
+            checkpoint_path (str): .pth, .torchscript or .onnx file.
+            version (str): Version id, defaults to the checkpoint's content hash.
+            labels (list): Class names by output index, defaults to CLASS_LABELS.
+            input_size (int): Square input resolution the model expects.
+            mean, std (list): Per-channel normalization.
+            notes (str): Free text kept in the manifest.
+        Returns:
+            dict: The manifest.
+        Raises:
+            RuntimeError: If the checkpoint cannot be loaded or does not match the labels.
+            ValueError: If the version id is already taken by a different checkpoint.
+        """
+        import torch
+        from ml_backends import backend_for_path
+
+        labels = list(labels or [CLASS_LABELS[i] for i in sorted(CLASS_LABELS)])
+        content = checkpoint_version(checkpoint_path)
+        version = version or content
+        if os.sep in version or version.startswith('.') or version == ACTIVE_FILE:
+            raise ValueError(f"Invalid version id '{version}'")
+        try:
+            existing = self.manifest(version)
+        except UnknownVersionError:
+            existing = None
+        if existing is not None:
+            if existing['sha256_prefix'] != content:
+                raise ValueError(f"Version '{version}' already exists with a different checkpoint")
+            return existing
+
+        backend = backend_for_path(checkpoint_path)
+        backend.load(checkpoint_path)
+        outputs = backend.predict_batch(torch.zeros(1, 3, input_size, input_size)).shape[1]
+        if outputs != len(labels):
+            raise RuntimeError(f"Model has {outputs} outputs but {len(labels)} labels were given")
+
+        manifest = {
+            'version': version,
+            # The original file name is kept: ONNX graphs reference their .data file by name
+            'checkpoint': os.path.basename(checkpoint_path),
+            'architecture': _architecture(backend),
+            'labels': labels,
+            'input_size': input_size,
+            'mean': list(mean),
+            'std': list(std),
+            'sha256_prefix': content,
+            'source': os.path.abspath(checkpoint_path),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'notes': notes,
+        }
+        os.makedirs(self.root, exist_ok=True)
+        staging = os.path.join(self.root, f".{version}.tmp-{os.getpid()}")
+        os.makedirs(staging)
+        try:
+            target = os.path.join(staging, manifest['checkpoint'])
+            shutil.copy2(checkpoint_path, target)
+            # ONNX graphs may keep their weights in an external data file
+            if os.path.exists(checkpoint_path + '.data'):
+                shutil.copy2(checkpoint_path + '.data', target + '.data')
+            with open(os.path.join(staging, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.rename(staging, self._version_dir(version))
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return manifest
+
+    def activate(self, version):
+        """Point every worker at a published version (they switch within one poll interval)."""
+        self.manifest(version)
+        _write_atomically(os.path.join(self.root, ACTIVE_FILE), version + '\n')
+
+    @property
+    def active_version(self):
+        return self._active_version
+
+    def active_model_path(self):
+        """Checkpoint this worker should serve, or None when no version is active."""
+        now = time.monotonic()
+        if now >= self._next_poll and self._lock.acquire(blocking=False):
+            try:
+                self._next_poll = now + self.poll_seconds
+                self._poll()
+            finally:
+                self._lock.release()
+        return self._active_path
+
+    def _poll(self):
+        version = self.read_active()
+        if version is None or version in (self._active_version, self._loading, self._failed):
+            return
+        try:
+            path = self.model_path(version)
+        except UnknownVersionError:
+            logger.error(f"{ACTIVE_FILE} names unknown model version '{version}', ignoring it")
+            self._failed = version
+            return
+        if self._active_version is None:
+            # Nothing is being served yet, so there is nothing to keep serving meanwhile
+            self._active_version, self._active_path = version, path
+            return
+        self._loading = version
+        threading.Thread(target=self._swap, args=(version, path), name='ml-model-swap', daemon=True).start()
+
+    def _swap(self, version, path):
+        try:
+            get_model_handle(path)
+        except RuntimeError as e:
+            logger.error(f"Could not load model version {version}, still serving {self._active_version}: {e}")
+            with self._lock:
+                self._loading, self._failed = None, version
+            return
+        with self._lock:
+            previous = self._active_version
+            self._active_version, self._active_path, self._loading = version, path, None
+        logger.info(f"Switched from model version {previous} to {version}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide ModelStore over ML_MODEL_REGISTRY_DIR."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ModelStore()
+    return _store
+
+
+def model_path_for_version(version=None):
+    """
+    Checkpoint for a pinned version, or None to use the default (active) model.
+
+    Raises:
+        UnknownVersionError: If the version was never published.
+    """
+    if not version:
+        return None
+    return get_store().model_path(version)
@@ -1,6 +1,22 @@
+import logging
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
 
 
 class ScannerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'scanner'
+
+    def ready(self):
+        # Load and warm up the classifier once per worker instead of on the first scan;
+        # with the inference sidecar the worker never loads models at all
+        from ml_sidecar import get_client
+        if getattr(settings, 'ML_PRELOAD_MODELS', False) and get_client() is None:
+            try:
+                import ml_inference
+                ml_inference.warm_up()
+            except Exception as e:
+                logger.error(f"Failed to preload inference model: {e}")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_versions import UnknownVersionError, get_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Switch the served model to a published version (or list published versions). "
+        "Workers pick the change up within ML_MODEL_REGISTRY_POLL_SECONDS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('version', nargs='?', help='Published version to serve')
+        parser.add_argument('--list', action='store_true', help='List published versions')
+
+    def handle(self, *args, **options):
+        store = get_store()
+        if options['list'] or not options['version']:
+            active = store.read_active()
+            versions = store.versions()
+            if not versions:
+                self.stdout.write(f"No versions published in {store.root}")
+            for manifest in versions:
+                marker = '*' if manifest['version'] == active else ' '
+                self.stdout.write(
+                    f"{marker} {manifest['version']:<20} {manifest['architecture']:<20} "
+                    f"{manifest['input_size']:>4}px  {manifest['created_at']}  {manifest['notes']}"
+                )
+            return
+        try:
+            store.activate(options['version'])
+        except UnknownVersionError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Activated version {options['version']}"))
@@ -0,0 +1,43 @@
+import json
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_benchmarks import benchmark_decode, generate_bucket_images
+from ml_inference import find_images
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare full-resolution and reduced-resolution image decoding: "
+        "decode time and peak RSS per image size bucket."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Benchmark these images instead of synthetic ones')
+        parser.add_argument('--format', default='JPEG', choices=['JPEG', 'PNG', 'WEBP', 'GIF'],
+                            help='Format of the synthetic images (default: JPEG)')
+        parser.add_argument('--repeats', type=int, default=5, help='Decodes per image (default: 5)')
+        parser.add_argument('--output', help='Write results as JSON to this path')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            if options['dir']:
+                paths = find_images(options['dir'])
+                if not paths:
+                    raise CommandError(f"No images found in {options['dir']}")
+            else:
+                paths = generate_bucket_images(tmp, options['format'])
+            results = benchmark_decode(paths, options['repeats'])
+
+        self.stdout.write(f"{'bucket':>8} {'images':>6} {'full ms':>9} {'fast ms':>9} {'speedup':>8} "
+                          f"{'full MiB':>9} {'fast MiB':>9}")
+        for bucket, stats in results.items():
+            self.stdout.write(
+                f"{bucket:>8} {stats['images']:>6} {stats['full']['mean_ms']:>9} {stats['fast']['mean_ms']:>9} "
+                f"{stats['speedup']:>8} {stats['full']['peak_rss_bytes'] / 2**20:>9.1f} "
+                f"{stats['fast']['peak_rss_bytes'] / 2**20:>9.1f}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
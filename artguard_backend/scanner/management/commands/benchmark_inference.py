@@ -0,0 +1,111 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_benchmarks import (
+    DEFAULT_BUDGETS, PIPELINE_FORMATS, PIPELINE_STAGES, SIZE_BUCKETS, THROUGHPUT_BATCH_SIZES, benchmark_pipeline,
+    compare_benchmarks,
+)
+
+
+def _csv(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the inference pipeline on synthetic artworks: decode, preprocess, forward and "
+        "end-to-end latency (p50/p95/p99) per format and size, batch-size throughput and peak memory. "
+        "With --compare, fail when any metric regresses past its budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', help='Checkpoint to benchmark (default: the serving model)')
+        parser.add_argument('--formats', default=','.join(PIPELINE_FORMATS),
+                            help=f"Comma-separated image formats (default: {','.join(PIPELINE_FORMATS)})")
+        parser.add_argument('--buckets', default=','.join(SIZE_BUCKETS),
+                            help=f"Comma-separated size buckets (default: {','.join(SIZE_BUCKETS)})")
+        parser.add_argument('--repeats', type=int, default=10, help='Timed runs per image and stage (default: 10)')
+        parser.add_argument('--batch-sizes', default=','.join(map(str, THROUGHPUT_BATCH_SIZES)),
+                            help='Comma-separated batch sizes for the throughput curve')
+        parser.add_argument('--output', help='Write results as JSON to this path')
+        parser.add_argument('--results', help='Report (and compare) saved results instead of running the benchmark')
+        parser.add_argument('--compare', metavar='BASELINE', help='Baseline results JSON to compare against')
+        parser.add_argument('--budget', type=float, default=DEFAULT_BUDGETS['default'],
+                            help='Allowed relative regression for every metric (default: 0.10)')
+        parser.add_argument('--budgets', help=(
+            'JSON file of per-category budgets overriding --budget, keyed by stage '
+            f"({', '.join(PIPELINE_STAGES)}), 'throughput' or 'memory'"))
+        parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                            help='Latency changes below this never count as regressions (default: 0.5)')
+
+    def handle(self, *args, **options):
+        if options['results']:
+            with open(options['results']) as f:
+                results = json.load(f)
+        else:
+            formats = [fmt.upper() for fmt in _csv(options['formats'])]
+            unknown = set(formats) - set(PIPELINE_FORMATS)
+            if unknown:
+                raise CommandError(f"Unsupported formats {sorted(unknown)}, expected some of {PIPELINE_FORMATS}")
+            try:
+                results = benchmark_pipeline(
+                    options['model'], formats, _csv(options['buckets']), options['repeats'],
+                    [int(size) for size in _csv(options['batch_sizes'])],
+                )
+            except (ValueError, RuntimeError) as e:
+                raise CommandError(f"Benchmark failed: {e}")
+            if options['output']:
+                with open(options['output'], 'w') as f:
+                    json.dump(results, f, indent=2)
+
+        self._print_results(results)
+        if options['compare']:
+            self._compare(results, options)
+
+    def _print_results(self, results):
+        environment = results['environment']
+        self.stdout.write(
+            f"{environment['model']} ({environment['backend']}), torch {environment['torch']}, "
+            f"{environment['available_cpus']} CPUs, {results['repeats']} runs per image"
+        )
+        self.stdout.write(f"{'case':>12} {'stage':>11} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for case, stages in [*results['latency'].items(), ('all', results['stages'])]:
+            for stage, summary in stages.items():
+                self.stdout.write(
+                    f"{case:>12} {stage:>11} {summary['p50_ms']:>9} {summary['p95_ms']:>9} {summary['p99_ms']:>9}"
+                )
+        self.stdout.write(f"{'batch':>6} {'forward img/s':>14} {'batch p50 ms':>13} {'pipeline img/s':>15}")
+        for point in results['throughput']:
+            self.stdout.write(
+                f"{point['batch_size']:>6} {point['forward_images_per_second']:>14} "
+                f"{point['forward_batch_p50_ms']:>13} {point['pipeline_images_per_second']:>15}"
+            )
+        memory = results['memory']
+        requests = ', '.join(f"{fmt} {value / 2**20:.1f}" for fmt, value in memory['request_peak_rss_bytes'].items())
+        self.stdout.write(
+            f"Weights {memory['model_weight_bytes'] / 2**20:.1f} MiB, process peak RSS "
+            f"{memory['process_peak_rss_bytes'] / 2**20:.1f} MiB, peak per request (MiB): {requests}"
+        )
+
+    def _compare(self, results, options):
+        budgets = {'default': options['budget']}
+        if options['budgets']:
+            with open(options['budgets']) as f:
+                budgets.update(json.load(f))
+        with open(options['compare']) as f:
+            baseline = json.load(f)
+        try:
+            rows = compare_benchmarks(baseline, results, budgets, options['min_delta_ms'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        regressions = [row for row in rows if row['regressed']]
+        for row in regressions:
+            self.stdout.write(self.style.ERROR(
+                f"{row['metric']}: {row['baseline']} -> {row['current']} "
+                f"({row['change']:+.1%}, budget {row['budget']:.0%})"
+            ))
+        if regressions:
+            raise CommandError(f"{len(regressions)} of {len(rows)} metrics regressed past their budget")
+        self.stdout.write(self.style.SUCCESS(f"All {len(rows)} metrics within budget of {options['compare']}"))
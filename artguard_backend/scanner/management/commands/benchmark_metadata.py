@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_cascade import labelled_images
+from ml_metadata import METADATA_THRESHOLD, SCANNER_CONFIDENCE, measure_metadata
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the metadata fast path and full inference over a folder and report how often the metadata "
+        "decides the label, how often it is right, and what it costs next to decoding and running the "
+        "model. Subfolders named AI/, Handmade/ and Print/ are used as ground truth; otherwise answers "
+        "are compared with the model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Folder of sample artworks')
+        parser.add_argument('--threshold', type=float, default=METADATA_THRESHOLD,
+                            help=f'Evidence confidence that decides (default: {METADATA_THRESHOLD}; '
+                                 f'{SCANNER_CONFIDENCE} lets scanner EXIF answer Print)')
+        parser.add_argument('--model', help='Checkpoint to compare with (default: the serving model)')
+        parser.add_argument('--report', help='Write the summary as JSON to this path')
+
+    def handle(self, *args, **options):
+        paths, labels = labelled_images(options['directory'])
+        if not paths:
+            raise CommandError(f"No images found in {options['directory']}")
+        try:
+            report = measure_metadata(paths, labels, options['threshold'], options['model'])
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Metadata benchmark failed: {e}")
+
+        self.stdout.write(
+            f"{report['images']} images ({report['skipped']} unreadable), accuracy against "
+            f"{report['accuracy_against']}, threshold {report['threshold']}\n"
+            f"Fast path fired on {report['fired']} ({report['fire_rate'] * 100:.1f}%)"
+        )
+        if report['fired']:
+            labels_line = ', '.join(f"{label} {count}" for label, count in sorted(report['by_label'].items()))
+            sources_line = ', '.join(f"{source} {count}" for source, count in sorted(report['by_source'].items()))
+            self.stdout.write(
+                f"  answers: {labels_line}\n  evidence: {sources_line}\n"
+                f"  accuracy on those images: metadata {report['fired_accuracy'] * 100:.2f}%, "
+                f"model {report['model_accuracy_on_fired'] * 100:.2f}%"
+            )
+        self.stdout.write(f"{'path':>10} {'mean ms':>10}")
+        for name, key in (('metadata', 'metadata_ms_mean'), ('model', 'model_ms_mean'),
+                          ('pipeline', 'pipeline_ms_mean')):
+            self.stdout.write(f"{name:>10} {report[key]:>10}")
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
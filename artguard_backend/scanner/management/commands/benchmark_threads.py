@@ -0,0 +1,60 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_benchmarks import benchmark_thread_plans
+from ml_inference import MODEL_PATH
+from ml_threads import available_cpus, plan_threads
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare inference throughput and tail latency across thread plans: N worker processes "
+        "sharing the CPUs, each with an even share of threads (optionally pinned) versus torch's "
+        "default of every worker using all cores."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=MODEL_PATH, help='Checkpoint to benchmark')
+        parser.add_argument('--workers', help='Comma-separated worker counts (default: powers of two up to the CPU count)')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per plan (default: 10)')
+        parser.add_argument('--pin', action='store_true', help='Also measure each even split with pinned cores')
+        parser.add_argument('--output', help='Write results as JSON to this path')
+
+    def handle(self, *args, **options):
+        cpus = available_cpus()
+        if options['workers']:
+            try:
+                worker_counts = [int(w) for w in options['workers'].split(',') if w.strip()]
+            except ValueError:
+                raise CommandError(f"Invalid --workers '{options['workers']}'")
+        else:
+            worker_counts = [1 << i for i in range(cpus.bit_length()) if 1 << i <= cpus]
+
+        plans = []
+        for workers in worker_counts:
+            plans.append((f"{workers}x{max(1, cpus // workers)}",
+                          [plan_threads(workers) for _ in range(workers)]))
+            if options['pin']:
+                plans.append((f"{workers}x{max(1, cpus // workers)} pinned",
+                              [plan_threads(workers, worker_index=i, pin=True) for i in range(workers)]))
+            if workers > 1:
+                # What every worker does when left to torch's defaults
+                plans.append((f"{workers}x{cpus} default",
+                              [plan_threads(workers, intra_op=cpus) for _ in range(workers)]))
+
+        self.stdout.write(f"{cpus} CPUs available, {options['duration']}s per plan")
+        try:
+            results = benchmark_thread_plans(options['model'], plans, options['duration'])
+        except RuntimeError as e:
+            raise CommandError(f"Benchmark failed: {e}")
+
+        self.stdout.write(f"{'plan':>16} {'images/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for row in results:
+            self.stdout.write(
+                f"{row['plan']:>16} {row['images_per_second']:>9} {row['p50_ms']:>9} {row['p99_ms']:>9}")
+        best = max(results, key=lambda row: row['images_per_second'])
+        self.stdout.write(self.style.SUCCESS(f"Highest throughput: {best['plan']}"))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
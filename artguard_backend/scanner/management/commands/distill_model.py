@@ -0,0 +1,89 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_cascade import labelled_images
+from ml_distillation import run_distillation, split_samples
+from ml_inference import MODEL_PATH
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(MODEL_PATH), 'artguard_cnn_student.pth')
+
+
+class Command(BaseCommand):
+    help = (
+        "Distill a teacher checkpoint (e.g. the ResNet18 ArtworkClassifier) into a MobileNetV2 "
+        "student, optionally prune its channels and recover, then compare accuracy, parameters, "
+        "FLOPs and CPU latency. Training images go in class subfolders (AI/, Handmade/, Print/); "
+        "without them the student learns from the teacher alone. Publish the result with publish_model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('train_dir', help='Folder of training artworks')
+        parser.add_argument('--teacher', required=True, help='Teacher checkpoint')
+        parser.add_argument('--student', help='MobileNetV2 checkpoint to start from (default: random init)')
+        parser.add_argument('--output', default=DEFAULT_OUTPUT, help=f'Student checkpoint (default: {DEFAULT_OUTPUT})')
+        parser.add_argument('--val-dir', help='Validation folder (default: hold out --val-fraction of train_dir)')
+        parser.add_argument('--val-fraction', type=float, default=0.2, help='Held-out share of train_dir (default: 0.2)')
+        parser.add_argument('--epochs', type=int, default=5, help='Distillation epochs (default: 5)')
+        parser.add_argument('--prune', type=float, default=0.0,
+                            help='Fraction of hidden channels to prune per block, 0 to skip (default: 0)')
+        parser.add_argument('--recovery-epochs', type=int, default=2, help='Epochs after pruning (default: 2)')
+        parser.add_argument('--batch-size', type=int, default=32, help='Images per step (default: 32)')
+        parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate, a tenth of it for recovery (default: 1e-3)')
+        parser.add_argument('--temperature', type=float, default=4.0, help='Softmax temperature (default: 4)')
+        parser.add_argument('--alpha', type=float, default=0.7,
+                            help='Weight of the teacher targets against the labels (default: 0.7)')
+        parser.add_argument('--seed', type=int, default=0, help='Shuffling and initialization seed (default: 0)')
+        parser.add_argument('--latency-runs', type=int, default=30, help='Timed single-image runs per model (default: 30)')
+        parser.add_argument('--report', help='Write the report as JSON to this path')
+
+    def handle(self, *args, **options):
+        paths, labels = labelled_images(options['train_dir'])
+        if not paths:
+            raise CommandError(f"No images found in {options['train_dir']}")
+        try:
+            if options['val_dir']:
+                val_paths, val_labels = labelled_images(options['val_dir'])
+                train, _ = split_samples(paths, labels, 0.0, options['seed'])
+                val, _ = split_samples(val_paths, val_labels, 0.0, options['seed'])
+            else:
+                train, val = split_samples(paths, labels, options['val_fraction'], options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"{len(train)} training and {len(val)} validation images"
+            f"{'' if labels else ' (no class folders, distilling from the teacher alone)'}"
+        )
+
+        def progress(entry):
+            accuracy = f", accuracy {entry['accuracy']:.2%}" if entry['accuracy'] is not None else ''
+            self.stdout.write(
+                f"{entry['phase']} epoch {entry['epoch']}: loss {entry['loss']}, {entry['seconds']}s, "
+                f"teacher agreement {entry['teacher_agreement']:.2%}{accuracy}"
+            )
+
+        try:
+            report = run_distillation(
+                options['teacher'], train, val, options['output'], options['student'], options['epochs'],
+                options['prune'], options['recovery_epochs'], options['batch_size'], options['lr'],
+                options['temperature'], options['alpha'], options['seed'], options['latency_runs'], progress,
+            )
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Distillation failed: {e}")
+
+        self.stdout.write(
+            f"{'model':>8} {'accuracy':>9} {'agreement':>10} {'params':>11} {'GFLOPs':>7} {'p50 ms':>8} {'p95 ms':>8}")
+        for name in ('teacher', 'student', 'pruned'):
+            if name not in report:
+                continue
+            row = report[name]
+            accuracy = f"{row['accuracy']:.2%}" if row['accuracy'] is not None else '-'
+            self.stdout.write(
+                f"{name:>8} {accuracy:>9} {row['teacher_agreement']:>10.2%} {row['parameters']:>11,} "
+                f"{row['flops'] / 1e9:>7.2f} {row['latency']['p50_ms']:>8} {row['latency']['p95_ms']:>8}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Saved student to {report['output']}"))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
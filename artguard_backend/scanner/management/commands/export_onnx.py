@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_export import ONNX_OPSET, ONNX_TOLERANCE, export_onnx
+from ml_inference import MODEL_PATH, ONNX_MODEL_PATH
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the artwork classifier to ONNX and verify it against PyTorch with ONNX Runtime. "
+        "Serve it with ML_INFERENCE_BACKEND=onnxruntime."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=MODEL_PATH, help='fp32 checkpoint to export')
+        parser.add_argument('--output', default=ONNX_MODEL_PATH, help='Where to write the .onnx file')
+        parser.add_argument('--opset', type=int, default=ONNX_OPSET, help=f'ONNX opset (default: {ONNX_OPSET})')
+        parser.add_argument('--tolerance', type=float, default=ONNX_TOLERANCE,
+                            help=f'Maximum allowed logit difference against PyTorch (default: {ONNX_TOLERANCE:.0e})')
+
+    def handle(self, *args, **options):
+        try:
+            result = export_onnx(options['model'], options['output'], options['opset'], options['tolerance'])
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Export failed: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved ONNX model to {result['output']} (max logit diff {result['max_abs_diff']:.2e})"
+        ))
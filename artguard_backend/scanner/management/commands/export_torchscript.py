@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_export import TORCHSCRIPT_TOLERANCE, compare_with_eager, export_torchscript
+from ml_inference import MODEL_PATH, TORCHSCRIPT_MODEL_PATH
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the artwork classifier as a frozen TorchScript archive with batch norm folded in. "
+        "ml_inference serves it in place of the eager model while it is newer than the checkpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=MODEL_PATH, help='fp32 checkpoint to export')
+        parser.add_argument('--output', default=TORCHSCRIPT_MODEL_PATH, help='Where to write the archive')
+        parser.add_argument('--tolerance', type=float, default=TORCHSCRIPT_TOLERANCE,
+                            help=f'Maximum allowed logit difference against eager (default: {TORCHSCRIPT_TOLERANCE:.0e})')
+        parser.add_argument('--runs', type=int, default=50, help='Timed forward passes per model (default: 50)')
+        parser.add_argument('--report', help='Write the latency comparison as JSON to this path')
+
+    def handle(self, *args, **options):
+        try:
+            result = export_torchscript(options['model'], options['output'], options['tolerance'])
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Export failed: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved TorchScript model to {result['output']} (max logit diff {result['max_abs_diff']:.2e})"
+        ))
+
+        report = compare_with_eager(options['output'], model_path=options['model'], runs=options['runs'])
+        for name in ('eager', 'exported'):
+            stats = report[name]
+            self.stdout.write(
+                f"{name:>8}: cold start {stats['cold_start_seconds']}s, "
+                f"p50 {stats['p50_ms']} ms/image, p95 {stats['p95_ms']} ms/image"
+            )
+        self.stdout.write(
+            f"Speedup: cold start x{report['cold_start_speedup']}, per-image x{report['latency_speedup']}"
+        )
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,243 @@
+import copy
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_cascade import labelled_images
+from ml_dataset import ShardedDataset, ShardLoader
+from ml_distillation import UNLABELLED, split_samples
+from ml_inference import artwork_classifier_module, load_model
+
+
+def _loader(samples, batch_size, shuffle):
+    import torch
+    from PIL import Image
+
+    from ml_preprocessing import STRETCH, get_preprocessor
+
+    readable = []
+    for path, label in samples:
+        try:
+            with Image.open(path) as image:
+                image.verify()
+        except Exception:
+            continue
+        readable.append((path, label))
+    preprocessor = get_preprocessor(STRETCH)
+
+    class ArtworkDataset(torch.utils.data.Dataset):
+        def __len__(self):
+            return len(readable)
+
+        def __getitem__(self, index):
+            path, label = readable[index]
+            return preprocessor.preprocess(path)[0], label
+
+    return torch.utils.data.DataLoader(ArtworkDataset(), batch_size=batch_size, shuffle=shuffle)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fine-tune the ResNet18 ArtworkClassifier on labelled artworks (class subfolders AI/, "
+        "Handmade/, Print/) or a dataset written by prepare_dataset. With --cache-features the "
+        "frozen backbone runs once and every epoch trains from its cached outputs; --compare also "
+        "runs the standard loop from the same weights and reports the speedup and the accuracy "
+        "difference."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('train_dir', help='Folder of labelled training artworks, or a dataset from prepare_dataset')
+        parser.add_argument('--val-dir',
+                            help='Validation folder or dataset, same kind as train_dir (default: hold out --val-fraction)')
+        parser.add_argument('--val-fraction', type=float, default=0.2, help='Held-out share of train_dir (default: 0.2)')
+        parser.add_argument('--init', help='ArtworkClassifier checkpoint to start from (default: ImageNet weights)')
+        parser.add_argument('--epochs', type=int, default=10, help='Training epochs (default: 10)')
+        parser.add_argument('--batch-size', type=int, default=32, help='Images per step (default: 32)')
+        parser.add_argument('--cache-features', action='store_true', help='Train from cached frozen-backbone features')
+        parser.add_argument('--cache-dir', help='Keep the feature cache here (default: temporary)')
+        parser.add_argument('--augment', action='store_true',
+                            help='Random crops and flips from a prepared dataset (standard loop only)')
+        parser.add_argument('--workers', type=int, help='Batch assembly threads for a prepared dataset '
+                                                          '(default: ML_DECODE_WORKERS)')
+        parser.add_argument('--half', action='store_true', help='Store cached features as float16')
+        parser.add_argument('--compare', action='store_true',
+                            help='Also train with the standard loop and compare time and accuracy')
+        parser.add_argument('--tolerance', type=float, default=0.02,
+                            help='With --compare, fail when the best accuracies differ by more than this (default: 0.02)')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Data-parallel training processes on this machine, for a prepared dataset (default: 1)')
+        parser.add_argument('--scaling', metavar='COUNTS',
+                            help="Compare throughput at these process counts instead of training once, e.g. '1,2,4,8'")
+        parser.add_argument('--pin', action='store_true', help='Pin each training process to its own cores')
+        parser.add_argument('--seed', type=int, default=0, help='Split and initialization seed (default: 0)')
+        parser.add_argument('--output', help='Save the fine-tuned state_dict here')
+        parser.add_argument('--report', help='Write timings and accuracies as JSON to this path')
+
+    def handle(self, *args, **options):
+        import torch
+
+        if options['processes'] > 1 or options['scaling']:
+            return self._distributed(options)
+        if ShardedDataset.is_dataset(options['train_dir']):
+            train_loader, val_loader, make_train_loader = self._shard_loaders(options)
+        else:
+            train_loader, val_loader, make_train_loader = self._folder_loaders(options)
+
+        architecture = artwork_classifier_module()
+        torch.manual_seed(options['seed'])
+        if options['init']:
+            try:
+                model = load_model(options['init'], mmap=False)
+            except RuntimeError as e:
+                raise CommandError(str(e))
+            if not isinstance(model, architecture.ArtworkClassifier):
+                raise CommandError(f"{options['init']} is not an ArtworkClassifier checkpoint")
+        else:
+            model = architecture.ArtworkClassifier(pretrained=True)
+        baseline_model = copy.deepcopy(model) if options['compare'] else None
+
+        report = {'train_images': len(train_loader.dataset), 'val_images': len(val_loader.dataset),
+                  'epochs': options['epochs']}
+        mode = 'cached' if options['cache_features'] else 'standard'
+        report[mode] = {}
+        architecture.fine_tune_model(
+            model, train_loader, val_loader, options['epochs'], cache_features=options['cache_features'],
+            cache_dir=options['cache_dir'], cache_dtype=torch.float16 if options['half'] else torch.float32,
+            stats=report[mode],
+        )
+        if options['output']:
+            architecture.save_model(model, options['output'])
+
+        if baseline_model is not None:
+            other = 'standard' if options['cache_features'] else 'cached'
+            report[other] = {}
+            torch.manual_seed(options['seed'])
+            architecture.fine_tune_model(
+                baseline_model, make_train_loader(other == 'standard'), val_loader,
+                options['epochs'], cache_features=other == 'cached', cache_dir=options['cache_dir'],
+                cache_dtype=torch.float16 if options['half'] else torch.float32, stats=report[other],
+            )
+            report['comparison'] = self._compare(report)
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if baseline_model is not None:
+            difference = report['comparison']['accuracy_difference']
+            if abs(difference) > options['tolerance']:
+                raise CommandError(
+                    f"Cached training accuracy differs by {difference:+.2%}, more than {options['tolerance']:.0%}")
+            self.stdout.write(self.style.SUCCESS(f"Accuracies agree within {options['tolerance']:.0%}"))
+
+    def _distributed(self, options):
+        from ml_distributed import measure_scaling, train_distributed
+
+        if options['cache_features'] or options['compare']:
+            raise CommandError("--cache-features and --compare train in a single process")
+        if not ShardedDataset.is_dataset(options['train_dir']):
+            raise CommandError(f"Multi-process training reads a dataset from prepare_dataset, "
+                               f"{options['train_dir']} is not one")
+        settings = {
+            'init_path': options['init'], 'val_dataset': options['val_dir'], 'val_fraction': options['val_fraction'],
+            'epochs': options['epochs'], 'batch_size': options['batch_size'], 'augment': options['augment'],
+            'seed': options['seed'], 'pin': options['pin'],
+        }
+        try:
+            if options['scaling']:
+                counts = [int(count) for count in options['scaling'].split(',') if count.strip()]
+                report = measure_scaling(
+                    options['train_dir'], counts,
+                    lambda run: self.stdout.write(f"{run['world_size']} processes: {run['images_per_second']} images/s"),
+                    **settings,
+                )
+            else:
+                report = train_distributed(options['train_dir'], options['processes'], output=options['output'],
+                                           **settings)
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(str(e))
+
+        if options['scaling']:
+            self.stdout.write(f"{report['available_cpus']} CPUs available")
+            self.stdout.write(
+                f"{'processes':>9} {'batch/rank':>10} {'epoch s':>8} {'images/s':>9} {'speedup':>8} "
+                f"{'efficiency':>10} {'accuracy':>9}")
+            for run in report['runs']:
+                epoch = sum(run['epoch_seconds']) / len(run['epoch_seconds'])
+                self.stdout.write(
+                    f"{run['world_size']:>9} {run['batch_size_per_rank']:>10} {epoch:>8.2f} "
+                    f"{run['images_per_second']:>9} {run['speedup']:>7}x {run['efficiency']:>10.0%} "
+                    f"{run['val_accuracy'][-1]:>9.2%}")
+        else:
+            self.stdout.write(
+                f"{report['world_size']} processes: {report['images_per_second']} images/s, final accuracy "
+                f"{report['val_accuracy'][-1]:.2%}")
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def _folder_loaders(self, options):
+        paths, labels = labelled_images(options['train_dir'])
+        if not labels:
+            raise CommandError(f"{options['train_dir']} has no class subfolders to take labels from")
+        try:
+            if options['val_dir']:
+                train, _ = split_samples(paths, labels, 0.0, options['seed'])
+                val, _ = split_samples(*labelled_images(options['val_dir']), 0.0, options['seed'])
+            else:
+                train, val = split_samples(paths, labels, options['val_fraction'], options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if any(label == UNLABELLED for _, label in val):
+            raise CommandError(f"{options['val_dir']} has no class subfolders to take labels from")
+
+        def make_train_loader(standard):
+            return _loader(train, options['batch_size'], shuffle=standard)
+
+        return make_train_loader(not options['cache_features']), _loader(val, options['batch_size'], False), \
+            make_train_loader
+
+    def _shard_loaders(self, options):
+        try:
+            dataset = ShardedDataset(options['train_dir'])
+            if options['val_dir']:
+                val_dataset, train, val = ShardedDataset(options['val_dir']), None, None
+            else:
+                val_dataset = dataset
+                train, val = dataset.split(options['val_fraction'], options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        for directory, data in ((options['train_dir'], dataset), (options['val_dir'], val_dataset)):
+            if not data.labelled:
+                raise CommandError(f"{directory} was prepared without class labels")
+
+        def make_train_loader(standard):
+            # Random crops and flips only make sense when every epoch sees the images again
+            return ShardLoader(dataset, options['batch_size'], train, shuffle=standard,
+                               augment=standard and options['augment'], workers=options['workers'],
+                               seed=options['seed'])
+
+        val_loader = ShardLoader(val_dataset, options['batch_size'], val, workers=options['workers'])
+        return make_train_loader(not options['cache_features']), val_loader, make_train_loader
+
+    def _compare(self, report):
+        standard, cached = report['standard'], report['cached']
+        standard_epoch = sum(standard['epoch_seconds']) / len(standard['epoch_seconds'])
+        cached_epoch = sum(cached['epoch_seconds']) / len(cached['epoch_seconds'])
+        standard_total = sum(standard['epoch_seconds'])
+        cached_total = cached['extract_seconds'] + sum(cached['epoch_seconds'])
+        # Best epoch rather than the last, which is noisy on small validation sets
+        difference = max(cached['val_accuracy']) - max(standard['val_accuracy'])
+        comparison = {
+            'standard_epoch_seconds': round(standard_epoch, 3),
+            'cached_epoch_seconds': round(cached_epoch, 3),
+            'epoch_speedup': round(standard_epoch / cached_epoch, 1) if cached_epoch else None,
+            'total_speedup': round(standard_total / cached_total, 2) if cached_total else None,
+            'accuracy_difference': round(difference, 4),
+        }
+        self.stdout.write(
+            f"Epoch {comparison['standard_epoch_seconds']}s -> {comparison['cached_epoch_seconds']}s "
+            f"({comparison['epoch_speedup']}x; {comparison['total_speedup']}x overall including the "
+            f"{cached['extract_seconds']}s feature pass). Best accuracy standard "
+            f"{max(standard['val_accuracy']):.2%}, cached {max(cached['val_accuracy']):.2%}"
+        )
+        return comparison
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_benchmarks import MEMORY_STRATEGIES, worker_memory
+from ml_inference import default_model_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Start N worker processes per weight-loading strategy (private copies, memory-mapped "
+        "checkpoint, preload before fork) and report per-worker unique (USS) and proportional "
+        "(PSS) memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', help='Checkpoint to load (default: the serving model)')
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes per strategy (default: 4)')
+        parser.add_argument('--strategies', default=','.join(MEMORY_STRATEGIES),
+                            help=f"Comma-separated subset of {', '.join(MEMORY_STRATEGIES)}")
+        parser.add_argument('--output', help='Write results as JSON to this path')
+
+    def handle(self, *args, **options):
+        model_path = options['model'] or default_model_path()
+        strategies = [s.strip() for s in options['strategies'].split(',') if s.strip()]
+        results = []
+        for strategy in strategies:
+            try:
+                results.append(worker_memory(model_path, options['workers'], strategy))
+            except (ValueError, RuntimeError) as e:
+                raise CommandError(f"Measuring '{strategy}' failed: {e}")
+
+        self.stdout.write(f"{options['workers']} workers serving {model_path}")
+        self.stdout.write(f"{'strategy':>9} {'RSS MiB':>9} {'PSS MiB':>9} {'USS MiB':>9} {'total PSS MiB':>14}")
+        for row in results:
+            self.stdout.write(
+                f"{row['strategy']:>9} {row['mean_rss_bytes'] / 2**20:>9.1f} {row['mean_pss_bytes'] / 2**20:>9.1f} "
+                f"{row['mean_uss_bytes'] / 2**20:>9.1f} {row['total_pss_bytes'] / 2**20:>14.1f}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_cascade import labelled_images
+from ml_dataset import SHARD_ROWS, ShardedDataset, ShardLoader, measure_decode, measure_loader, prepare_dataset
+from ml_preprocessing import CROP_RESIZE, POLICIES, STRETCH
+
+
+class Command(BaseCommand):
+    help = (
+        "Decode a folder of training artworks once into a memory-mapped uint8 dataset: duplicates "
+        "are dropped by content hash, images are resized to a square store size and written to "
+        "shards with their labels (from AI/, Handmade/, Print/ subfolders). Pass the output to "
+        "fine_tune_model instead of the image folder. --benchmark compares the shard loader with "
+        "decoding the JPEGs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source_dir', help='Folder of training artworks')
+        parser.add_argument('output', help='Dataset directory, replaced if it exists')
+        parser.add_argument('--size', type=int, default=CROP_RESIZE,
+                            help=f'Side of the stored images, random crops are taken from it (default: {CROP_RESIZE})')
+        parser.add_argument('--policy', default=STRETCH, choices=POLICIES, help=f'Resize policy (default: {STRETCH})')
+        parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS, help=f'Images per shard (default: {SHARD_ROWS})')
+        parser.add_argument('--workers', type=int, help='Decode threads (default: ML_DECODE_WORKERS)')
+        parser.add_argument('--benchmark', action='store_true',
+                            help='Time an augmented pass of the loader against decoding the source images')
+        parser.add_argument('--batch-size', type=int, default=32, help='Benchmark batch size (default: 32)')
+        parser.add_argument('--report', help='Write the summary as JSON to this path')
+
+    def handle(self, *args, **options):
+        paths, labels = labelled_images(options['source_dir'])
+        if not paths:
+            raise CommandError(f"No images found in {options['source_dir']}")
+        self.stdout.write(
+            f"Preparing {len(paths)} images{'' if labels else ' (no class folders, stored unlabelled)'}")
+        try:
+            report = prepare_dataset(paths, labels, options['output'], options['size'], options['policy'],
+                                     options['shard_rows'], options['workers'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        classes = ', '.join(f"{label} {count}" for label, count in sorted(report['classes'].items()))
+        self.stdout.write(
+            f"{report['images']} images ({classes}) in {report['shards']} shards, "
+            f"{report['bytes'] / 2 ** 20:.1f} MiB, {report['seconds']}s; skipped {report['duplicates']} "
+            f"duplicates ({report['label_conflicts']} with conflicting labels) and {report['unreadable']} "
+            f"unreadable files"
+        )
+
+        if options['benchmark']:
+            loader = ShardLoader(ShardedDataset(report['path']), options['batch_size'], shuffle=True, augment=True,
+                                 workers=options['workers'], seed=0)
+            report['benchmark'] = {
+                'shards': measure_loader(loader),
+                'decode': measure_decode(paths, options['policy'], options['workers']),
+            }
+            shards, decode = report['benchmark']['shards'], report['benchmark']['decode']
+            self.stdout.write(f"{'source':>8} {'images':>8} {'seconds':>9} {'images/s':>10}")
+            for name, row in (('jpeg', decode), ('shards', shards)):
+                self.stdout.write(
+                    f"{name:>8} {row['images']:>8} {row['seconds']:>9} {row['images_per_second']:>10}")
+        self.stdout.write(self.style.SUCCESS(f"Saved dataset to {report['path']}"))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
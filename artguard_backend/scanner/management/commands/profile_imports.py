@@ -0,0 +1,69 @@
+import json
+import shlex
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_benchmarks import profile_startup
+
+
+def _csv(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _importers(chain):
+    # The direct importer and the top-level import it happened under
+    if len(chain) > 2:
+        chain = [chain[0], '...', chain[-1]]
+    return ''.join(f" <- {module}" for module in chain)
+
+
+class Command(BaseCommand):
+    help = (
+        "Profile startup imports in fresh interpreters and report the slowest imports, the "
+        "packages costing the most and what pulled them in. Profiles a web worker boot (Django "
+        "setup plus the URLconf) unless --manage names a manage.py command line."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--manage', metavar='ARGS',
+                            help="Profile 'manage.py ARGS' instead of a worker boot, e.g. --manage 'migrate --plan'")
+        parser.add_argument('--runs', type=int, default=3, help='Fresh processes to time, median reported (default: 3)')
+        parser.add_argument('--top', type=int, default=15, help='Rows per table (default: 15)')
+        parser.add_argument('--forbid', default='',
+                            help='Comma-separated packages that must not be imported, e.g. torch,torchvision,supabase')
+        parser.add_argument('--budget-ms', type=float, help='Fail when the median run takes longer than this')
+        parser.add_argument('--output', help='Write results as JSON to this path')
+
+    def handle(self, *args, **options):
+        argv = ['manage.py', *shlex.split(options['manage'])] if options['manage'] else None
+        try:
+            results = profile_startup(argv, options['runs'], options['top'])
+        except RuntimeError as e:
+            raise CommandError(f"Profiling failed: {e}")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        self.stdout.write(
+            f"{results['command']}: {results['seconds'] * 1000:.0f} ms (median of {results['runs']}, "
+            f"best {results['seconds_min'] * 1000:.0f} ms), {results['modules']} modules imported "
+            f"in {results['import_seconds'] * 1000:.0f} ms"
+        )
+        self.stdout.write(f"{'cumulative ms':>14} {'self ms':>8}  module <- imported by")
+        for row in results['slowest']:
+            self.stdout.write(
+                f"{row['cumulative_ms']:>14} {row['self_ms']:>8}  {row['module']}{_importers(row['imported_by'])}")
+        self.stdout.write(f"{'self ms':>14} {'modules':>8}  package <- first imported by")
+        for package in results['packages']:
+            self.stdout.write(
+                f"{package['self_ms']:>14} {package['modules']:>8}  {package['package']}"
+                f"{_importers(package['imported_by'])}")
+
+        failures = []
+        forbidden = sorted(set(_csv(options['forbid'])) & set(results['imported']))
+        if forbidden:
+            failures.append(f"imports {', '.join(forbidden)}")
+        if options['budget_ms'] is not None and results['seconds'] * 1000 > options['budget_ms']:
+            failures.append(f"took {results['seconds'] * 1000:.0f} ms, budget {options['budget_ms']:.0f} ms")
+        if failures:
+            raise CommandError(f"{results['command']} {'; '.join(failures)}")
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_inference import IMAGENET_MEAN, IMAGENET_STD, INPUT_SIZE
+from ml_versions import get_store
+
+
+def _floats(value):
+    return [float(v) for v in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = (
+        "Publish a checkpoint into the versioned model store (ML_MODEL_REGISTRY_DIR) with a manifest, "
+        "optionally making it the active version. Running workers switch over without a restart."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('checkpoint', help='.pth, .torchscript or .onnx file to publish')
+        parser.add_argument('--name', help='Version id (default: content hash of the checkpoint)')
+        parser.add_argument('--labels', help='Comma-separated class names by output index (default: Handmade,AI,Print)')
+        parser.add_argument('--input-size', type=int, default=INPUT_SIZE, help=f'Input resolution (default: {INPUT_SIZE})')
+        parser.add_argument('--mean', type=_floats, default=IMAGENET_MEAN, help='Comma-separated channel means')
+        parser.add_argument('--std', type=_floats, default=IMAGENET_STD, help='Comma-separated channel stds')
+        parser.add_argument('--notes', default='', help='Free text stored in the manifest')
+        parser.add_argument('--activate', action='store_true', help='Serve this version once published')
+
+    def handle(self, *args, **options):
+        labels = [label.strip() for label in options['labels'].split(',')] if options['labels'] else None
+        store = get_store()
+        try:
+            manifest = store.publish(
+                options['checkpoint'], options['name'], labels, options['input_size'],
+                options['mean'], options['std'], options['notes'],
+            )
+        except (OSError, ValueError, RuntimeError) as e:
+            raise CommandError(f"Publishing failed: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Published version {manifest['version']} ({manifest['architecture']}, "
+            f"{len(manifest['labels'])} labels, {manifest['input_size']}px) to {store.root}"
+        ))
+        if options['activate']:
+            store.activate(manifest['version'])
+            self.stdout.write(self.style.SUCCESS(f"Activated version {manifest['version']}"))
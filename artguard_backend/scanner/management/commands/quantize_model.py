@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_inference import MODEL_PATH, QUANTIZED_MODEL_PATH, find_images, load_model
+from ml_quantization import parity_report, quantize_model, save_quantized_model
+
+
+class Command(BaseCommand):
+    help = (
+        "Calibrate and save an int8 copy of the artwork classifier, then compare it "
+        "against fp32 on a held-out folder. Serve it with ML_INFERENCE_MODE=int8."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('calibration_dir', help='Folder of sample artworks used for calibration')
+        parser.add_argument('--holdout-dir', help='Folder of held-out artworks for the parity report')
+        parser.add_argument('--limit', type=int, default=200, help='Maximum calibration images (default: 200)')
+        parser.add_argument('--model', default=MODEL_PATH, help='fp32 checkpoint to quantize')
+        parser.add_argument('--output', default=QUANTIZED_MODEL_PATH, help='Where to write the int8 checkpoint')
+        parser.add_argument('--backend', choices=['fbgemm', 'qnnpack'], help='Quantized engine (default: auto)')
+        parser.add_argument('--report', help='Write the parity report as JSON to this path')
+
+    def handle(self, *args, **options):
+        calibration_paths = find_images(options['calibration_dir'])[:options['limit']]
+        if not calibration_paths:
+            raise CommandError(f"No images found in {options['calibration_dir']}")
+
+        try:
+            int8_model, stats = quantize_model(calibration_paths, options['model'], options['backend'])
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Quantization failed: {e}")
+        save_quantized_model(int8_model, stats['backend'], options['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved int8 model to {options['output']} "
+            f"({stats['calibration_images']} calibration images, {stats['backend']}, "
+            f"{stats['calibration_seconds']}s)"
+        ))
+
+        if not options['holdout_dir']:
+            self.stdout.write(self.style.WARNING("No --holdout-dir given, skipping parity report"))
+            return
+
+        holdout_paths = find_images(options['holdout_dir'])
+        try:
+            report = parity_report(load_model(options['model']), int8_model, holdout_paths)
+        except ValueError as e:
+            raise CommandError(f"Parity report failed: {e}")
+        report['calibration'] = stats
+
+        self.stdout.write(
+            f"Label agreement: {report['label_agreement'] * 100:.2f}% over {report['images']} images\n"
+            f"Confidence drift: mean {report['mean_confidence_drift']}, "
+            f"p95 {report['p95_confidence_drift']}, max {report['max_confidence_drift']}\n"
+            f"Latency: fp32 {report['fp32_ms_per_image']} ms/image, "
+            f"int8 {report['int8_ms_per_image']} ms/image"
+        )
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Parity report written to {options['report']}")
@@ -0,0 +1,86 @@
+import io
+import json
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_embeddings import build_index, embedding_model_path
+
+
+def _download(url, timeout):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the near-duplicate embedding index from every scan in scan_history, downloading "
+        "each artwork and embedding it with the current embedding model. Workers switch to the "
+        "new index on their next search."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', help='Embedding checkpoint (default: ML_EMBEDDING_MODEL or the served .pth)')
+        parser.add_argument('--page-size', type=int, default=200, help='Scans fetched per query (default: 200)')
+        parser.add_argument('--downloads', type=int, default=8, help='Concurrent image downloads (default: 8)')
+        parser.add_argument('--batch-size', type=int, default=16, help='Images per forward pass (default: 16)')
+        parser.add_argument('--timeout', type=float, default=30, help='Download timeout in seconds (default: 30)')
+        parser.add_argument('--limit', type=int, help='Stop after this many scans')
+        parser.add_argument('--report', help='Write the run summary as JSON to this path')
+
+    def handle(self, *args, **options):
+        # Imported here: the Supabase client needs credentials, the rest of the ML stack does not
+        from scanner.utils.supabase_client import get_all_scans
+
+        failed_downloads = []
+
+        def records():
+            offset = 0
+            limit = options['limit']
+            with ThreadPoolExecutor(max_workers=max(1, options['downloads'])) as executor:
+                while limit is None or offset < limit:
+                    page_size = options['page_size'] if limit is None else min(options['page_size'], limit - offset)
+                    scans = get_all_scans(page_size, offset)
+                    if scans is None:
+                        raise CommandError(f"Could not read scan_history at offset {offset}")
+                    if not scans:
+                        return
+                    offset += len(scans)
+                    futures = [executor.submit(_download, scan['artwork_url'], options['timeout']) for scan in scans]
+                    for scan, future in zip(scans, futures):
+                        try:
+                            image_bytes = future.result()
+                        except Exception as e:
+                            failed_downloads.append(scan['id'])
+                            self.stderr.write(f"Could not download scan {scan['id']}: {e}")
+                            continue
+                        result = scan.get('result') or {}
+                        entry = {
+                            'scan_id': scan['id'],
+                            'label': result.get('label'),
+                            'confidence': result.get('confidence'),
+                            'model_version': result.get('model_version'),
+                        }
+                        yield entry, io.BytesIO(image_bytes)
+
+        def progress(done):
+            self.stdout.write(f"{done} scans embedded", ending='\r')
+            self.stdout.flush()
+
+        model_path = options['model'] or embedding_model_path()
+        try:
+            summary = build_index(records(), model_path, options['batch_size'], progress=progress)
+        except RuntimeError as e:
+            raise CommandError(f"Rebuild failed: {e}")
+        summary['failed_downloads'] = len(failed_downloads)
+
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {summary['indexed']} scans with embedding model {summary['model_version']} "
+            f"into {summary['path']} in {summary['seconds']}s "
+            f"({summary['errors']} unreadable, {summary['failed_downloads']} not downloadable)"
+        ))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(summary, f, indent=2)
@@ -0,0 +1,113 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_feedback import (
+    ANCHOR_RATIO, DEFAULT_OUTPUT, HOLDOUT_PERCENT, MIN_FEEDBACK, MIN_HOLDOUT, refit_head,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Refit only the classifier head on the cached embeddings of scans users confirmed or "
+        "corrected (POST /api/feedback/), and publish the result as a new model version if it "
+        "does at least as well on held-out feedback. Takes seconds; meant to run periodically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base', help='Eager .pth to refit (default: the embedding model)')
+        parser.add_argument('--output', default=DEFAULT_OUTPUT, help=f'Refit checkpoint (default: {DEFAULT_OUTPUT})')
+        parser.add_argument('--holdout-percent', type=int, default=HOLDOUT_PERCENT,
+                            help=f'Feedback scans held out for the guard (default: {HOLDOUT_PERCENT})')
+        parser.add_argument('--anchor-ratio', type=float, default=ANCHOR_RATIO,
+                            help=f'Unlabelled scans sampled per feedback example (default: {ANCHOR_RATIO:g})')
+        parser.add_argument('--steps', type=int, default=300, help='Full-batch training steps (default: 300)')
+        parser.add_argument('--lr', type=float, default=0.01, help='Learning rate (default: 0.01)')
+        parser.add_argument('--min-feedback', type=int, default=MIN_FEEDBACK,
+                            help=f'Skip the run below this many training examples (default: {MIN_FEEDBACK})')
+        parser.add_argument('--min-holdout', type=int, default=MIN_HOLDOUT,
+                            help=f'Skip the run below this many holdout examples (default: {MIN_HOLDOUT})')
+        parser.add_argument('--min-gain', type=float, default=0.0,
+                            help='Holdout accuracy the new head must gain to be published (default: 0)')
+        parser.add_argument('--no-publish', action='store_true', help='Only write the checkpoint')
+        parser.add_argument('--activate', action='store_true', help='Serve the new version once published')
+        parser.add_argument('--page-size', type=int, default=1000, help='Feedback rows fetched per query (default: 1000)')
+        parser.add_argument('--report', help='Write the run summary as JSON to this path')
+
+    def handle(self, *args, **options):
+        # Imported here: the Supabase client needs credentials, the rest of the ML stack does not
+        from scanner.utils.supabase_client import get_all_feedback
+
+        start = time.perf_counter()
+        feedback, offset = [], 0
+        while True:
+            page = get_all_feedback(options['page_size'], offset)
+            if page is None:
+                raise CommandError(f"Could not read scan_feedback at offset {offset}")
+            feedback.extend(page)
+            offset += len(page)
+            if len(page) < options['page_size']:
+                break
+        fetch_seconds = time.perf_counter() - start
+
+        try:
+            report = refit_head(
+                feedback, options['base'], options['output'], options['holdout_percent'], options['anchor_ratio'],
+                options['steps'], options['lr'], options['min_feedback'], options['min_holdout'], options['min_gain'],
+            )
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Refit failed: {e}")
+        report['feedback_rows'] = len(feedback)
+        report['fetch_seconds'] = round(fetch_seconds, 3)
+        self.stdout.write(
+            f"{len(feedback)} feedback rows on {report['feedback_scans']} labelled scans "
+            f"({report['not_indexed']} not in the index, {report['missing_norm']} indexed before norms were kept): "
+            f"{report['train']} training, {report['holdout']} holdout, {report['anchors']} anchors"
+        )
+        if 'holdout_accuracy_after' in report:
+            self.stdout.write(
+                f"Holdout accuracy {report['holdout_accuracy_before']:.2%} -> {report['holdout_accuracy_after']:.2%}, "
+                f"{report['changed_predictions']:.2%} of indexed scans change label, refit in {report['seconds']}s"
+            )
+
+        try:
+            if 'refused' in report:
+                # Too little feedback, or nothing to learn from it, is routine for a periodic job;
+                # a regression is not
+                regressed = report.get('holdout_accuracy_after', 1.0) < (
+                    report.get('holdout_accuracy_before', 0.0) + options['min_gain'])
+                if not regressed:
+                    self.stdout.write(f"Nothing published: {report['refused']}")
+                    return
+                raise CommandError(f"Refusing to publish the refit head: {report['refused']}")
+            self.stdout.write(self.style.SUCCESS(f"Saved refit checkpoint to {report['checkpoint']}"))
+            if not options['no_publish']:
+                self._publish(report, options['activate'])
+        finally:
+            if options['report']:
+                with open(options['report'], 'w') as f:
+                    json.dump(report, f, indent=2)
+
+    def _publish(self, report, activate):
+        from ml_embeddings import copy_index
+        from ml_versions import get_store
+
+        store = get_store()
+        try:
+            manifest = store.publish(
+                report['checkpoint'],
+                notes=(f"Head ({report['head']}) of {report['base_version']} refit on {report['train']} "
+                       f"feedback scans; holdout accuracy {report['holdout_accuracy_before']:.2%} -> "
+                       f"{report['holdout_accuracy_after']:.2%}"),
+            )
+        except (OSError, ValueError, RuntimeError) as e:
+            raise CommandError(f"Publishing failed: {e}")
+        report['version'] = manifest['version']
+        self.stdout.write(self.style.SUCCESS(f"Published version {manifest['version']} to {store.root}"))
+        # Same backbone, same embeddings: the next refit can use every scan recorded so far
+        if copy_index(report['base_version'], manifest['version']):
+            self.stdout.write(f"Copied the embedding index of {report['base_version']} to {manifest['version']}")
+        if activate:
+            store.activate(manifest['version'])
+            self.stdout.write(self.style.SUCCESS(f"Activated version {manifest['version']}"))
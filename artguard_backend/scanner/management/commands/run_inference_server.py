@@ -0,0 +1,49 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_sidecar import SIDECAR_SOCKET, InferenceServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the inference sidecar: load the ML stack once and serve classifications to the web "
+        "workers over a Unix domain socket. Start the web workers with the same ML_SIDECAR_SOCKET "
+        "so they forward scans here instead of loading models themselves."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=SIDECAR_SOCKET,
+                            help='Unix socket path to listen on (default: ML_SIDECAR_SOCKET)')
+        parser.add_argument('--mode', default='660', help='Octal permissions of the socket file (default: 660)')
+        parser.add_argument('--no-warm-up', action='store_true',
+                            help='Load the model on the first request instead of at startup')
+
+    def handle(self, *args, **options):
+        # The only inference process on the node: give it every CPU instead of a per-worker share
+        from ml_inference import warm_up
+        from ml_threads import configure_threads, plan_threads
+
+        plan = configure_threads(plan_threads(workers=1))
+        self.stdout.write(str(plan))
+        if not options['no_warm_up']:
+            try:
+                model = warm_up()
+            except RuntimeError as e:
+                raise CommandError(f"Could not load the serving model: {e}")
+            self.stdout.write(f"Loaded {model['name']} (version {model['version']})")
+
+        try:
+            server = InferenceServer(options['socket'], int(options['mode'], 8))
+        except (ValueError, RuntimeError, OSError) as e:
+            raise CommandError(str(e))
+        # Let SIGTERM from the process manager unwind like Ctrl-C so the socket file is removed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.stdout.write(self.style.SUCCESS(f"Inference server listening on {server.socket_path}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write("Inference server stopped")
@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_cascade import CASCADE_FIRST_SIZE, DEFAULT_THRESHOLDS, Cascade, labelled_images, sweep_thresholds
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the cascade's first stage and escalation model over a folder and report the escalation rate, "
+        "accuracy and mean latency per confidence threshold. Subfolders named AI/, Handmade/ and Print/ "
+        "are used as ground truth; otherwise accuracy is agreement with the escalation model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Folder of sample artworks')
+        parser.add_argument('--thresholds', default=','.join(str(t) for t in DEFAULT_THRESHOLDS),
+                            help='Comma-separated confidence thresholds to evaluate')
+        parser.add_argument('--first-size', type=int, default=CASCADE_FIRST_SIZE,
+                            help=f'First-stage input size in pixels (default: {CASCADE_FIRST_SIZE})')
+        parser.add_argument('--first-model', help='First-stage checkpoint (default: the serving model)')
+        parser.add_argument('--escalation-model', help='Escalation checkpoint (default: the serving model)')
+        parser.add_argument('--report', help='Write the sweep as JSON to this path')
+
+    def handle(self, *args, **options):
+        try:
+            thresholds = [float(t) for t in options['thresholds'].split(',') if t.strip()]
+        except ValueError:
+            raise CommandError(f"Invalid --thresholds '{options['thresholds']}'")
+        paths, labels = labelled_images(options['directory'])
+        if not paths:
+            raise CommandError(f"No images found in {options['directory']}")
+
+        cascade = Cascade(first_size=options['first_size'], first_model_path=options['first_model'],
+                          escalation_model_path=options['escalation_model'])
+        try:
+            report = sweep_thresholds(paths, labels, thresholds, cascade)
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(f"Cascade sweep failed: {e}")
+
+        self.stdout.write(
+            f"{report['images']} images, accuracy against {report['accuracy_against']}\n"
+            f"First stage only ({report['first_size']}px): accuracy {report['first_only']['accuracy'] * 100:.2f}%, "
+            f"{report['first_only']['mean_ms']} ms\n"
+            f"Escalation model only: accuracy {report['full_only']['accuracy'] * 100:.2f}%, "
+            f"{report['full_only']['mean_ms']} ms"
+        )
+        self.stdout.write(f"{'threshold':>9} {'escalated':>9} {'accuracy':>9} {'mean ms':>9}")
+        for row in report['thresholds']:
+            self.stdout.write(
+                f"{row['threshold']:>9} {row['escalation_rate'] * 100:>8.1f}% "
+                f"{row['accuracy'] * 100:>8.2f}% {row['mean_ms']:>9}"
+            )
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,83 @@
+import threading
+import unittest
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from unittest import mock
+
+import torch
+
+from ml_batching import BatchingEngine, _run_engine
+from ml_errors import QueueFullError
+
+
+class _GatedModel:
+    """predict_fn that records each batch and blocks until released."""
+
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append(batch.clone())
+        self.started.set()
+        self.release.wait(5)
+        return batch.flatten(1).sum(dim=1)
+
+
+def _image(value, size=2):
+    return torch.full((3, size, size), float(value))
+
+
+class BatchingEngineTests(unittest.TestCase):
+
+    def engine(self, model, **kwargs):
+        engine = BatchingEngine(model, **{'max_wait_ms': 50, **kwargs}).start()
+        self.addCleanup(engine.shutdown)
+        self.addCleanup(model.release.set)
+        return engine
+
+    def busy_engine(self, **kwargs):
+        """An engine whose thread is stuck in a forward pass, so submissions queue up."""
+        model = _GatedModel()
+        engine = self.engine(model, **kwargs)
+        engine.submit(_image(0))
+        self.assertTrue(model.started.wait(5))
+        return model, engine
+
+    def test_queued_requests_share_a_batch_up_to_max_size(self):
+        model, engine = self.busy_engine(max_batch_size=4)
+        futures = [engine.submit(_image(i)) for i in range(1, 6)]
+        model.release.set()
+        # Every caller gets its own row back
+        self.assertEqual([f.result(5).item() for f in futures], [12.0 * i for i in range(1, 6)])
+        self.assertEqual([len(batch) for batch in model.batches], [1, 4, 1])
+
+    def test_different_shapes_run_in_separate_batches(self):
+        model, engine = self.busy_engine()
+        small, large = engine.submit(_image(1, 2)), engine.submit(_image(1, 3))
+        model.release.set()
+        self.assertEqual((small.result(5).item(), large.result(5).item()), (12.0, 27.0))
+        self.assertEqual(sorted(tuple(batch.shape) for batch in model.batches[1:]), [(1, 3, 2, 2), (1, 3, 3, 3)])
+
+    def test_full_queue_is_rejected(self):
+        model, engine = self.busy_engine(max_queue_size=1)
+        engine.submit(_image(1))
+        with self.assertRaises(QueueFullError):
+            engine.submit(_image(2))
+
+    def test_forward_errors_reach_every_caller(self):
+        engine = BatchingEngine(mock.Mock(side_effect=RuntimeError('boom'))).start()
+        self.addCleanup(engine.shutdown)
+        with self.assertLogs('ml_batching', 'ERROR'), self.assertRaisesRegex(RuntimeError, 'boom'):
+            engine.submit(_image(1)).result(5)
+
+    def test_timed_out_request_is_cancelled_and_skipped(self):
+        model, engine = self.busy_engine()
+        with mock.patch('ml_batching.get_engine', return_value=engine):
+            with self.assertRaises(FutureTimeoutError):
+                _run_engine(_image(7), 0.05, None, False)
+        later = engine.submit(_image(1))
+        model.release.set()
+        self.assertEqual(later.result(5).item(), 12.0)
+        # The abandoned image never took a slot in a forward pass
+        self.assertEqual([batch[:, 0, 0, 0].tolist() for batch in model.batches], [[0.0], [1.0]])
@@ -0,0 +1,68 @@
+import unittest
+
+from ml_benchmarks import PIPELINE_SCHEMA, compare_benchmarks
+
+
+def _results(decode_p50=10.0, forward_p50=20.0, images_per_second=100.0, weight_bytes=1000, schema=PIPELINE_SCHEMA):
+    return {
+        'schema': schema,
+        'stages': {
+            'decode': {'p50_ms': decode_p50, 'p95_ms': decode_p50},
+            'forward': {'p50_ms': forward_p50, 'p95_ms': forward_p50},
+        },
+        'throughput': [{'batch_size': 8, 'forward_images_per_second': images_per_second,
+                        'pipeline_images_per_second': images_per_second}],
+        'memory': {'model_weight_bytes': weight_bytes},
+    }
+
+
+def _regressed(rows):
+    return sorted(row['metric'] for row in rows if row['regressed'])
+
+
+class CompareBenchmarksTests(unittest.TestCase):
+
+    def test_identical_runs_pass(self):
+        rows = compare_benchmarks(_results(), _results())
+        self.assertEqual(_regressed(rows), [])
+        self.assertTrue(all(row['change'] == 0 for row in rows))
+
+    def test_latency_over_budget_regresses(self):
+        rows = compare_benchmarks(_results(), _results(forward_p50=23.0))
+        self.assertEqual(_regressed(rows), ['stages.forward.p50_ms', 'stages.forward.p95_ms'])
+        row = next(r for r in rows if r['metric'] == 'stages.forward.p50_ms')
+        self.assertEqual((row['baseline'], row['current'], row['change'], row['budget']), (20.0, 23.0, 0.15, 0.1))
+
+    def test_latency_within_budget_and_improvements_pass(self):
+        self.assertEqual(_regressed(compare_benchmarks(_results(), _results(forward_p50=21.5))), [])
+        self.assertEqual(_regressed(compare_benchmarks(_results(), _results(forward_p50=5.0))), [])
+
+    def test_changes_below_min_delta_never_regress(self):
+        baseline = _results(decode_p50=0.2)
+        self.assertEqual(_regressed(compare_benchmarks(baseline, _results(decode_p50=0.6))), [])
+        self.assertEqual(_regressed(compare_benchmarks(baseline, _results(decode_p50=0.6), min_delta_ms=0.1)),
+                         ['stages.decode.p50_ms', 'stages.decode.p95_ms'])
+
+    def test_lower_throughput_is_worse(self):
+        rows = compare_benchmarks(_results(), _results(images_per_second=80.0))
+        self.assertEqual(_regressed(rows), ['throughput.batch8.forward_images_per_second',
+                                            'throughput.batch8.pipeline_images_per_second'])
+        self.assertEqual(_regressed(compare_benchmarks(_results(), _results(images_per_second=150.0))), [])
+
+    def test_per_category_budgets(self):
+        current = _results(forward_p50=23.0, weight_bytes=1150)
+        self.assertEqual(_regressed(compare_benchmarks(_results(), current)),
+                         ['memory.model_weight_bytes', 'stages.forward.p50_ms', 'stages.forward.p95_ms'])
+        budgets = {'forward': 0.2, 'memory': 0.2}
+        self.assertEqual(_regressed(compare_benchmarks(_results(), current, budgets)), [])
+
+    def test_metrics_missing_from_the_baseline_are_skipped(self):
+        baseline = _results()
+        del baseline['stages']['decode']
+        metrics = {row['metric'] for row in compare_benchmarks(baseline, _results())}
+        self.assertNotIn('stages.decode.p50_ms', metrics)
+        self.assertIn('stages.forward.p50_ms', metrics)
+
+    def test_schema_mismatch_is_refused(self):
+        with self.assertRaises(ValueError):
+            compare_benchmarks(_results(schema=0), _results())
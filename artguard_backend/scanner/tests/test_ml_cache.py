@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ml_cache import PredictionCache, cache_key
+
+
+class PredictionCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite3')
+
+    def test_key_covers_bytes_version_and_policy(self):
+        key = cache_key(b'image', 'v1', 'stretch')
+        self.assertEqual(key, cache_key(b'image', 'v1', 'stretch'))
+        self.assertNotEqual(key, cache_key(b'other', 'v1', 'stretch'))
+        self.assertNotEqual(key, cache_key(b'image', 'v2', 'stretch'))
+        self.assertNotEqual(key, cache_key(b'image', 'v1', 'center_crop'))
+
+    def test_put_then_get_from_memory(self):
+        cache = PredictionCache(self.path)
+        self.assertIsNone(cache.get('k'))
+        cache.put('k', 'v1', 'AI', 0.9)
+        self.assertEqual(cache.get('k'), ('AI', 0.9))
+        self.assertEqual((cache.memory_hits, cache.disk_hits, cache.misses), (1, 0, 1))
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        cache = PredictionCache(self.path, memory_items=2)
+        cache.put('a', 'v1', 'AI', 0.9)
+        cache.put('b', 'v1', 'Print', 0.8)
+        cache.get('a')
+        cache.put('c', 'v1', 'Handmade', 0.7)
+        self.assertEqual(list(cache._memory), ['a', 'c'])
+        # Evicted from memory, still on disk
+        self.assertEqual(cache.get('b'), ('Print', 0.8))
+        self.assertEqual(cache.disk_hits, 1)
+
+    def test_disk_tier_is_shared_between_instances(self):
+        PredictionCache(self.path).put('k', 'v1', 'Print', 0.75)
+        other = PredictionCache(self.path)
+        self.assertEqual(other.get('k'), ('Print', 0.75))
+        self.assertEqual(other.disk_hits, 1)
+        # Promoted into the reader's memory tier
+        self.assertEqual(other.get('k'), ('Print', 0.75))
+        self.assertEqual(other.memory_hits, 1)
+
+    def test_prune_drops_the_oldest_rows(self):
+        cache = PredictionCache(self.path, memory_items=0, max_rows=2)
+        with mock.patch('ml_cache.time.time', side_effect=[1.0, 2.0, 3.0]):
+            for key in ('old', 'middle', 'new'):
+                cache.put(key, 'v1', 'AI', 0.9)
+        cache.prune()
+        self.assertIsNone(cache.get('old'))
+        self.assertEqual(cache.get('middle'), ('AI', 0.9))
+        self.assertEqual(cache.get('new'), ('AI', 0.9))
+
+    def test_lookup_or_predict_runs_the_model_once(self):
+        cache = PredictionCache(self.path)
+        predict = mock.Mock(return_value=('Handmade', 0.6))
+        self.assertEqual(cache.lookup_or_predict(b'image', 'v1', 'stretch', predict), ('Handmade', 0.6, False))
+        self.assertEqual(cache.lookup_or_predict(b'image', 'v1', 'stretch', predict), ('Handmade', 0.6, True))
+        self.assertEqual(predict.call_count, 1)
+        cache.lookup_or_predict(b'image', 'v2', 'stretch', predict)
+        self.assertEqual(predict.call_count, 2)
@@ -0,0 +1,44 @@
+import unittest
+
+from ml_feedback import feedback_targets, in_holdout
+
+
+def _row(scan_id, helpful, predicted='AI', corrected=None):
+    return {'scan_id': scan_id, 'helpful': helpful, 'predicted_label': predicted, 'corrected_label': corrected}
+
+
+class FeedbackTargetsTests(unittest.TestCase):
+
+    def test_helpful_confirms_the_prediction(self):
+        self.assertEqual(feedback_targets([_row('a', True, 'Print')]), {'a': 'Print'})
+
+    def test_correction_wins_over_the_prediction(self):
+        self.assertEqual(feedback_targets([_row('a', False, 'AI', 'Handmade')]), {'a': 'Handmade'})
+
+    def test_thumbs_down_without_correction_is_left_out(self):
+        self.assertEqual(feedback_targets([_row('a', False, 'AI')]), {})
+
+    def test_latest_verdict_per_scan_counts(self):
+        rows = [_row('a', True, 'AI'), _row('b', True, 'Print'), _row('a', False, 'AI', 'Print'), _row('b', False)]
+        self.assertEqual(feedback_targets(rows), {'a': 'Print'})
+
+    def test_unknown_labels_are_left_out(self):
+        self.assertEqual(feedback_targets([_row('a', True, 'Unknown'), _row('b', False, 'AI', 'Sculpture')]), {})
+
+
+class HoldoutTests(unittest.TestCase):
+
+    def test_assignment_is_stable(self):
+        self.assertEqual([in_holdout(f'scan-{i}') for i in range(50)], [in_holdout(f'scan-{i}') for i in range(50)])
+        self.assertEqual(in_holdout(42), in_holdout('42'))
+
+    def test_percent_bounds(self):
+        ids = [f'scan-{i}' for i in range(200)]
+        self.assertFalse(any(in_holdout(scan_id, 0) for scan_id in ids))
+        self.assertTrue(all(in_holdout(scan_id, 100) for scan_id in ids))
+
+    def test_share_follows_percent(self):
+        share = sum(in_holdout(f'scan-{i}', 20) for i in range(2000)) / 2000
+        self.assertAlmostEqual(share, 0.2, delta=0.03)
+        # Raising the percentage only adds scans to the holdout
+        self.assertTrue(all(in_holdout(f'scan-{i}', 30) for i in range(2000) if in_holdout(f'scan-{i}', 20)))
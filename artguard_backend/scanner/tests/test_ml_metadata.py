@@ -0,0 +1,107 @@
+import io
+import struct
+import unittest
+import zlib
+
+from PIL import Image
+
+from ml_metadata import decide, inspect_metadata
+
+SOFTWARE, MAKE, MODEL = 0x0131, 0x010F, 0x0110
+XMP_AI = 'http://cv.iptc.org/newscodes/digitalsourcetype/trainedAlgorithmicMedia'
+
+
+def _png(*chunks):
+    """A PNG container with the given (type, body) chunks; no pixels are needed."""
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+    ihdr = struct.pack('>IIBBBBB', 8, 8, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr)
+            + b''.join(chunk(kind, body) for kind, body in chunks) + chunk(b'IEND', b''))
+
+
+def _jpeg(**tags):
+    exif = Image.Exif()
+    for tag, value in tags.items():
+        exif[{'software': SOFTWARE, 'make': MAKE, 'model': MODEL}[tag]] = value
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+def _webp(*chunks):
+    body = b'WEBP' + b''.join(
+        kind + struct.pack('<I', len(data)) + data + b'\x00' * (len(data) & 1) for kind, data in chunks)
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def _cbor_text(text):
+    data = text.encode()
+    return (bytes([0x60 + len(data)]) if len(data) < 24 else bytes([0x78, len(data)])) + data
+
+
+def _claim(generator, *rest):
+    return _cbor_text('claim_generator') + _cbor_text(generator) + b''.join(rest)
+
+
+class MetadataRuleTests(unittest.TestCase):
+
+    def labels(self, image_bytes):
+        return [(e['label'], e['source']) for e in inspect_metadata(image_bytes)['evidence']]
+
+    def test_png_generation_parameters(self):
+        data = _png((b'tEXt', b'parameters\x00a castle\nSteps: 20, Sampler: Euler a, CFG scale: 7'))
+        result = inspect_metadata(data)
+        self.assertEqual(result['format'], 'png')
+        self.assertEqual(self.labels(data), [('AI', 'png:parameters')])
+        self.assertEqual(decide(result['evidence']), 'AI')
+
+    def test_png_text_without_generator_signature(self):
+        data = _png((b'tEXt', b'parameters\x00exposure 1/250'), (b'tEXt', b'Software\x00GIMP 2.10'))
+        self.assertEqual(self.labels(data), [])
+
+    def test_png_itxt_xmp_source_type(self):
+        xmp = f'<x:xmpmeta><Iptc4xmpExt:DigitalSourceType>{XMP_AI}</Iptc4xmpExt:DigitalSourceType></x:xmpmeta>'
+        data = _png((b'iTXt', b'XML:com.adobe.xmp\x00\x00\x00\x00\x00' + xmp.encode()))
+        self.assertEqual(self.labels(data), [('AI', 'xmp')])
+
+    def test_jpeg_exif_software(self):
+        self.assertEqual(self.labels(_jpeg(software='Midjourney v6')), [('AI', 'exif:Software')])
+
+    def test_jpeg_scanner_is_not_decisive_alone(self):
+        result = inspect_metadata(_jpeg(make='EPSON', model='Perfection V600'))
+        self.assertEqual([e['label'] for e in result['evidence']], ['Print'])
+        self.assertIsNone(decide(result['evidence']))
+        self.assertEqual(decide(result['evidence'], threshold=0.8), 'Print')
+
+    def test_webp_c2pa_claim_generator(self):
+        data = _webp((b'VP8 ', b'\x00' * 10), (b'C2PA', _claim('Adobe_Firefly/1.0')))
+        result = inspect_metadata(data)
+        self.assertEqual(result['format'], 'webp')
+        self.assertEqual(self.labels(data), [('AI', 'c2pa:claim_generator')])
+
+    def test_c2pa_generative_edit_is_not_decisive(self):
+        # A photo edited with generative fill: Photoshop claims it, an action names Firefly
+        manifest = _claim(
+            'Adobe_Photoshop/25.0', _cbor_text('softwareAgent'), _cbor_text('Adobe Firefly'),
+            b'digitalsourcetype/compositeWithTrainedAlgorithmicMedia')
+        result = inspect_metadata(_webp((b'C2PA', manifest)))
+        self.assertEqual([(e['source'], e['confidence']) for e in result['evidence']], [('c2pa', 0.9)])
+        self.assertIsNone(decide(result['evidence']))
+
+    def test_c2pa_claim_generator_info_name(self):
+        manifest = (_cbor_text('claim_generator_info') + b'\x81\xa1' + _cbor_text('name')
+                    + _cbor_text('Microsoft Designer / DALL-E 3'))
+        self.assertEqual(self.labels(_webp((b'C2PA', manifest))), [('AI', 'c2pa:claim_generator')])
+
+    def test_conflicting_decisive_evidence_decides_nothing(self):
+        evidence = [
+            {'label': 'AI', 'confidence': 0.99, 'source': 'png:parameters', 'detail': ''},
+            {'label': 'Print', 'confidence': 0.97, 'source': 'xmp', 'detail': ''},
+        ]
+        self.assertIsNone(decide(evidence))
+
+    def test_unknown_and_truncated_files(self):
+        self.assertEqual(inspect_metadata(b'GIF89a....'), {'format': None, 'evidence': []})
+        data = _png((b'tEXt', b'parameters\x00Steps: 20, Sampler: Euler'))
+        self.assertEqual(inspect_metadata(data[:40])['format'], 'png')
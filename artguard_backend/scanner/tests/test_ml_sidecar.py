@@ -0,0 +1,69 @@
+import socket
+import struct
+import threading
+import unittest
+
+from ml_sidecar import (
+    FLAG_NEAR_DUPLICATE, IMAGE, MAX_PAYLOAD_BYTES, OK, PROTOCOL_VERSION, QUEUE_FULL, RECORD, REQUEST_HEADER,
+    ProtocolError, read_request, read_response, send_request, send_response,
+)
+
+
+class FramingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+
+    def test_request_round_trip(self):
+        send_request(self.client, IMAGE, b'v2', b'\xff\xd8jpeg', policy=1, flags=FLAG_NEAR_DUPLICATE)
+        self.assertEqual(read_request(self.server), (IMAGE, 1, FLAG_NEAR_DUPLICATE, b'v2', b'\xff\xd8jpeg'))
+
+    def test_requests_follow_each_other_on_one_connection(self):
+        send_request(self.client, IMAGE, payload=b'first')
+        send_request(self.client, RECORD, b'{"scan_id": "s"}', b'\x00' * 8)
+        self.assertEqual(read_request(self.server), (IMAGE, 0, 0, b'', b'first'))
+        self.assertEqual(read_request(self.server), (RECORD, 0, 0, b'{"scan_id": "s"}', b'\x00' * 8))
+
+    def test_response_round_trip(self):
+        send_response(self.server, OK, {'label': 'AI', 'confidence': 0.9}, b'\x01\x02')
+        self.assertEqual(read_response(self.client), (OK, {'label': 'AI', 'confidence': 0.9}, b'\x01\x02'))
+        send_response(self.server, QUEUE_FULL, {'error': 'full'})
+        self.assertEqual(read_response(self.client), (QUEUE_FULL, {'error': 'full'}, b''))
+
+    def test_large_payload_arrives_whole(self):
+        payload = bytes(range(256)) * 4096
+        sender = threading.Thread(target=send_request, args=(self.client, IMAGE, b'', payload))
+        sender.start()
+        self.assertEqual(read_request(self.server)[4], payload)
+        sender.join()
+
+    def test_bad_magic_is_rejected(self):
+        self.client.sendall(REQUEST_HEADER.pack(b'XX', PROTOCOL_VERSION, IMAGE, 0, 0, 0, 0))
+        with self.assertRaises(ProtocolError):
+            read_request(self.server)
+
+    def test_oversized_payload_is_rejected_before_reading_it(self):
+        self.client.sendall(REQUEST_HEADER.pack(b'AG', PROTOCOL_VERSION, IMAGE, 0, 0, 0, MAX_PAYLOAD_BYTES + 1))
+        with self.assertRaises(ProtocolError):
+            read_request(self.server)
+
+    def test_clean_close_and_truncated_frame(self):
+        self.client.shutdown(socket.SHUT_WR)
+        with self.assertRaises(EOFError):
+            read_request(self.server)
+
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        client.sendall(REQUEST_HEADER.pack(b'AG', PROTOCOL_VERSION, IMAGE, 0, 0, 0, 10) + b'short')
+        client.shutdown(socket.SHUT_WR)
+        with self.assertRaises(ProtocolError):
+            read_request(server)
+
+    def test_header_layout(self):
+        # Wire format from the module docstring: 2s B B B B H I, big-endian
+        self.assertEqual(REQUEST_HEADER.size, 12)
+        self.assertEqual(struct.unpack('!2sBBBBHI', REQUEST_HEADER.pack(b'AG', 1, 2, 3, 4, 5, 6)),
+                         (b'AG', 1, 2, 3, 4, 5, 6))
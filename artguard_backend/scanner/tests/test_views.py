@@ -0,0 +1,82 @@
+import json
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase
+
+
+SCAN = {
+    'id': 'scan-1',
+    'user_id': 'user-1',
+    'result': {'label': 'AI', 'confidence': 0.91, 'model_version': 'v1'},
+}
+
+
+@mock.patch('scanner.views.log_scan_feedback')
+@mock.patch('scanner.views.fetch_scan_record')
+class SubmitFeedbackTests(SimpleTestCase):
+    """POST /api/feedback/ with the Supabase helpers patched out."""
+
+    def post(self, body):
+        return self.client.post('/api/feedback/', json.dumps(body), content_type='application/json')
+
+    def test_helpful(self, fetch_scan_record, log_scan_feedback):
+        fetch_scan_record.return_value = SCAN
+        log_scan_feedback.return_value = {'scan_id': 'scan-1', 'helpful': True}
+        response = self.post({'scan_id': 'scan-1', 'helpful': True, 'user_id': 'user-1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['success'])
+        fetch_scan_record.assert_called_once_with('scan-1', 'user-1')
+        log_scan_feedback.assert_called_once_with('scan-1', 'user-1', True, 'AI', None, 'v1')
+
+    def test_correct_label(self, fetch_scan_record, log_scan_feedback):
+        fetch_scan_record.return_value = SCAN
+        log_scan_feedback.return_value = {'scan_id': 'scan-1', 'helpful': False, 'corrected_label': 'Handmade'}
+        response = self.post({'scan_id': 'scan-1', 'helpful': False, 'correct_label': 'Handmade'})
+        self.assertEqual(response.status_code, 200)
+        log_scan_feedback.assert_called_once_with('scan-1', 'anonymous', False, 'AI', 'Handmade', 'v1')
+
+    def test_helpful_with_different_label_is_rejected(self, fetch_scan_record, log_scan_feedback):
+        fetch_scan_record.return_value = SCAN
+        response = self.post({'scan_id': 'scan-1', 'helpful': True, 'correct_label': 'Print'})
+        self.assertEqual(response.status_code, 400)
+        log_scan_feedback.assert_not_called()
+
+    def test_unknown_label_is_rejected(self, fetch_scan_record, log_scan_feedback):
+        response = self.post({'scan_id': 'scan-1', 'helpful': False, 'correct_label': 'Sculpture'})
+        self.assertEqual(response.status_code, 400)
+        fetch_scan_record.assert_not_called()
+
+    def test_missing_helpful_is_rejected(self, fetch_scan_record, log_scan_feedback):
+        response = self.post({'scan_id': 'scan-1'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_scan(self, fetch_scan_record, log_scan_feedback):
+        fetch_scan_record.return_value = None
+        response = self.post({'scan_id': 'missing', 'helpful': True})
+        self.assertEqual(response.status_code, 404)
+        log_scan_feedback.assert_not_called()
+
+
+@mock.patch('scanner.views.log_scan_to_supabase', return_value={'id': 'scan-2'})
+@mock.patch('scanner.views.upload_image_to_cloudinary',
+            return_value={'url': 'https://example.com/a.jpg', 'public_id': 'a', 'filename': 'a.jpg'})
+@mock.patch('scanner.views.get_sidecar_client', return_value=None)
+class CompleteScanTests(SimpleTestCase):
+    """POST /api/complete-scan/ with upload, inference and Supabase patched out."""
+
+    def test_near_duplicate_does_not_reveal_the_earlier_scan(self, get_sidecar_client, upload, log_scan):
+        prediction = {
+            'label': 'Print', 'confidence': 0.8, 'cached': True, 'model_version': 'v1',
+            'near_duplicate_of': 'someone-elses-scan', 'similarity': 0.99, 'embedding': None,
+        }
+        with mock.patch('scanner.views._classify_in_process', return_value=prediction):
+            response = self.client.post('/api/complete-scan/', {
+                'image': SimpleUploadedFile('a.jpg', b'jpeg bytes', content_type='image/jpeg'),
+                'user_id': 'user-1',
+            })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()['data']
+        self.assertEqual((data['label'], data['cached'], data['scan_id']), ('Print', True, 'scan-2'))
+        self.assertNotIn('someone-elses-scan', json.dumps(response.json()))
+        self.assertNotIn('someone-elses-scan', json.dumps(log_scan.call_args[0][2]))
@@ -6,12 +6,15 @@ urlpatterns = [
     path('upload/', views.upload_image, name='upload_image'),
     path('complete-scan/', views.complete_scan, name='complete_scan'),
     path('health/', views.health_check, name='health_check'),
+    path('inference/status/', views.inference_status, name='inference_status'),
+    path('metrics/', views.metrics, name='metrics'),
     
     # Scan history management
     path('scan-history/', views.get_scan_history, name='get_scan_history'),
     path('scan/<str:scan_id>/', views.get_scan_by_id, name='get_scan_by_id'),
     path('scan/<str:scan_id>/update/', views.update_scan, name='update_scan'),
     path('delete-scan/', views.delete_scan, name='delete_scan'),
+    path('feedback/', views.submit_feedback, name='submit_feedback'),
     path('batch-delete/', views.batch_delete_scans, name='batch_delete_scans'),
     
     # Analytics and search
@@ -1,9 +1,27 @@
 import os
 import uuid
 from django.conf import settings
-import cloudinary
-import cloudinary.uploader
-from cloudinary.exceptions import Error as CloudinaryError
+
+
+def _cloudinary():
+    """
+    Import and configure the Cloudinary SDK on first use instead of at import
+    time, which every Django process pays through the scanner views.
+    
+    Returns:
+        (uploader module, Cloudinary's base exception class)
+    """
+    import cloudinary
+    import cloudinary.uploader
+    from cloudinary.exceptions import Error as CloudinaryError
+    
+    # Configure Cloudinary with settings
+    cloudinary.config(
+        cloud_name=settings.CLOUDINARY_CLOUD_NAME,
+        api_key=settings.CLOUDINARY_API_KEY,
+        api_secret=settings.CLOUDINARY_API_SECRET
+    )
+    return cloudinary.uploader, CloudinaryError
 
 
 def upload_image_to_cloudinary(image_file, user_id):
@@ -18,14 +36,8 @@ def upload_image_to_cloudinary(image_file, user_id):
         dict: Contains 'url' (str) and 'public_id' (str) on success
         None: On failure
     """
+    uploader, CloudinaryError = _cloudinary()
     try:
-        # Configure Cloudinary with settings
-        cloudinary.config(
-            cloud_name=settings.CLOUDINARY_CLOUD_NAME,
-            api_key=settings.CLOUDINARY_API_KEY,
-            api_secret=settings.CLOUDINARY_API_SECRET
-        )
-        
         # Generate a unique filename to avoid conflicts
         file_extension = os.path.splitext(image_file.name)[1]
         unique_filename = f"{uuid.uuid4().hex}{file_extension}"
@@ -34,7 +46,7 @@ def upload_image_to_cloudinary(image_file, user_id):
         folder_path = f"user_uploads/{user_id}"
         
         # Upload to Cloudinary
-        upload_result = cloudinary.uploader.upload(
+        upload_result = uploader.upload(
             image_file,
             folder=folder_path,
             public_id=unique_filename,
@@ -67,14 +79,9 @@ def delete_image_from_cloudinary(public_id):
     Returns:
         bool: True if successful, False otherwise
     """
+    uploader, CloudinaryError = _cloudinary()
     try:
-        cloudinary.config(
-            cloud_name=settings.CLOUDINARY_CLOUD_NAME,
-            api_key=settings.CLOUDINARY_API_KEY,
-            api_secret=settings.CLOUDINARY_API_SECRET
-        )
-        
-        result = cloudinary.uploader.destroy(public_id)
+        result = uploader.destroy(public_id)
         return result.get('result') == 'ok'
         
     except CloudinaryError as e:
@@ -1,7 +1,6 @@
 import logging
+import threading
 from typing import Optional, Dict, List, Any
-from supabase import create_client, Client
-from supabase.lib.client_options import ClientOptions
 import os
 from datetime import datetime, timezone
 import json
@@ -18,26 +17,58 @@ logger = logging.getLogger(__name__)
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 
-# Validate required configuration
-if not SUPABASE_URL:
-    raise RuntimeError("SUPABASE_URL is missing. Please set SUPABASE_URL in your .env file at the project root.")
-if not SUPABASE_KEY:
-    raise RuntimeError("SUPABASE_SERVICE_KEY is missing. Please set SUPABASE_SERVICE_KEY in your .env file at the project root.")
-
-# Initialize Supabase client with options
-client_options = ClientOptions(
-    schema='public',
-    headers={
-        'X-Client-Info': 'artguard-backend/1.0.0'
-    }
-)
-
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=client_options)
-    logger.info("Supabase client initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize Supabase client: {e}")
-    raise
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_supabase():
+    """
+    The shared Supabase client, created on first use so that importing this
+    module (every Django process does, through the scanner views) neither
+    loads the supabase package nor needs credentials or a connection.
+    
+    Returns:
+        Client: Supabase client
+        
+    Raises:
+        RuntimeError: If SUPABASE_URL or SUPABASE_SERVICE_KEY is missing
+    """
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            # Validate required configuration
+            if not SUPABASE_URL:
+                raise RuntimeError("SUPABASE_URL is missing. Please set SUPABASE_URL in your .env file at the project root.")
+            if not SUPABASE_KEY:
+                raise RuntimeError("SUPABASE_SERVICE_KEY is missing. Please set SUPABASE_SERVICE_KEY in your .env file at the project root.")
+            
+            from supabase import create_client
+            from supabase.lib.client_options import ClientOptions
+            
+            # Initialize Supabase client with options
+            client_options = ClientOptions(
+                schema='public',
+                headers={
+                    'X-Client-Info': 'artguard-backend/1.0.0'
+                }
+            )
+            
+            try:
+                _client = create_client(SUPABASE_URL, SUPABASE_KEY, options=client_options)
+                logger.info("Supabase client initialized successfully")
+            except Exception as e:
+                logger.error(f"Failed to initialize Supabase client: {e}")
+                raise
+    return _client
+
+
+def __getattr__(name):
+    # Keeps "from scanner.utils.supabase_client import supabase" working, lazily
+    if name == 'supabase':
+        return get_supabase()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class SupabaseError(Exception):
     """Custom exception for Supabase operations"""
@@ -75,7 +106,7 @@ def log_scan_to_supabase(user_id: str, artwork_url: str, scan_data: Dict[str, An
         }
         
         # Insert the record
-        response = supabase.table("scan_history").insert(scan_record).execute()
+        response = get_supabase().table("scan_history").insert(scan_record).execute()
         
         if response.data:
             logger.info(f"Successfully logged scan for user {user_id}")
@@ -110,7 +141,7 @@ def get_user_scan_history(user_id: str, limit: int = 50, offset: int = 0) -> Opt
         # Limit the maximum number of records
         limit = min(limit, 100)
         
-        response = supabase.table("scan_history")\
+        response = get_supabase().table("scan_history")\
             .select("*")\
             .eq("user_id", user_id)\
             .order("created_at", desc=True)\
@@ -146,7 +177,7 @@ def delete_scan_record(scan_id: str, user_id: str = None) -> Optional[Dict]:
             return None
         
         # Build the query
-        query = supabase.table("scan_history").delete()
+        query = get_supabase().table("scan_history").delete()
         
         # If user_id is provided, ensure the user owns the record
         if user_id:
@@ -188,7 +219,7 @@ def get_scan_analytics(user_id: str, days: int = 30) -> Optional[Dict]:
         from datetime import timedelta
         cutoff_date = datetime.now(timezone.utc) - timedelta(days=days)
         
-        response = supabase.table("scan_history")\
+        response = get_supabase().table("scan_history")\
             .select("*")\
             .eq("user_id", user_id)\
             .gte("created_at", cutoff_date.isoformat())\
@@ -240,7 +271,7 @@ def batch_delete_scans(scan_ids: List[str], user_id: str = None) -> Optional[Dic
             scan_ids = scan_ids[:100]
         
         # Build the query
-        query = supabase.table("scan_history").delete()
+        query = get_supabase().table("scan_history").delete()
         
         # If user_id is provided, ensure the user owns the records
         if user_id:
@@ -281,7 +312,7 @@ def search_scans(user_id: str, query: str, limit: int = 20) -> Optional[Dict]:
             return None
         
         # Use full-text search if available, otherwise filter by URL
-        response = supabase.table("scan_history")\
+        response = get_supabase().table("scan_history")\
             .select("*")\
             .eq("user_id", user_id)\
             .ilike("artwork_url", f"%{query}%")\
@@ -319,7 +350,7 @@ def update_scan_record(scan_id: str, updates: Dict[str, Any], user_id: str = Non
             return None
         
         # Build the query
-        query = supabase.table("scan_history").update(updates)
+        query = get_supabase().table("scan_history").update(updates)
         
         # If user_id is provided, ensure the user owns the record
         if user_id:
@@ -358,7 +389,7 @@ def get_scan_by_id(scan_id: str, user_id: str = None) -> Optional[Dict]:
             return None
         
         # Build the query
-        query = supabase.table("scan_history").select("*").eq("id", scan_id)
+        query = get_supabase().table("scan_history").select("*").eq("id", scan_id)
         
         # If user_id is provided, ensure the user owns the record
         if user_id:
@@ -375,4 +406,123 @@ def get_scan_by_id(scan_id: str, user_id: str = None) -> Optional[Dict]:
             
     except Exception as e:
         logger.error(f"Error retrieving scan record from Supabase: {e}")
-        return None 
\ No newline at end of file
+        return None 
+
+
+def get_all_scans(limit: int = 500, offset: int = 0) -> Optional[List[Dict]]:
+    """
+    Page through every user's scan records, oldest first (for offline jobs
+    such as rebuilding the embedding index)
+
+    Args:
+        limit: Maximum number of records to return (default: 500, max: 1000)
+        offset: Number of records to skip for pagination (default: 0)
+
+    Returns:
+        list: Scan records with id, artwork_url and result
+        None: On failure
+    """
+    try:
+        limit = min(limit, 1000)
+
+        response = get_supabase().table("scan_history")\
+            .select("id, artwork_url, result, created_at")\
+            .order("created_at", desc=False)\
+            .order("id", desc=False)\
+            .range(offset, offset + limit - 1)\
+            .execute()
+
+        if response.data is not None:
+            logger.info(f"Retrieved {len(response.data)} scan records at offset {offset}")
+            return response.data
+        else:
+            logger.error("No data returned from Supabase query")
+            return None
+
+    except Exception as e:
+        logger.error(f"Error retrieving scan records from Supabase: {e}")
+        return None
+
+
+def log_scan_feedback(scan_id: str, user_id: str, helpful: bool, predicted_label: str,
+                      corrected_label: str = None, model_version: str = None) -> Optional[Dict]:
+    """
+    Store a user's verdict on a scan result in the scan_feedback table; a
+    second verdict from the same user on the same scan replaces the first
+
+    Args:
+        scan_id: The ID of the scan the feedback is about
+        user_id: The user giving the feedback
+        helpful: Whether the user agrees with the predicted label
+        predicted_label: The label the scan was given
+        corrected_label: The label the user says is right (optional)
+        model_version: The model version that classified the scan (optional)
+
+    Returns:
+        dict: The stored feedback record
+        None: On failure
+    """
+    try:
+        if not scan_id or not user_id:
+            logger.error("scan_id and user_id are required")
+            return None
+
+        feedback_record = {
+            "scan_id": scan_id,
+            "user_id": user_id,
+            "helpful": helpful,
+            "predicted_label": predicted_label,
+            "corrected_label": corrected_label,
+            "model_version": model_version,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+
+        response = get_supabase().table("scan_feedback")\
+            .upsert(feedback_record, on_conflict="scan_id,user_id")\
+            .execute()
+
+        if response.data:
+            logger.info(f"Stored feedback on scan {scan_id} from user {user_id}")
+            return response.data[0]
+        else:
+            logger.error("No data returned from Supabase upsert")
+            return None
+
+    except Exception as e:
+        logger.error(f"Error storing scan feedback in Supabase: {e}")
+        return None
+
+
+def get_all_feedback(limit: int = 1000, offset: int = 0) -> Optional[List[Dict]]:
+    """
+    Page through all scan feedback, oldest first (for offline jobs such as
+    refitting the classifier head)
+
+    Args:
+        limit: Maximum number of records to return (default: 1000, max: 1000)
+        offset: Number of records to skip for pagination (default: 0)
+
+    Returns:
+        list: Feedback records
+        None: On failure
+    """
+    try:
+        limit = min(limit, 1000)
+
+        response = get_supabase().table("scan_feedback")\
+            .select("scan_id, user_id, helpful, predicted_label, corrected_label, model_version, created_at")\
+            .order("created_at", desc=False)\
+            .order("id", desc=False)\
+            .range(offset, offset + limit - 1)\
+            .execute()
+
+        if response.data is not None:
+            logger.info(f"Retrieved {len(response.data)} feedback records at offset {offset}")
+            return response.data
+        else:
+            logger.error("No data returned from Supabase query")
+            return None
+
+    except Exception as e:
+        logger.error(f"Error retrieving scan feedback from Supabase: {e}")
+        return None
@@ -5,7 +5,9 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from .utils.storage import upload_image_to_cloudinary
 from .utils.supabase_client import (
     log_scan_to_supabase, 
@@ -15,13 +17,47 @@ from .utils.supabase_client import (
     batch_delete_scans,
     search_scans,
     update_scan_record,
-    get_scan_by_id
+    get_scan_by_id,
+    # Aliased: the get_scan_by_id view below shadows the helper's own name
+    get_scan_by_id as fetch_scan_record,
+    log_scan_feedback
 )
 import json
+from ml_errors import QueueFullError, UnknownVersionError
+from ml_metrics import CONTENT_TYPE, PREDICTIONS, STAGE_SECONDS, exposition
+from ml_sidecar import get_client as get_sidecar_client
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+
+def _classify_in_process(image_bytes, model_version):
+    """
+    complete_scan's inference step when no sidecar is configured: the metadata
+    fast path, then the prediction cache, near-duplicate lookup and this worker's
+    batching engine (ml_batching.classify_image_bytes). Returns the same dict as
+    SidecarClient.classify.
+    """
+    from ml_batching import classify_image_bytes
+    from ml_metadata import METADATA_VERSION, get_metadata_stage
+    
+    stage = get_metadata_stage() if not model_version else None
+    answer = stage.classify(image_bytes) if stage is not None else None
+    if answer is not None:
+        PREDICTIONS.labels('metadata').inc()
+        return {
+            'label': answer['label'],
+            'confidence': answer['confidence'],
+            'cached': False,
+            'model_version': METADATA_VERSION,
+            'near_duplicate_of': None,
+            'similarity': None,
+            'evidence': answer['evidence'],
+            'embedding': None
+        }
+    return classify_image_bytes(image_bytes, model_version=model_version)
+
+
 # Create your views here.
 
 @api_view(['POST'])
@@ -91,7 +127,8 @@ def upload_image(request):
         }
         
         # Log the upload to Supabase
-        supabase_log = log_scan_to_supabase(user_id, upload_result['url'], scan_data)
+        with STAGE_SECONDS.labels('supabase').time():
+            supabase_log = log_scan_to_supabase(user_id, upload_result['url'], scan_data)
         
         response_data = {
             'success': True,
@@ -127,6 +164,7 @@ def upload_image(request):
 @api_view(['POST'])
 @parser_classes([MultiPartParser, FormParser])
 @csrf_exempt
+@STAGE_SECONDS.labels('request').time()
 def complete_scan(request):
     """
     Complete scan process: Upload to Cloudinary, scan artwork, and log to Supabase
@@ -136,10 +174,22 @@ def complete_scan(request):
     - 'image' field containing the image file
     - 'user_id' field containing the user ID (optional, defaults to 'anonymous')
     - 'description' field containing scan description (optional)
+    - 'model_version' field pinning a published model version (optional, defaults to the active one)
+    
+    Uploads whose metadata decides the label (generator parameters, EXIF Software, C2PA or
+    IPTC source type, see ml_metadata) are answered without running the model, with the
+    metadata in 'evidence'. Uploads whose embedding is within ML_NEAR_DUPLICATE_THRESHOLD
+    cosine similarity of an earlier scan classified by the same model version reuse that
+    scan's result ('cached' true, with its 'similarity'). The earlier scan may belong to
+    another user, so its id is neither returned nor stored. Pinned versions are always
+    classified.
+    
+    With ML_SIDECAR_SOCKET set, inference runs in the inference server (run_inference_server)
+    and this worker never loads a model.
     
     Returns:
     - 200: Success with scan results and Cloudinary URL
-    - 400: Bad request (missing image or invalid data)
+    - 400: Bad request (missing image, invalid data or unknown model version)
     - 500: Server error during processing
     """
     try:
@@ -153,6 +203,7 @@ def complete_scan(request):
         image_file = request.FILES['image']
         user_id = request.data.get('user_id', 'anonymous')
         description = request.data.get('description', '')
+        model_version = request.data.get('model_version') or None
         
         # Validate file type (basic check)
         allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
@@ -169,8 +220,25 @@ def complete_scan(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        sidecar = get_sidecar_client()
+        
+        # Reject unknown pinned versions before uploading anything
+        if model_version:
+            try:
+                if sidecar is not None:
+                    sidecar.check_version(model_version)
+                else:
+                    from ml_versions import get_store
+                    get_store().manifest(model_version)
+            except UnknownVersionError as e:
+                return Response(
+                    {'error': str(e)}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        
         # Step 1: Upload to Cloudinary
-        upload_result = upload_image_to_cloudinary(image_file, user_id)
+        with STAGE_SECONDS.labels('upload').time():
+            upload_result = upload_image_to_cloudinary(image_file, user_id)
         
         if upload_result is None:
             return Response(
@@ -178,13 +246,34 @@ def complete_scan(request):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
-        # Step 2: Perform ML scan (mock for now, replace with actual ML inference)
-        # In production, this would call your ML model
-        import random
-        labels = ["Handmade", "AI-Generated", "Digital"]
+        # Step 2: Perform ML scan. Decisive metadata answers without the model, exact re-uploads
+        # come from the prediction cache and near-duplicates of earlier scans reuse their result;
+        # everything else goes through the shared batching engine
+        image_file.seek(0)
+        image_bytes = image_file.read()
+        try:
+            if sidecar is not None:
+                prediction = sidecar.classify(image_bytes, model_version=model_version,
+                                              near_duplicate=not model_version)
+            else:
+                prediction = _classify_in_process(image_bytes, model_version)
+        except ValueError as e:
+            return Response(
+                {'error': f'Unreadable image: {str(e)}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except QueueFullError as e:
+            return Response(
+                {'error': str(e)}, 
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         scan_result = {
-            'label': random.choice(labels),
-            'confidence': round(0.7 + random.random() * 0.29, 2)  # Between 0.7 and 0.99
+            'label': prediction['label'],
+            'confidence': round(prediction['confidence'], 2),
+            'cached': prediction['cached'],
+            'model_version': prediction['model_version'],
+            'similarity': prediction['similarity'],
+            'evidence': prediction.get('evidence')
         }
         
         # Step 3: Prepare scan data for Supabase
@@ -198,11 +287,27 @@ def complete_scan(request):
             'status': 'completed',
             'label': scan_result['label'],
             'confidence': scan_result['confidence'],
+            'model_version': scan_result['model_version'],
+            'evidence': scan_result['evidence'],
             'cloudinary_url': upload_result['url']
         }
         
         # Step 4: Log the complete scan to Supabase
-        supabase_log = log_scan_to_supabase(user_id, upload_result['url'], scan_data)
+        with STAGE_SECONDS.labels('supabase').time():
+            supabase_log = log_scan_to_supabase(user_id, upload_result['url'], scan_data)
+        
+        # Step 5: Make the new scan findable by later near-duplicates
+        if prediction['embedding'] is not None and supabase_log and supabase_log.get('id'):
+            record_args = (supabase_log['id'], prediction['embedding'], prediction['label'],
+                           prediction['confidence'], prediction['model_version'])
+            try:
+                if sidecar is not None:
+                    sidecar.record_scan(*record_args)
+                else:
+                    from ml_embeddings import record_scan
+                    record_scan(*record_args)
+            except (OSError, ValueError, RuntimeError) as e:
+                logger.warning(f"Could not add scan {supabase_log['id']} to the embedding index: {e}")
         
         response_data = {
             'success': True,
@@ -210,6 +315,10 @@ def complete_scan(request):
             'data': {
                 'label': scan_result['label'],
                 'confidence': scan_result['confidence'],
+                'cached': scan_result['cached'],
+                'model_version': scan_result['model_version'],
+                'similarity': scan_result['similarity'],
+                'evidence': scan_result['evidence'],
                 'cloudinary_url': upload_result['url'],
                 'public_id': upload_result['public_id'],
                 'filename': upload_result['filename'],
@@ -245,6 +354,63 @@ def health_check(request):
     }, status=status.HTTP_200_OK)
 
 
+@api_view(['GET'])
+def inference_status(request):
+    """
+    Inference diagnostics for this worker process, or for the inference server
+    when ML_SIDECAR_SOCKET is set
+
+    Returns:
+    - 200: Loaded models, active model version, classifier and embedding batching engine
+           stats, prediction cache hit/miss counters, cascade escalation counters, metadata
+           fast-path counters, the worker's thread plan and embedding index sizes
+    """
+    sidecar = get_sidecar_client()
+    if sidecar is not None:
+        return Response({'success': True, 'data': sidecar.status()}, status=status.HTTP_200_OK)
+    
+    from ml_inference import registry
+    from ml_cache import get_cache
+    from ml_batching import engine_stats
+    from ml_cascade import get_cascade
+    from ml_metadata import get_metadata_stage
+    from ml_threads import current_plan
+    from ml_versions import get_store
+    from ml_embeddings import embedding_model_path, index_stats
+
+    cache = get_cache()
+    cascade = get_cascade()
+    stage = get_metadata_stage()
+    plan = current_plan()
+    return Response({
+        'success': True,
+        'data': {
+            'models': registry.describe(),
+            'active_version': get_store().active_version,
+            'batching': engine_stats(),
+            'embedding_batching': engine_stats(embedding_model_path(), embed=True),
+            'cache': cache.stats() if cache else None,
+            'cascade': cascade.stats() if cascade else None,
+            'metadata': stage.stats() if stage else None,
+            'threads': plan.describe() if plan else None,
+            'embedding_index': index_stats()
+        }
+    }, status=status.HTTP_200_OK)
+
+
+@require_GET
+def metrics(request):
+    """
+    Prometheus metrics for the whole server (every worker process)
+    
+    Returns:
+    - 200: Per-stage latency histograms (metadata fast path, decode, resize, normalize, queue
+           wait, forward, near-duplicate lookup, Cloudinary upload, Supabase insert, whole request),
+           batch size and queue depth histograms, prediction and error counters
+    """
+    return HttpResponse(exposition(), content_type=CONTENT_TYPE)
+
+
 @api_view(['GET'])
 def get_scan_history(request):
     """
@@ -611,3 +777,84 @@ def get_scan_by_id(request):
             {'error': f'Unexpected error: {str(e)}'}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+
+@api_view(['POST'])
+def submit_feedback(request):
+    """
+    Record whether a scan's label was right, optionally with the correct one
+    
+    Expected request:
+    - POST with JSON body containing 'scan_id' and 'helpful' (true or false)
+    - Optional 'correct_label' (one of the model's labels) when the prediction was wrong
+    - Optional 'user_id' (defaults to 'anonymous'), also used for ownership validation
+    
+    Confirmed and corrected labels are what refit_head trains the classifier head on.
+    
+    Returns:
+    - 200: Success with the stored feedback
+    - 400: Bad request (missing or inconsistent parameters, unknown label)
+    - 404: Scan not found
+    - 500: Server error
+    """
+    try:
+        from ml_inference import CLASS_LABELS
+        
+        data = json.loads(request.body) if request.body else {}
+        scan_id = data.get('scan_id')
+        helpful = data.get('helpful')
+        correct_label = data.get('correct_label') or None
+        user_id = data.get('user_id')
+        
+        if not scan_id or not isinstance(helpful, bool):
+            return Response(
+                {'error': 'scan_id and helpful (true or false) are required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if correct_label is not None and correct_label not in CLASS_LABELS.values():
+            return Response(
+                {'error': f"correct_label must be one of {', '.join(CLASS_LABELS.values())}"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        scan = fetch_scan_record(scan_id, user_id)
+        if scan is None:
+            return Response(
+                {'error': 'Scan record not found or access denied'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        result = scan.get('result') or {}
+        predicted_label = result.get('label')
+        if helpful and correct_label not in (None, predicted_label):
+            return Response(
+                {'error': 'A helpful result cannot have a different correct_label'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        feedback = log_scan_feedback(scan_id, user_id or 'anonymous', helpful, predicted_label,
+                                     correct_label, result.get('model_version'))
+        if feedback is None:
+            return Response(
+                {'error': 'Failed to store feedback'}, 
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        return Response({
+            'success': True,
+            'message': 'Feedback recorded',
+            'data': feedback
+        }, status=status.HTTP_200_OK)
+        
+    except json.JSONDecodeError:
+        return Response(
+            {'error': 'Invalid JSON in request body'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    except Exception as e:
+        logger.error(f"Error in submit_feedback: {e}")
+        return Response(
+            {'error': f'Unexpected error: {str(e)}'}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
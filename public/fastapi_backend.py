@@ -11,13 +11,22 @@ uvicorn fastapi_backend:app --reload
 
 import io
 import json
+import os
+import sys
 from typing import Optional
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
 import torch
-import torchvision.transforms as transforms
+
+# Share the inference code with the Django backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "artguard_backend"))
+from ml_preprocessing import CENTER_CROP
+from ml_batching import predict_image_bytes, QueueFullError
+from ml_versions import UnknownVersionError
+from ml_metrics import CONTENT_TYPE, STAGE_SECONDS, exposition
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -31,57 +40,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Define image transformation
-transform = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
-
-# Mock model prediction function
-# In production, replace with your actual fine-tuned model
-def predict_image(image):
-    # This is a placeholder - replace with your model inference code
-    # For example:
-    # model = torch.load("path/to/your/model.pth")
-    # with torch.no_grad():
-    #     outputs = model(image.unsqueeze(0))
-    
-    # Mock response for demonstration
-    import random
-    labels = ["Handmade", "AI-Generated", "Digital"]
-    label = random.choice(labels)
-    confidence = 0.7 + random.random() * 0.3  # Between 0.7 and 1.0
-    
+async def predict_image(contents, model_version=None):
+    """Classify raw image bytes via the prediction cache and the shared batching engine"""
+    # Cache lookups and waiting on the engine block, so keep them off the event loop
+    label, confidence, cached, used_version = await run_in_threadpool(
+        predict_image_bytes, contents, CENTER_CROP, model_version=model_version
+    )
     return {
         "label": label,
-        "confidence": confidence
+        "confidence": confidence,
+        "cached": cached,
+        "model_version": used_version
     }
 
 @app.get("/")
 def read_root():
     return {"status": "Art Classification API is running"}
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics aggregated over every worker process (same as Django's /api/metrics/)"""
+    return Response(content=exposition(), media_type=CONTENT_TYPE)
+
 @app.post("/predict/")
-async def predict(file: UploadFile = File(...)):
+async def predict(file: UploadFile = File(...), model_version: Optional[str] = None):
     # Check file type
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
     try:
-        # Read and process image
+        # Read the image
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
-        
-        # Preprocess the image
-        img_tensor = transform(image)
         
         # Get prediction
-        result = predict_image(img_tensor)
+        with STAGE_SECONDS.labels('request').time():
+            result = await predict_image(contents, model_version)
         
         return JSONResponse(content=result)
     
+    except (ValueError, UnknownVersionError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
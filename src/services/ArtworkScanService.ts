@@ -81,6 +81,13 @@ export interface BatchDeleteRequest {
   user_id?: string;
 }
 
+export interface FeedbackRequest {
+  scan_id: string;
+  helpful: boolean;
+  correct_label?: 'AI' | 'Handmade' | 'Print';
+  user_id?: string;
+}
+
 // API configuration
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000/api';
 
@@ -233,6 +240,14 @@ class ArtworkScanService {
     });
   }
 
+  // Submit feedback on a scan result
+  async submitFeedback(request: FeedbackRequest): Promise<{ success: boolean; message: string }> {
+    return this.makeRequest<{ success: boolean; message: string }>('/feedback/', {
+      method: 'POST',
+      body: JSON.stringify(request),
+    });
+  }
+
   // Health check
   async healthCheck(): Promise<{ status: string; message: string; version: string }> {
     return this.makeRequest<{ status: string; message: string; version: string }>('/health/');